@@ -20,7 +20,7 @@ public class Api {
 
 
 	public Api(String mcName, FileDescriptor log, FileDescriptor toSwift, Map<String, String> objectMd, 
-			   Map<String, String> reqMd, Logger localLog) 
+			   Map<String, String> reqMd, ApiObjectData objectData, ApiSwiftBus apiBus, Logger localLog) 
 	{	
 		String tenantId = reqMd.get("X-Tenant-Id");
 		String currentObject = reqMd.get("Referer").split("/",6)[5];
@@ -28,12 +28,12 @@ public class Api {
 		String method = reqMd.get("X-Method");
 		
 		logger_ = localLog;
-		swift = new ApiSwift(token, tenantId, logger_);
+		swift = new ApiSwift(token, tenantId, apiBus, logger_);
 		logger = new ApiLogger(log, logger_);
 		microcontroller = new ApiMicrocontroller(objectMd, mcName, currentObject, method, swift, logger_);
 		request = new ApiRequest(toSwift, reqMd, logger_);
 		storlet = new ApiStorlet(toSwift, logger_);
-		object = new ApiObject(objectMd, currentObject, swift, logger_);
+		object = new ApiObject(objectMd, currentObject, objectData, swift, logger_);
 		
 		logger_.trace("Full API created");
 	}
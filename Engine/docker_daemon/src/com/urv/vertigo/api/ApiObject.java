@@ -13,6 +13,7 @@ public class ApiObject {
 	private ApiSwift swift;
 	private Logger logger_;	
 	public Metadata metadata;
+	public ApiObjectData data; // null if the microcontroller can not read the object
 	public String timestamp;
 	public String etag;
 	public String lastModified;
@@ -20,8 +21,10 @@ public class ApiObject {
 	public String backendTimestamp;
 	public String contentType;
 	
-	public ApiObject(Map<String, String> objectMetadata, String currentObject, ApiSwift apiSwift, Logger logger) {
+	public ApiObject(Map<String, String> objectMetadata, String currentObject, ApiObjectData objectData,
+					 ApiSwift apiSwift, Logger logger) {
 		object = currentObject;
+		data = objectData;
 		swift = apiSwift;
 		logger_ = logger;
 		//objectMetadata.entrySet().removeIf(entry -> entry.getKey().startsWith("X-Object-Sysmeta-Vertigo"));
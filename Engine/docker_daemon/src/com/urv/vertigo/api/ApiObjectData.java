@@ -0,0 +1,86 @@
+package com.urv.vertigo.api;
+
+import java.io.FileDescriptor;
+import java.io.FileInputStream;
+import java.io.IOException;
+import java.io.InputStream;
+import java.nio.ByteBuffer;
+import java.nio.MappedByteBuffer;
+import java.nio.channels.FileChannel;
+
+import org.slf4j.Logger;
+
+/*
+ * Read-only access to the data of the object: the fd of its data file in
+ * the object server, or of a copy of a sample of it, with the
+ * [offset, offset + length) range that holds the data.
+ */
+public class ApiObjectData {
+	private Logger logger_;
+	private FileInputStream file;
+	private FileChannel channel;
+	private long offset;
+	private long length;
+
+	public ApiObjectData(FileDescriptor fd, long dataOffset, long dataLength, Logger logger) {
+		logger_ = logger;
+		file = new FileInputStream(fd);
+		channel = file.getChannel();
+		offset = dataOffset;
+		length = dataLength;
+
+		logger_.trace("ApiObjectData created");
+	}
+
+	public long length() {
+		return length;
+	}
+
+	/*
+	 * Reads up to buf.length bytes from position, without moving any
+	 * shared file offset. Returns the number of bytes read, or -1 at the end.
+	 */
+	public int read(long position, byte[] buf) throws IOException {
+		if (position >= length)
+			return -1;
+		int size = (int) Math.min(buf.length, length - position);
+		return channel.read(ByteBuffer.wrap(buf, 0, size), offset + position);
+	}
+
+	public InputStream getInputStream() {
+		return new InputStream() {
+			private long position = 0;
+
+			@Override
+			public int read() throws IOException {
+				byte[] b = new byte[1];
+				return read(b, 0, 1) == -1 ? -1 : b[0] & 0xff;
+			}
+
+			@Override
+			public int read(byte[] b, int off, int len) throws IOException {
+				if (position >= length)
+					return -1;
+				int size = (int) Math.min(len, length - position);
+				int n = channel.read(ByteBuffer.wrap(b, off, size), offset + position);
+				if (n > 0)
+					position += n;
+				return n;
+			}
+		};
+	}
+
+	/*
+	 * Maps the readable range in memory, read-only
+	 */
+	public MappedByteBuffer map() throws IOException {
+		return channel.map(FileChannel.MapMode.READ_ONLY, offset, length);
+	}
+
+	public void close() {
+		try {
+			file.close();
+		} catch (IOException e) {
+		}
+	}
+}
@@ -21,12 +21,20 @@ public class ApiStorlet {
 		logger_.trace("ApiStorlet created");
 	}
 
-	@SuppressWarnings("unchecked") 
+	/*
+	 * The server of the storlet is chosen by the placement planner of the
+	 * object server ("auto"), or pinned to "object" or "proxy".
+	 */
 	public void set(String storlet, String parameters){
+		set(storlet, parameters, "auto");
+	}
+
+	@SuppressWarnings("unchecked") 
+	public void set(String storlet, String parameters, String server){
 		JSONObject storletPack = new JSONObject();
 		storletPack.put("storlet",storlet);
 		storletPack.put("params",parameters);
-		storletPack.put("server","object");		
+		storletPack.put("server",server);
 		storletList.put(index,storletPack);
 		index = index+1;
 	}
@@ -44,11 +44,13 @@ public class ApiSwift {
 	
 	private Jedis redis = null;
 	private MemcachedClient mc = null;
+	private ApiSwiftBus bus = null; // null if the calls go through HTTP
 	public Metadata metadata;
 
 
-	public ApiSwift(String strToken, String projectId, Logger logger) {
+	public ApiSwift(String strToken, String projectId, ApiSwiftBus apiBus, Logger logger) {
 		token = strToken;
+		bus = apiBus;
 		tenantId = projectId;
 		storageUrl = swiftBackend+"AUTH_"+projectId+"/";
 		logger_ = logger;
@@ -74,7 +76,17 @@ public class ApiSwift {
 			String redisPrefix = tenantId+"/"+source+"_";
 			Set<String> keys = redis.keys(redisPrefix+"*");
 
-			if (keys.size() == 0){
+			if (keys.size() == 0 && bus != null){
+				ApiSwiftBus.Response response = bus.call("HEAD", source, null, null);
+				for (Entry<String, String> entry : response.headers.entrySet()) {
+					String key = entry.getKey();
+					String value = entry.getValue();
+					if (!unnecessaryHeaders.contains(key) && !key.startsWith("Vertigo")){
+						redis.set(redisPrefix+key.toLowerCase(), value);
+						metadata.put(key.toLowerCase(), value);
+					}
+				}
+			} else if (keys.size() == 0){
 				HttpURLConnection conn = newConnection(source);
 				try {
 					conn.setRequestMethod("HEAD");
@@ -164,7 +176,13 @@ public class ApiSwift {
 		public void flush(String source){
 			String redisPrefix = tenantId+"/"+source+"_";
 			Set<String> keys = redis.keys(redisPrefix+"x-object-meta-*");
-			if (keys.size()>0){
+			if (keys.size()>0 && bus != null){
+				Map<String, String> headers = new HashMap<String, String>();
+				for (String redisKey : keys) {
+					headers.put(redisKey.replace(redisPrefix, ""), redis.get(redisKey));
+				}
+				bus.call("POST", source, headers, null);
+			} else if (keys.size()>0){
 				HttpURLConnection conn = newConnection(source);
 				for (String redisKey : keys) {
 					String redisValue = redis.get(redisKey);
@@ -206,6 +224,12 @@ public class ApiSwift {
 	*/
 
 	public void setMicrocontroller(String source, String mc, String method, String metadata){
+		if (bus != null){
+			Map<String, String> headers = new HashMap<String, String>();
+			headers.put("X-Vertigo-on"+method, mc);
+			bus.call("POST", source, headers, metadata);
+			return;
+		}
 		HttpURLConnection conn = newConnection(source);
 		conn.setRequestProperty("X-Vertigo-on"+method, mc);
 		try {
@@ -217,7 +241,12 @@ public class ApiSwift {
 	}
 	
 	public void copy(String source, String dest){
-		if (!source.equals(dest)){
+		if (!source.equals(dest) && bus != null){
+			Map<String, String> headers = new HashMap<String, String>();
+			headers.put("X-Copy-From", source);
+			bus.call("PUT", dest, headers, null);
+			logger_.trace("Copying "+source+" object to "+dest);
+		} else if (!source.equals(dest)){
 			HttpURLConnection conn = newConnection(dest);
 			conn.setFixedLengthStreamingMode(0);
 			conn.setRequestProperty("X-Copy-From", source);
@@ -232,7 +261,12 @@ public class ApiSwift {
 	}
 	
 	public void move(String source, String dest){
-		if (!source.equals(dest)){
+		if (!source.equals(dest) && bus != null){
+			Map<String, String> headers = new HashMap<String, String>();
+			headers.put("X-Vertigo-Link-To", dest);
+			bus.call("PUT", source, headers, null);
+			logger_.trace("Moving "+source+" object to "+dest);
+		} else if (!source.equals(dest)){
 			HttpURLConnection conn = newConnection(source);
 			conn.setFixedLengthStreamingMode(0);
 			conn.setRequestProperty("X-Vertigo-Link-To", dest);
@@ -246,15 +280,24 @@ public class ApiSwift {
 		}
 	}
 	
+	// Prefetching fills the hot-object cache of the proxy, so it is only
+	// available to the microcontrollers run by the proxy, over the API bus
 	public void prefetch(String source){
-		String id =  "AUTH_"+tenantId+"/"+source;
-		//logger_.trace("Prefetching "+id);
-		String hash = MD5(id);
-		String data = "";
-		//mc.set(hash, 600, data);
+		if (bus == null){
+			logger_.trace("Prefetch of "+source+" skipped: only available on the proxy");
+			return;
+		}
+		Map<String, String> headers = new HashMap<String, String>();
+		headers.put("X-Vertigo-Prefetch", "True");
+		bus.call("POST", source, headers, null);
+		logger_.trace("Prefetching "+source);
 	}	
 	
 	public void delete(String source){
+		if (bus != null){
+			bus.call("DELETE", source, null, null);
+			return;
+		}
 		HttpURLConnection conn = newConnection(source);
 		try {
 			conn.setRequestMethod("DELETE");
@@ -0,0 +1,75 @@
+package com.urv.vertigo.api;
+
+import java.io.BufferedReader;
+import java.io.FileDescriptor;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.util.HashMap;
+import java.util.Map;
+
+import org.json.simple.JSONObject;
+import org.json.simple.parser.JSONParser;
+import org.json.simple.parser.ParseException;
+import org.slf4j.Logger;
+
+/*
+ * Client side of the API bus: each call is sent to the Swift middleware as a
+ * JSON line, and runs there as a subrequest of the request that triggered
+ * the microcontrollers, without HTTP or authentication.
+ */
+public class ApiSwiftBus {
+	private Logger logger_;
+	private FileOutputStream out;
+	private BufferedReader in;
+
+	public class Response {
+		public int status = 404;
+		public Map<String, String> headers = new HashMap<String, String>();
+	}
+
+	public ApiSwiftBus(FileDescriptor fd, Logger logger) {
+		logger_ = logger;
+		out = new FileOutputStream(fd);
+		in = new BufferedReader(new InputStreamReader(new FileInputStream(fd)));
+
+		logger_.trace("ApiSwiftBus created");
+	}
+
+	@SuppressWarnings("unchecked")
+	public synchronized Response call(String method, String object, Map<String, String> headers, String body) {
+		Response response = new Response();
+		JSONObject call = new JSONObject();
+		call.put("method", method);
+		call.put("object", object);
+		if (headers != null)
+			call.put("headers", new JSONObject(headers));
+		if (body != null)
+			call.put("body", body);
+		try {
+			out.write((call.toJSONString() + "\n").getBytes("UTF-8"));
+			out.flush();
+			String line = in.readLine();
+			if (line == null) {
+				logger_.trace("Error: API bus closed");
+				return response;
+			}
+			JSONObject result = (JSONObject) new JSONParser().parse(line);
+			response.status = ((Long) result.get("status")).intValue();
+			response.headers = (Map<String, String>) result.get("headers");
+		} catch (IOException e) {
+			logger_.trace("Error sending API call");
+		} catch (ParseException e) {
+			logger_.trace("Error parsing API response");
+		}
+		return response;
+	}
+
+	public void close() {
+		try {
+			out.close();
+		} catch (IOException e) {
+		}
+	}
+}
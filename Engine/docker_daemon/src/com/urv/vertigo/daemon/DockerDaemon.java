@@ -15,8 +15,6 @@ public class DockerDaemon {
 
 	private static ch.qos.logback.classic.Logger logger_;
 	private static SBus bus_;
-	private static SBus apiBus_;
-	private static String apiBusPath_;
 	private static ExecutorService threadPool_;
 	private static int nDefaultTimeoutToWaitBeforeShutdown_ = 3;
 
@@ -41,9 +39,11 @@ public class DockerDaemon {
 	 * main
 	 * 
 	 * Entry point.
-	 * args[1] - path to SBus
+	 * args[0] - path to SBus
+	 * args[1] - unused (the API bus is sent with each invocation)
 	 * args[2] - log level
 	 * args[3] - thread pool size
+	 * args[4] - container id
 	 * 
 	 * */
 	public static void main(String[] args) throws Exception {
@@ -59,7 +59,6 @@ public class DockerDaemon {
 	 * */
 	private static void initialize(String[] args) throws Exception {
 		String strBusPath = args[0];
-		apiBusPath_ = args[1];
 		String strLogLevel = args[2];
 		int nPoolSize = Integer.parseInt(args[3]);
 		String strContId = args[4];
@@ -69,14 +68,12 @@ public class DockerDaemon {
 
 		logger_.trace("Instanciating Bus");
 		bus_ = new SBus(strContId);
-		apiBus_ = new SBus(strContId);
 
 		try {
-			logger_.trace("Initialising Swift and API bus");
+			logger_.trace("Initialising Swift bus");
 			bus_.create(strBusPath);
-			apiBus_.create(apiBusPath_);
 		} catch (IOException e) {
-			logger_.error("Failed to create Swift and API Bus");
+			logger_.error("Failed to create Swift Bus");
 			return;
 		}
 		logger_.trace("Initialising thread pool with " + nPoolSize + " threads");
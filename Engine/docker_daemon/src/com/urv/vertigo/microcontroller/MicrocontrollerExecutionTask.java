@@ -2,6 +2,8 @@ package com.urv.vertigo.microcontroller;
 
 import com.ibm.storlet.sbus.SBusDatagram;
 import com.urv.vertigo.api.Api;
+import com.urv.vertigo.api.ApiObjectData;
+import com.urv.vertigo.api.ApiSwiftBus;
 
 import org.json.simple.JSONObject;
 import org.json.simple.parser.JSONParser;
@@ -45,6 +47,8 @@ public class MicrocontrollerExecutionTask implements Runnable {
 		
 		Map<String, String> object_md = null;
 		Map<String, String> req_md = null;
+		HashMap<String, ApiObjectData> objectData = new HashMap<String, ApiObjectData>();
+		ApiSwiftBus apiBus = null;
 		
 		String mcName, mcMainClass, mcDependencies = null;
 		Api api = null;
@@ -63,7 +67,15 @@ public class MicrocontrollerExecutionTask implements Runnable {
 				logger_.trace("Got Microcontroller output fd");
 				
 			} else if (strFDtype.equals("SBUS_FD_INPUT_OBJECT")){
-				//Isn't need to get fd
+				if (FilesMD[i].containsKey("microcontroller")) {
+					// Object data, only for the microcontroller that can read it
+					mcName = FilesMD[i].get("microcontroller");
+					objectData.put(mcName, new ApiObjectData(dtg.getFiles()[i],
+							Long.parseLong(FilesMD[i].get("data_offset")),
+							Long.parseLong(FilesMD[i].get("data_length")), logger_));
+					logger_.trace("Got object data fd for "+mcName);
+					continue;
+				}
 				JSONObject jsonMetadata;
 				try {
 					jsonMetadata = (JSONObject)new JSONParser().parse(FilesMD[i].get("json_md"));
@@ -74,6 +86,11 @@ public class MicrocontrollerExecutionTask implements Runnable {
 				}
 				logger_.trace("Got object and request metadata");
 	
+			} else if (strFDtype.equals("SBUS_FD_OUTPUT_OBJECT_METADATA")){
+				// API bus to the Swift middleware, sent as the output metadata fd
+				apiBus = new ApiSwiftBus(dtg.getFiles()[i], logger_);
+				logger_.trace("Got API bus fd");
+
 			} else if (strFDtype.equals("SBUS_FD_LOGGER")){
 				logFd = dtg.getFiles()[i];
 				mcName = FilesMD[i].get("microcontroller");
@@ -82,7 +99,7 @@ public class MicrocontrollerExecutionTask implements Runnable {
 				mcDependencies = FilesMD[i].get("dependencies");
 				logger_.trace("Got logger microcontroller fd for "+mcName);
 				
-				api = new Api(mcName, mcLog.get(mcName), toSwift, object_md, req_md, logger_);
+				api = new Api(mcName, mcLog.get(mcName), toSwift, object_md, req_md, objectData.get(mcName), apiBus, logger_);
 				mc = new Microcontroller(mcName, mcMainClass, mcDependencies, logger_);
 
 				logger_.trace("Microcontroller '"+mcName+"' loaded");
@@ -93,6 +110,10 @@ public class MicrocontrollerExecutionTask implements Runnable {
 				api = null;
 				microcontroller = null;
 			}
-		}					
+		}
+		for (ApiObjectData data : objectData.values())
+			data.close();
+		if (apiBus != null)
+			apiBus.close();
 	}
 }
\ No newline at end of file
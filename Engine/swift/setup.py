@@ -2,13 +2,20 @@ from setuptools import setup, find_packages
 
 paste_factory = ['vertigo_handler = '
                  'vertigo_middleware.vertigo_handler:filter_factory']
+console_scripts = ['vertigo-migrate-triggers = '
+                   'vertigo_middleware.tools.migrate_triggers:main',
+                   'vertigo-trigger-index = '
+                   'vertigo_middleware.tools.trigger_index:main',
+                   'vertigo-timer-scheduler = '
+                   'vertigo_middleware.tools.timer_scheduler:main']
 
 setup(name='swift_vertigo',
       version='0.0.4',
       description='Crystal filter middleware for OpenStack Swift',
       author='Josep Sampe',
       url='http://iostack.eu',
-      packages=find_packages(),
+      packages=find_packages(exclude=['test', 'test.*']),
       requires=['swift(>=1.4)','storlets(>=1.0)'],
-      entry_points={'paste.filter_factory': paste_factory}
+      entry_points={'paste.filter_factory': paste_factory,
+                    'console_scripts': console_scripts}
       )
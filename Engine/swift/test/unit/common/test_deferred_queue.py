@@ -0,0 +1,145 @@
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from vertigo_middleware.common import deferred_queue
+from vertigo_middleware.common.deferred_queue import DeferredQueue, \
+    DeferredInvoker
+
+
+class TestDeferredQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.logger = mock.Mock()
+        self.queue = DeferredQueue(self.path, 3, self.logger)
+
+    def test_put_claim_done(self):
+        with mock.patch('time.time', return_value=1000.0):
+            self.assertTrue(self.queue.put({'path': '/a'}))
+        with mock.patch('time.time', return_value=1001.0):
+            self.assertTrue(self.queue.put({'path': '/b'}))
+        self.assertEqual(len(self.queue), 2)
+        self.assertEqual(os.listdir(self.queue.tmp_dir), [])
+
+        claimed, job = self.queue.claim()
+        self.assertEqual(job, {'path': '/a'})
+        self.assertEqual(os.path.dirname(claimed), self.queue.processing_dir)
+        self.assertTrue(claimed.endswith('.%d' % os.getpid()))
+        self.assertEqual(len(self.queue), 1)
+        self.queue.done(claimed)
+        self.assertEqual(os.listdir(self.queue.processing_dir), [])
+
+        self.assertEqual(self.queue.claim()[1], {'path': '/b'})
+        self.assertIsNone(self.queue.claim())
+
+    def test_full(self):
+        for i in range(3):
+            self.assertTrue(self.queue.put({'job': i}))
+        self.assertFalse(self.queue.put({'job': 3}))
+        self.assertEqual(len(self.queue), 3)
+
+    def test_retry_is_claimed_when_due(self):
+        with mock.patch('time.time', return_value=1000.0):
+            self.queue.put({'path': '/a'})
+            claimed, job = self.queue.claim()
+            self.queue.retry(claimed, job, 60)
+            self.assertIsNone(self.queue.claim())
+        self.assertEqual(os.listdir(self.queue.processing_dir), [])
+        with mock.patch('time.time', return_value=1059.0):
+            self.assertIsNone(self.queue.claim())
+        with mock.patch('time.time', return_value=1060.0):
+            self.assertEqual(self.queue.claim()[1], {'path': '/a'})
+
+    def test_retry_does_not_block_due_jobs(self):
+        with mock.patch('time.time', return_value=1000.0):
+            self.queue.put({'path': '/a'})
+            claimed, job = self.queue.claim()
+            self.queue.retry(claimed, job, 60)
+        with mock.patch('time.time', return_value=1010.0):
+            self.queue.put({'path': '/b'})
+            self.assertEqual(self.queue.claim()[1], {'path': '/b'})
+
+    def test_corrupt_job_is_dropped(self):
+        self.queue.put({'path': '/a'})
+        name = os.listdir(self.queue.queue_dir)[0]
+        with open(os.path.join(self.queue.queue_dir, name), 'w') as f:
+            f.write('{')
+        self.assertIsNone(self.queue.claim())
+        self.assertEqual(os.listdir(self.queue.processing_dir), [])
+        self.assertTrue(self.logger.error.called)
+
+    def test_recover_jobs_of_dead_workers(self):
+        self.queue.put({'path': '/a'})
+        self.queue.put({'path': '/b'})
+        self.queue.claim()
+        with open(os.path.join(self.queue.processing_dir,
+                               '%016.5f-x.json.123' % 1), 'w') as f:
+            json.dump({'path': '/c'}, f)
+
+        alive = {os.getpid(): True, 123: False}
+        with mock.patch.object(deferred_queue, '_pid_alive',
+                               side_effect=alive.get):
+            self.queue.recover()
+        self.assertEqual(len(self.queue), 2)
+        self.assertEqual(len(os.listdir(self.queue.processing_dir)), 1)
+        self.assertEqual(self.queue.claim()[1], {'path': '/c'})
+
+
+class FailingInvoker(DeferredInvoker):
+
+    def __init__(self, conf, queue, failures):
+        super(FailingInvoker, self).__init__(conf, mock.Mock(), queue)
+        self.failures = failures
+        self.jobs = list()
+
+    def invoke(self, job):
+        self.jobs.append(dict(job))
+        if len(self.jobs) <= self.failures:
+            raise Exception('sandbox down')
+
+
+class TestDeferredInvoker(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = mock.Mock()
+        self.conf = {'deferred_max_retries': 2,
+                     'deferred_retry_interval': 10}
+
+    def test_done(self):
+        invoker = FailingInvoker(self.conf, self.queue, 0)
+        invoker._process('claimed', {'path': '/a'})
+        self.assertEqual(invoker.invoked, 1)
+        self.queue.done.assert_called_once_with('claimed')
+        self.assertFalse(self.queue.retry.called)
+
+    def test_retries_with_backoff(self):
+        invoker = FailingInvoker(self.conf, self.queue, 5)
+        job = {'path': '/a'}
+        invoker._process('claimed', job)
+        self.queue.retry.assert_called_once_with(
+            'claimed', {'path': '/a', 'retries': 1}, 10)
+        invoker._process('claimed', job)
+        self.queue.retry.assert_called_with(
+            'claimed', {'path': '/a', 'retries': 2}, 20)
+        self.assertFalse(self.queue.done.called)
+
+        # Dropped after deferred_max_retries
+        invoker._process('claimed', job)
+        self.assertEqual(self.queue.retry.call_count, 2)
+        self.queue.done.assert_called_once_with('claimed')
+        self.assertEqual(invoker.failed, 3)
+
+    def test_failed_retry_drops_job(self):
+        self.queue.retry.side_effect = OSError()
+        invoker = FailingInvoker(self.conf, self.queue, 1)
+        invoker._process('claimed', {'path': '/a'})
+        self.queue.done.assert_called_once_with('claimed')
+
+
+if __name__ == '__main__':
+    unittest.main()
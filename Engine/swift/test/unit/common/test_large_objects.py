@@ -0,0 +1,126 @@
+import eventlet
+import json
+import unittest
+
+from vertigo_middleware.common.large_objects import SegmentAssembler, \
+    check_segment, iter_segments, is_slo_manifest
+
+
+class FakeResponse(object):
+
+    def __init__(self, etag, length, status_int=200):
+        self.headers = {'Etag': etag}
+        self.content_length = length
+        self.status_int = status_int
+
+
+class TestIterSegments(unittest.TestCase):
+
+    def test_nested_manifests(self):
+        sub_manifests = {
+            '/c/sub': json.dumps([{'name': '/c/s2'}, {'name': '/c/s3'}])}
+        manifest = json.dumps([{'name': '/c/s1'},
+                               {'name': '/c/sub', 'sub_slo': True},
+                               {'name': '/c/s4'}])
+        segments = iter_segments(
+            manifest, lambda segment: sub_manifests[segment['name']])
+        self.assertEqual([segment['name'] for segment in segments],
+                         ['/c/s1', '/c/s2', '/c/s3', '/c/s4'])
+
+    def test_too_deep(self):
+        manifest = json.dumps([{'name': '/c/sub', 'sub_slo': True}])
+        segments = iter_segments(manifest, lambda segment: manifest)
+        self.assertRaises(ValueError, list, segments)
+
+    def test_is_slo_manifest(self):
+        self.assertTrue(is_slo_manifest({'X-Static-Large-Object': 'True'}))
+        self.assertFalse(is_slo_manifest({}))
+
+
+class TestCheckSegment(unittest.TestCase):
+
+    def setUp(self):
+        self.segment = {'name': '/c/s1', 'hash': 'abc', 'bytes': 3}
+
+    def test_valid(self):
+        check_segment(self.segment, FakeResponse('"abc"', 3))
+        # Only the ETag of a range of the segment is checked
+        check_segment(self.segment, FakeResponse('abc', 1, 206))
+
+    def test_replaced_segment(self):
+        self.assertRaises(ValueError, check_segment, self.segment,
+                          FakeResponse('def', 3))
+        self.assertRaises(ValueError, check_segment, self.segment,
+                          FakeResponse('abc', 4))
+
+    def test_entry_without_hash_or_size(self):
+        check_segment({'name': '/c/s1'}, FakeResponse('abc', 3))
+
+
+class TestSegmentAssembler(unittest.TestCase):
+
+    def test_in_order(self):
+        segments = [{'name': str(i), 'delay': 0.01 * (5 - i)}
+                    for i in range(5)]
+
+        def get_segment(segment):
+            # Later segments are read faster
+            eventlet.sleep(segment['delay'])
+            return [segment['name'] + 'a', segment['name'] + 'b']
+
+        body = SegmentAssembler(segments, get_segment, concurrency=3,
+                                buffer_chunks=1)
+        self.assertEqual(''.join(body), '0a0b1a1b2a2b3a3b4a4b')
+
+    def test_concurrency(self):
+        running = [0]
+        peak = [0]
+
+        def get_segment(segment):
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+            eventlet.sleep(0.01)
+            running[0] -= 1
+            return [segment]
+
+        body = SegmentAssembler(iter('abcdefg'), get_segment, concurrency=2)
+        self.assertEqual(''.join(body), 'abcdefg')
+        self.assertEqual(peak[0], 2)
+
+    def test_error_fails_body(self):
+        def get_segment(segment):
+            if segment == 'b':
+                raise ValueError('segment no longer valid')
+            return [segment]
+
+        body = iter(SegmentAssembler(iter('abc'), get_segment))
+        self.assertEqual(next(body), 'a')
+        self.assertRaises(ValueError, next, body)
+
+    def test_close_stops_readers(self):
+        closed = list()
+
+        class Body(object):
+
+            def __init__(self, name):
+                self.name = name
+
+            def __iter__(self):
+                for _ in range(100):
+                    yield self.name
+
+            def close(self):
+                closed.append(self.name)
+
+        assembler = SegmentAssembler(iter('abc'), Body, concurrency=3,
+                                     buffer_chunks=1)
+        body = iter(assembler)
+        self.assertEqual(next(body), 'a')
+        body.close()
+        self.assertEqual(len(assembler.pending), 0)
+        eventlet.sleep(0)
+        self.assertEqual(sorted(closed), ['a', 'b', 'c'])
+
+
+if __name__ == '__main__':
+    unittest.main()
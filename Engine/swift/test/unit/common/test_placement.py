@@ -0,0 +1,91 @@
+import mock
+import unittest
+
+from vertigo_middleware.common.placement import StorletPlacementPlanner, \
+    ObservedIter, MB
+
+
+class TestStorletPlacementPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self.planner = StorletPlacementPlanner(
+            {'storlet_network_cost': 0.01}, mock.Mock())
+        patcher = mock.patch.object(self.planner, 'get_load',
+                                    return_value=0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stage(self, name, selectivity, cpu_cost, server='auto'):
+        return (name, {'Selectivity': str(selectivity),
+                       'Cpu-Cost': str(cpu_cost)}, server)
+
+    def test_filter_runs_on_object_server(self):
+        # Discards most of the data: cheaper before the transfer
+        split, _ = self.planner.plan([self.stage('grep', 0.01, 0.001)],
+                                     100 * MB, 0.0)
+        self.assertEqual(split, 1)
+
+    def test_expanding_stage_runs_on_proxy(self):
+        split, _ = self.planner.plan([self.stage('unzip', 10, 0.001)],
+                                     100 * MB, 0.0)
+        self.assertEqual(split, 0)
+
+    def test_load_moves_stages(self):
+        stages = [self.stage('transcode', 1, 0.1)]
+        self.planner.get_load.return_value = 3.0
+        self.assertEqual(self.planner.plan(stages, 100 * MB, 0.0)[0], 0)
+        self.planner.get_load.return_value = 0.0
+        self.assertEqual(self.planner.plan(stages, 100 * MB, 3.0)[0], 1)
+
+    def test_split_between_stages(self):
+        stages = [self.stage('grep', 0.01, 0.001),
+                  self.stage('unzip', 10, 0.001)]
+        split, explanation = self.planner.plan(stages, 100 * MB, 0.0)
+        self.assertEqual(split, 1)
+        self.assertIn('grep@object', explanation)
+        self.assertIn('unzip@proxy', explanation)
+
+    def test_pinned_servers(self):
+        stages = [self.stage('unzip', 10, 0.001, 'object'),
+                  self.stage('grep', 0.01, 0.001, 'proxy')]
+        self.assertEqual(self.planner.plan(stages, 100 * MB, 0.0)[0], 1)
+        stages.reverse()
+        self.assertEqual(self.planner.plan(stages, 100 * MB, 0.0),
+                         (None, 'infeasible'))
+
+    def test_unknown_size_and_proxy_load(self):
+        split, _ = self.planner.plan([self.stage('grep', 0.01, 0.001)],
+                                     None, None)
+        self.assertEqual(split, 1)
+
+    def test_learned_stats(self):
+        metadata = {'Selectivity': '10'}
+        self.assertEqual(self.planner.get_stats('s', metadata), (10.0, 0.01))
+        # 1 MB in, 0.1 MB out, in 1 second
+        self.planner.observe('s', metadata, MB, MB / 10, 1.0)
+        selectivity, cpu_cost = self.planner.get_stats('s', metadata)
+        self.assertAlmostEqual(selectivity, 10 + 0.2 * (0.1 - 10))
+        self.assertAlmostEqual(cpu_cost, 0.01 + 0.2 * (1 - 0.01))
+        self.planner.observe('s', metadata, 0, 0, 1.0)
+        self.assertEqual(self.planner.get_stats('s', metadata),
+                         (selectivity, cpu_cost))
+
+    def test_invalid_declared_stats(self):
+        self.assertEqual(self.planner.get_stats('s', {'Selectivity': 'x'}),
+                         (1.0, 0.01))
+
+
+class TestObservedIter(unittest.TestCase):
+
+    def test_reports_size_and_time(self):
+        callback = mock.Mock()
+        times = iter([0, 1, 5, 6, 10, 12])
+        with mock.patch('time.time', side_effect=lambda: next(times)):
+            chunks = list(ObservedIter(iter(['ab', 'cde']), callback))
+        self.assertEqual(chunks, ['ab', 'cde'])
+        # Only the time spent in the storlet output iterator
+        callback.assert_called_once_with(5, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
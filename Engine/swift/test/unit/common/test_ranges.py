@@ -0,0 +1,115 @@
+import mock
+import unittest
+
+from swift.common.swob import Request, Response
+
+from vertigo_middleware.common.ranges import RangeSafePipeline, SpooledBody
+
+DATA = 'abcdefghijklmnopqrstuvwxyz'
+
+
+class FakeDiskReader(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.read = list()
+        self.closed = False
+
+    def __iter__(self):
+        return self.app_iter_range(0, len(self.data))
+
+    def app_iter_range(self, start, stop):
+        self.read.append((start, stop))
+        yield self.data[start:stop]
+
+    def close(self):
+        self.closed = True
+
+
+def upper(data_iter):
+    # Range-safe storlet: keeps the offset of every byte
+    for chunk in data_iter:
+        yield chunk.upper()
+
+
+def get_ranged(body, range_header, length=len(DATA)):
+    """
+    :returns: (status, body, headers) of the response, as sent by swob
+    """
+    request = Request.blank('/v1/a/c/o', headers={'Range': range_header})
+    response = Response(app_iter=body, request=request,
+                        conditional_response=True)
+    response.content_length = length
+    sent = dict()
+
+    def start_response(status, headers):
+        sent['status'] = int(status.split()[0])
+        sent['headers'] = dict(headers)
+
+    body = ''.join(response(request.environ, start_response))
+    return sent['status'], body, sent['headers']
+
+
+class TestRangeSafePipeline(unittest.TestCase):
+
+    def test_whole_body(self):
+        source = FakeDiskReader(DATA)
+        self.assertEqual(''.join(RangeSafePipeline(upper, source)),
+                         DATA.upper())
+
+    def test_range_reads_only_the_range(self):
+        source = FakeDiskReader(DATA)
+        status, body, _ = get_ranged(RangeSafePipeline(upper, source),
+                                     'bytes=2-4')
+        self.assertEqual(status, 206)
+        self.assertEqual(body, 'CDE')
+        self.assertEqual(source.read, [(2, 5)])
+
+    def test_multiple_ranges(self):
+        source = FakeDiskReader(DATA)
+        status, body, headers = get_ranged(
+            RangeSafePipeline(upper, source), 'bytes=0-1,-2')
+        self.assertEqual(status, 206)
+        self.assertTrue(headers['Content-Type'].startswith(
+            'multipart/byteranges'))
+        self.assertIn('AB', body)
+        self.assertIn('YZ', body)
+        self.assertEqual(source.read, [(0, 2), (24, 26)])
+
+    def test_close(self):
+        source = FakeDiskReader(DATA)
+        RangeSafePipeline(upper, source).close()
+        self.assertTrue(source.closed)
+
+
+class TestSpooledBody(unittest.TestCase):
+
+    def test_spools_and_closes_input(self):
+        data_iter = mock.MagicMock()
+        data_iter.__iter__.return_value = iter(['abc', 'def'])
+        body = SpooledBody(data_iter, 2)
+        data_iter.close.assert_called_once_with()
+        self.assertEqual(body.length, 6)
+        self.assertEqual(''.join(body), 'abcdef')
+        # It can be read again, from the spool
+        self.assertEqual(''.join(body), 'abcdef')
+        body.close()
+
+    def test_ranges(self):
+        body = SpooledBody(iter([DATA[:10], DATA[10:]]), 4)
+        status, ranged, _ = get_ranged(body, 'bytes=8-12', body.length)
+        self.assertEqual(status, 206)
+        self.assertEqual(ranged, 'ijklm')
+        status, ranged, _ = get_ranged(body, 'bytes=0-0,-1', body.length)
+        self.assertEqual(status, 206)
+        self.assertIn('\r\n\r\na\r\n', ranged)
+        self.assertIn('\r\n\r\nz\r\n', ranged)
+
+    def test_unsatisfiable_range(self):
+        body = SpooledBody(iter([DATA]), 4)
+        status, _, _ = get_ranged(body, 'bytes=100-', body.length)
+        self.assertEqual(status, 416)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,285 @@
+import json
+import mock
+import unittest
+
+from vertigo_middleware.common.scheduler import TimerScheduler, TokenBucket
+from vertigo_middleware.common.triggers import TriggerTable
+
+
+class FakeClock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeSandbox(object):
+
+    def __init__(self):
+        self.batches = list()
+        self.fail = False
+
+    def invoke_batch(self, account, batch):
+        if self.fail:
+            raise Exception('sandbox down')
+        self.batches.append((account, batch))
+        return dict((name, None) for name, _, _ in batch)
+
+
+class FakeIndex(object):
+
+    def __init__(self):
+        self.triggers = list()  # (name, data_file, trigger, mc)
+        self.policies = dict()  # policy_id: [(name, data_file)]
+        self.last_fired = dict()
+        self.fired = list()
+
+    def find(self, trigger=None, mc=None):
+        return [row for row in self.triggers if row[2] == trigger]
+
+    def get_policies(self):
+        return iter(self.policies)
+
+    def find_by_policy(self, policy_id):
+        return iter(self.policies.get(policy_id, ()))
+
+    def get_last_fired(self):
+        return dict(self.last_fired)
+
+    def set_last_fired(self, fired):
+        self.fired.append(fired)
+
+
+class FakePolicyStore(object):
+
+    def __init__(self, policies):
+        self.policies = policies
+
+    def get(self, vertigo, policy_id, min_version=None):
+        return None, self.policies.get(policy_id)
+
+
+def make_table(*mcs, **params):
+    table = TriggerTable()
+    for mc in mcs:
+        table.add('ontimer', mc, params.get(mc))
+    return table
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2.0, burst=2.0, now=0)
+        self.assertEqual(bucket.take(0), 0)
+        self.assertEqual(bucket.take(0), 0)
+        self.assertEqual(bucket.take(0), 0.5)
+        self.assertEqual(bucket.take(0.5), 0)
+
+    def test_refill_is_capped_by_burst(self):
+        bucket = TokenBucket(rate=1.0, burst=2.0, now=0)
+        bucket.take(0)
+        bucket.take(0)
+        for _ in range(2):
+            self.assertEqual(bucket.take(100), 0)
+        self.assertEqual(bucket.take(100), 1)
+
+
+class TestTimerScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock(1000)
+        self.sandbox = FakeSandbox()
+        self.index = FakeIndex()
+        # Metadata of each data file: the trigger table itself
+        self.tables = dict()
+        patcher = mock.patch.multiple(
+            'vertigo_middleware.common.scheduler',
+            get_object_metadata=lambda data_file: self.tables[data_file],
+            get_object_trigger_table=lambda metadata, store: metadata)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.conf = {'timer_jitter': 0, 'timer_min_interval': 1,
+                     'timer_default_interval': 100}
+
+    def make_scheduler(self, **kwargs):
+        conf = dict(self.conf)
+        conf.update(kwargs.pop('conf', {}))
+        return TimerScheduler(self.index, self.sandbox, conf, mock.Mock(),
+                              clock=self.clock, **kwargs)
+
+    def add_object(self, name, *mcs, **params):
+        data_file = '/srv/node/d1/%s.data' % name.replace('/', '_')
+        self.tables[data_file] = make_table(*mcs, **params)
+        for mc in mcs:
+            self.index.triggers.append((name, data_file, 'ontimer', mc))
+        return data_file
+
+    def run_at(self, scheduler, now):
+        self.clock.now = now
+        return scheduler.run_pending()
+
+    def test_first_firing_and_period(self):
+        data_file = self.add_object('/AUTH_a/c/o', 'mc1',
+                                    mc1=json.dumps({'interval': 60}))
+        scheduler = self.make_scheduler()
+        self.assertEqual(scheduler.sync(), 1)
+
+        self.assertEqual(self.run_at(scheduler, 1000), 0)
+        self.assertEqual(self.run_at(scheduler, 1001), 1)
+        self.assertEqual(self.sandbox.batches,
+                         [('AUTH_a', [('/AUTH_a/c/o', data_file, ['mc1'])])])
+        self.assertEqual(self.index.fired, [[('/AUTH_a/c/o', 'mc1', 1000)]])
+
+        self.assertEqual(self.run_at(scheduler, 1059), 0)
+        self.assertEqual(self.run_at(scheduler, 1060), 1)
+        self.assertEqual(self.index.fired[-1], [('/AUTH_a/c/o', 'mc1', 1060)])
+
+    def test_min_interval(self):
+        self.add_object('/AUTH_a/c/o', 'mc1',
+                        mc1=json.dumps({'interval': 1}))
+        scheduler = self.make_scheduler(conf={'timer_min_interval': 30})
+        scheduler.sync()
+        entry = scheduler.entries[('/AUTH_a/c/o', 'mc1')]
+        self.assertEqual(entry.interval, 30)
+
+    def _catch_up(self, rule, **conf):
+        # Last fired 350s ago with a period of 100s: 3 firings missed
+        self.add_object('/AUTH_a/c/o', 'mc1', mc1=json.dumps(
+            {'interval': 100, 'catch_up': rule}))
+        self.index.last_fired[('/AUTH_a/c/o', 'mc1')] = 650
+        scheduler = self.make_scheduler(conf=conf)
+        scheduler.sync()
+        fired = [self.run_at(scheduler, now) for now in range(1001, 1006)]
+        return scheduler, fired
+
+    def test_catch_up_skip(self):
+        scheduler, fired = self._catch_up('skip')
+        self.assertEqual(fired, [0] * 5)
+        self.assertEqual(self.run_at(scheduler, 1050), 1)
+        self.assertEqual(self.index.fired, [[('/AUTH_a/c/o', 'mc1', 1050)]])
+
+    def test_catch_up_once(self):
+        scheduler, fired = self._catch_up('once')
+        self.assertEqual(fired, [1, 0, 0, 0, 0])
+        # The last missed firing, and then back in the rhythm
+        self.assertEqual(self.index.fired, [[('/AUTH_a/c/o', 'mc1', 950)]])
+        self.assertEqual(self.run_at(scheduler, 1049), 0)
+        self.assertEqual(self.run_at(scheduler, 1050), 1)
+
+    def test_catch_up_all(self):
+        scheduler, fired = self._catch_up('all')
+        self.assertEqual(fired, [1, 1, 1, 0, 0])
+        # Recorded once all the missed firings have run
+        self.assertEqual(self.index.fired, [[], [],
+                                            [('/AUTH_a/c/o', 'mc1', 950)]])
+        self.assertEqual(self.run_at(scheduler, 1050), 1)
+
+    def test_catch_up_all_is_bounded(self):
+        _, fired = self._catch_up('all', timer_max_catch_up=2)
+        self.assertEqual(fired, [1, 1, 0, 0, 0])
+
+    def test_catch_up_default_rule(self):
+        self.add_object('/AUTH_a/c/o', 'mc1',
+                        mc1=json.dumps({'interval': 100}))
+        self.index.last_fired[('/AUTH_a/c/o', 'mc1')] = 650
+        scheduler = self.make_scheduler(conf={'timer_catch_up': 'skip'})
+        scheduler.sync()
+        self.assertEqual(self.run_at(scheduler, 1001), 0)
+        self.assertEqual(self.run_at(scheduler, 1050), 1)
+
+    def test_tenant_rate_limit(self):
+        for obj in ('o1', 'o2', 'o3'):
+            self.add_object('/AUTH_a/c/' + obj, 'mc1')
+        self.add_object('/AUTH_b/c/o', 'mc1')
+        scheduler = self.make_scheduler(conf={'timer_tenant_rate': 1,
+                                              'timer_tenant_burst': 2})
+        scheduler.sync()
+        # AUTH_a has tokens for 2 of its 3 objects, AUTH_b is not affected
+        self.assertEqual(self.run_at(scheduler, 1001), 3)
+        self.assertEqual(scheduler.deferred, 1)
+        self.assertEqual(self.run_at(scheduler, 1002), 1)
+        accounts = [account for account, _ in self.sandbox.batches]
+        self.assertEqual(sorted(accounts), ['AUTH_a', 'AUTH_a', 'AUTH_b'])
+
+    def test_batches(self):
+        for obj in ('o1', 'o2', 'o3'):
+            self.add_object('/AUTH_a/c/' + obj, 'mc1')
+        self.add_object('/AUTH_a/c/o4', 'mc1', 'mc2')
+        scheduler = self.make_scheduler(conf={'timer_batch_size': 2})
+        scheduler.sync()
+        self.assertEqual(self.run_at(scheduler, 1001), 5)
+        batches = [batch for _, batch in self.sandbox.batches]
+        self.assertEqual([len(batch) for batch in batches], [2, 2])
+        # Each object once, with all its due microcontrollers
+        mc_lists = dict((name, sorted(mc_list))
+                        for batch in batches
+                        for name, _, mc_list in batch)
+        self.assertEqual(mc_lists['/AUTH_a/c/o4'], ['mc1', 'mc2'])
+        self.assertEqual(len(mc_lists), 4)
+
+    def test_failed_batch_is_retried(self):
+        self.add_object('/AUTH_a/c/o', 'mc1')
+        scheduler = self.make_scheduler(conf={'timer_retry_interval': 10})
+        scheduler.sync()
+        self.sandbox.fail = True
+        self.assertEqual(self.run_at(scheduler, 1001), 0)
+        self.assertEqual(scheduler.failed, 1)
+        self.assertEqual(self.index.fired, [])
+        self.sandbox.fail = False
+        self.assertEqual(self.run_at(scheduler, 1010), 0)
+        self.assertEqual(self.run_at(scheduler, 1011), 1)
+
+    def test_sync_cancels_removed_timers(self):
+        self.add_object('/AUTH_a/c/o', 'mc1')
+        scheduler = self.make_scheduler()
+        scheduler.sync()
+        self.index.triggers = list()
+        self.assertEqual(scheduler.sync(), 0)
+        self.assertEqual(self.run_at(scheduler, 1001), 0)
+
+    def test_owner(self):
+        self.add_object('/AUTH_a/c/o1', 'mc1')
+        self.add_object('/AUTH_a/c/o2', 'mc1')
+        scheduler = self.make_scheduler(
+            owner=lambda data_file: 'o1' in data_file)
+        self.assertEqual(scheduler.sync(), 1)
+        self.run_at(scheduler, 1001)
+        self.assertEqual(
+            [name for name, _, _ in self.sandbox.batches[0][1]],
+            ['/AUTH_a/c/o1'])
+
+    def test_inherited_timers(self):
+        data_file = '/srv/node/d1/inherited.data'
+        self.tables[data_file] = make_table('mc1')
+        self.index.policies['/v1/AUTH_a/c'] = [('/AUTH_a/c/o', data_file)]
+        overridden = '/srv/node/d1/overridden.data'
+        self.tables[overridden] = TriggerTable()
+        self.index.policies['/v1/AUTH_a/c'].append(('/AUTH_a/c/o2',
+                                                    overridden))
+        store = FakePolicyStore({'/v1/AUTH_a/c': make_table('mc1')})
+        scheduler = self.make_scheduler(policy_store=store)
+        # The object that overrides the inherited timer is not scheduled
+        self.assertEqual(scheduler.sync(), 1)
+        self.assertEqual(self.run_at(scheduler, 1001), 1)
+        self.assertEqual(self.sandbox.batches,
+                         [('AUTH_a', [('/AUTH_a/c/o', data_file, ['mc1'])])])
+
+    def test_jitter_is_stable_and_bounded(self):
+        self.add_object('/AUTH_a/c/o', 'mc1',
+                        mc1=json.dumps({'interval': 1000}))
+        scheduler = self.make_scheduler(conf={'timer_jitter': 0.1,
+                                              'timer_max_jitter': 50})
+        scheduler.sync()
+        entry = scheduler.entries[('/AUTH_a/c/o', 'mc1')]
+        jitter = scheduler._get_jitter(entry)
+        self.assertTrue(0 <= jitter < 50)
+        self.assertEqual(jitter, scheduler._get_jitter(entry))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+
+from vertigo_middleware.common.timer_wheel import TimerWheel
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        # Level 0 spans 4 ticks and level 1 spans 16: later deadlines
+        # wait in the overflow list
+        self.wheel = TimerWheel(tick=1, slots=4, levels=2, start=0)
+
+    def test_expires_at_deadline(self):
+        self.wheel.schedule('a', 3, 'A')
+        self.assertEqual(self.wheel.advance(2), [])
+        self.assertIn('a', self.wheel)
+        self.assertEqual(self.wheel.advance(3), [('a', 3.0, 'A')])
+        self.assertNotIn('a', self.wheel)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cascades_in_deadline_order(self):
+        for key, deadline in (('c', 13), ('a', 2), ('b', 5)):
+            self.wheel.schedule(key, deadline, key.upper())
+        self.assertEqual(self.wheel.advance(12), [('a', 2.0, 'A'),
+                                                  ('b', 5.0, 'B')])
+        self.assertEqual(self.wheel.advance(20), [('c', 13.0, 'C')])
+
+    def test_cascade_keeps_exact_deadline(self):
+        # Placed in level 1, in the slot that also covers ticks 8 to 11
+        self.wheel.schedule('a', 10, 'A')
+        self.assertEqual(self.wheel.advance(9), [])
+        self.assertEqual(self.wheel.advance(10), [('a', 10.0, 'A')])
+
+    def test_cancel(self):
+        self.wheel.schedule('a', 5, 'A')
+        self.wheel.schedule('b', 6, 'B')
+        self.assertEqual(self.wheel.cancel('a'), 'A')
+        self.assertIsNone(self.wheel.cancel('a'))
+        self.assertNotIn('a', self.wheel)
+        self.assertEqual(self.wheel.advance(10), [('b', 6.0, 'B')])
+
+    def test_cancel_cascaded_timer(self):
+        self.wheel.schedule('a', 10, 'A')
+        self.wheel.advance(8)
+        self.wheel.cancel('a')
+        self.assertEqual(self.wheel.advance(20), [])
+
+    def test_reschedule_replaces_timer(self):
+        self.wheel.schedule('a', 5, 'A')
+        self.wheel.schedule('a', 8, 'A2')
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(self.wheel.advance(6), [])
+        self.assertEqual(self.wheel.advance(8), [('a', 8.0, 'A2')])
+
+    def test_overflow(self):
+        self.wheel.schedule('a', 40, 'A')
+        self.wheel.schedule('b', 3, 'B')
+        self.assertIn('a', self.wheel.overflow)
+        self.assertEqual(self.wheel.advance(39), [('b', 3.0, 'B')])
+        self.assertEqual(self.wheel.advance(40), [('a', 40.0, 'A')])
+        self.assertEqual(self.wheel.overflow, {})
+
+    def test_cancel_overflow_timer(self):
+        self.wheel.schedule('a', 40, 'A')
+        self.wheel.cancel('a')
+        self.wheel.schedule('b', 50, 'B')
+        self.assertEqual(self.wheel.advance(60), [('b', 50.0, 'B')])
+
+    def test_past_deadline_expires_on_next_tick(self):
+        self.wheel.advance(10)
+        self.wheel.schedule('a', 4, 'A')
+        self.assertEqual(self.wheel.advance(10), [])
+        self.assertEqual(self.wheel.advance(11), [('a', 11.0, 'A')])
+
+    def test_empty_wheel_jumps_to_now(self):
+        self.assertEqual(self.wheel.advance(1000), [])
+        self.assertEqual(self.wheel.current, 1000)
+        self.wheel.schedule('a', 1002, 'A')
+        self.assertEqual(self.wheel.advance(1002), [('a', 1002.0, 'A')])
+
+    def test_tick_resolution(self):
+        wheel = TimerWheel(tick=0.5, slots=4, levels=2, start=0)
+        # Rounded up to the next tick
+        wheel.schedule('a', 1.2, 'A')
+        self.assertEqual(wheel.advance(1.4), [])
+        self.assertEqual(wheel.advance(1.5), [('a', 1.5, 'A')])
+
+
+if __name__ == '__main__':
+    unittest.main()
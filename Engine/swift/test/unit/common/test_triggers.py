@@ -0,0 +1,127 @@
+import unittest
+
+from vertigo_middleware.common import triggers
+from vertigo_middleware.common.triggers import TriggerTable, \
+    load_trigger_table, store_trigger_table, get_effective_table
+
+PREFIX = 'X-Object-Sysmeta-Vertigo-'
+
+
+class TestTriggerTable(unittest.TestCase):
+
+    def test_encode_decode(self):
+        table = TriggerTable()
+        table.add('onget', 'mc1')
+        table.add('onget', 'mc2', '{"interval": 60}')
+        table.add('ontimer', 'mc3', 'params')
+        value = table.encode()
+        self.assertEqual(
+            value, 'v1:{"g":[["mc1"],["mc2","{\\"interval\\": 60}"]],'
+                   '"t":[["mc3","params"]]}')
+
+        decoded = TriggerTable.decode(value)
+        self.assertEqual(decoded.triggers, table.triggers)
+        self.assertEqual(decoded.params, table.params)
+        # Native strings, as in the rest of the metadata
+        self.assertIsInstance(decoded.get_list('onget')[0], str)
+
+    def test_empty_trigger_round_trip(self):
+        table = TriggerTable()
+        table.add('onget', 'mc1')
+        table.remove('onget', 'mc1', keep_empty=True)
+        decoded = TriggerTable.decode(table.encode())
+        self.assertEqual(decoded.triggers, {'onget': []})
+        self.assertIsNone(decoded.get_list('onget'))
+
+    def test_decode_legacy(self):
+        table = TriggerTable.decode(
+            "{'onget': ['mc1', 'mc2'], 'onput': None, 'ondelete': []}")
+        self.assertEqual(table.triggers, {'onget': ['mc1', 'mc2']})
+        table = TriggerTable.decode({'onput': ['mc1']})
+        self.assertEqual(table.triggers, {'onput': ['mc1']})
+
+    def test_decode_unknown_version(self):
+        self.assertRaises(ValueError, TriggerTable.decode, 'v2:{}')
+
+    def test_encode_too_large(self):
+        table = TriggerTable()
+        table.add('onget', 'mc', 'x' * triggers.MAX_TRIGGER_TABLE_SIZE)
+        self.assertRaises(ValueError, table.encode)
+
+    def test_add_unknown_trigger(self):
+        self.assertRaises(ValueError, TriggerTable().add, 'onhead', 'mc')
+
+    def test_remove(self):
+        table = TriggerTable()
+        table.add('onget', 'mc1', 'p1')
+        table.add('onget', 'mc2', 'p2')
+        table.remove('onget', 'mc1')
+        self.assertEqual(table.triggers, {'onget': ['mc2']})
+        self.assertEqual(table.params, {('onget', 'mc2'): 'p2'})
+        self.assertRaises(ValueError, table.remove, 'onget', 'mc1')
+        table.remove('onget', 'all')
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.params, {})
+
+    def test_overlay(self):
+        policy = TriggerTable()
+        policy.add('onget', 'mc1', 'p1')
+        policy.add('onput', 'mc2')
+        own = TriggerTable()
+        own.add('onget', 'mc3', 'p3')
+        effective = policy.overlay(own)
+        self.assertEqual(effective.triggers, {'onget': ['mc3'],
+                                              'onput': ['mc2']})
+        self.assertEqual(effective.params, {('onget', 'mc3'): 'p3'})
+        # The policy is not changed
+        self.assertEqual(policy.get_list('onget'), ['mc1'])
+
+
+class TestTriggerMetadata(unittest.TestCase):
+
+    def test_load_legacy_parameters(self):
+        metadata = {PREFIX + 'Microcontroller': "{'onget': ['mc1']}",
+                    PREFIX + 'Onget-Mc1': 'params'}
+        table = load_trigger_table(metadata, PREFIX)
+        self.assertEqual(table.params, {('onget', 'mc1'): 'params'})
+
+    def test_load_without_triggers(self):
+        self.assertIsNone(load_trigger_table({}, PREFIX))
+        metadata = {PREFIX + 'Microcontroller': 'v1:{}'}
+        self.assertIsNone(load_trigger_table(metadata, PREFIX))
+
+    def test_store_migrates_legacy_format(self):
+        metadata = {PREFIX + 'Microcontroller': "{'onget': ['mc1']}",
+                    PREFIX + 'Onget-Mc1': 'params',
+                    'X-Object-Meta-Other': 'kept'}
+        table = load_trigger_table(metadata, PREFIX)
+        self.assertTrue(store_trigger_table(metadata, table, PREFIX))
+        self.assertEqual(metadata, {
+            PREFIX + 'Microcontroller': 'v1:{"g":[["mc1","params"]]}',
+            'X-Object-Meta-Other': 'kept'})
+        self.assertFalse(store_trigger_table(metadata, table, PREFIX))
+
+    def test_store_empty_table(self):
+        metadata = {PREFIX + 'Microcontroller': 'v1:{"g":[["mc1"]]}'}
+        self.assertTrue(store_trigger_table(metadata, None, PREFIX))
+        self.assertEqual(metadata, {})
+        metadata = {PREFIX + 'Microcontroller': 'v1:{"g":[["mc1"]]}'}
+        store_trigger_table(metadata, None, PREFIX, '')
+        self.assertEqual(metadata, {PREFIX + 'Microcontroller': ''})
+
+    def test_effective_table(self):
+        policy = TriggerTable()
+        policy.add('onget', 'mc1')
+        policy.add('ontimer', 'mc2')
+        metadata = {PREFIX + 'Policy': '/v1/a/c@0000000001.00000',
+                    PREFIX + 'Microcontroller': 'v1:{"g":[]}'}
+        table = get_effective_table(metadata, PREFIX, '/v1/a/c', policy)
+        # The object overrides onget with an empty list
+        self.assertEqual(table.triggers, {'onget': [], 'ontimer': ['mc2']})
+        # References to another policy do not inherit it
+        table = get_effective_table(metadata, PREFIX, '/v1/a/c2', policy)
+        self.assertEqual(table.triggers, {'onget': []})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+from swift.common.swob import Response
+from swift.common.utils import list_from_csv
+from eventlet.event import Event
+from eventlet.queue import LightQueue
+from collections import OrderedDict
+import hashlib
+import eventlet
+
+
+# Headers that change on every request, and never make two GETs different
+VOLATILE_HEADERS = frozenset(['X-Trans-Id', 'X-Trans-Id-Extra', 'X-Timestamp',
+                              'Date', 'Connection', 'Mc-Enabled'])
+# Request headers that change the response of a request-independent GET
+RESPONSE_HEADERS = ('Range', 'If-Match', 'If-None-Match', 'If-Modified-Since',
+                    'If-Unmodified-Since')
+
+_END_OF_STREAM = object()
+
+
+class CoalescedStream(object):
+    """
+    Iterator of one of the waiters of a coalesced fetch. The chunks are
+    shared with the other waiters, through a bounded queue.
+    """
+
+    def __init__(self, buffer_size):
+        self.queue = LightQueue(buffer_size)
+        self.closed = False
+
+    def __iter__(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is _END_OF_STREAM:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+
+    def close(self):
+        self.closed = True
+        # Unblock the producer if it is waiting on this queue
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+
+class CoalescedFetch(object):
+    """
+    In-flight GET pipeline (backend fetch, microcontrollers and storlets)
+    shared by all the identical requests that arrive before it responds.
+    """
+
+    def __init__(self, buffer_size):
+        self.buffer_size = buffer_size
+        self.started = False
+        self.streams = list()
+        self.response_ready = Event()
+
+    def join(self, request):
+        """
+        Waits for the response of the in-flight pipeline
+
+        :param request: swob.Request instance of the waiter
+        :returns: swob.Response instance, or None if the pipeline failed
+        """
+        stream = CoalescedStream(self.buffer_size)
+        self.streams.append(stream)
+        result = self.response_ready.wait()
+        if result is None:
+            return None
+        response, shared = result
+        if not shared:
+            # The leader response has no body iterator to share
+            return Response(status=response.status,
+                            headers=dict(response.headers),
+                            body=response.body, request=request)
+        return Response(status=response.status,
+                        headers=dict(response.headers),
+                        app_iter=stream, request=request)
+
+    def fail(self):
+        self.started = True
+        self.response_ready.send(None)
+
+    def start(self, response):
+        """
+        Fans the leader response out to every waiter
+
+        :param response: swob.Response instance of the leader
+        :returns: swob.Response instance for the leader
+        """
+        self.started = True
+        if not self.streams:
+            self.response_ready.send(None)
+            return response
+
+        if response.app_iter is None:
+            self.response_ready.send((response, False))
+            return response
+
+        leader_stream = CoalescedStream(self.buffer_size)
+        self.streams.append(leader_stream)
+        app_iter = response.app_iter
+        response.app_iter = leader_stream
+        self.response_ready.send((response, True))
+        eventlet.spawn_n(self._produce, app_iter)
+
+        return response
+
+    def _put(self, item):
+        for stream in self.streams:
+            if not stream.closed:
+                stream.queue.put(item)
+
+    def _produce(self, app_iter):
+        try:
+            for chunk in app_iter:
+                if all(stream.closed for stream in self.streams):
+                    break
+                self._put(chunk)
+            self._put(_END_OF_STREAM)
+        except Exception as e:
+            self._put(e)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+class RequestCoalescer(object):
+    """
+    Collapses concurrent identical GETs of the same object into a single
+    backend fetch and Vertigo pipeline. Requests are identical if they have
+    the same attributes (headers), or if the onget verdict of the object is
+    known to be request-independent.
+    """
+
+    def __init__(self, conf, logger):
+        self.logger = logger
+        self.buffer_size = int(conf.get('coalescing_buffer_size', 16))
+        self.max_tracked = int(conf.get('coalescing_max_tracked', 10000))
+        self.independent_mcs = frozenset(list_from_csv(
+            conf.get('coalescing_request_independent_mcs', '')))
+        self.in_flight = dict()  # key: CoalescedFetch
+        self.independent = OrderedDict()  # account/container/object: True
+        self.coalesced = 0
+
+    def _get_key(self, obj, request):
+        if obj in self.independent:
+            # The verdict does not depend on the request, but the response
+            # still depends on the query string, the range and conditions
+            return '\n'.join([obj, request.query_string or ''] +
+                             [request.headers.get(header, '')
+                              for header in RESPONSE_HEADERS])
+        attrs = sorted((k, v) for k, v in request.headers.items()
+                       if k not in VOLATILE_HEADERS)
+        return '\n'.join([obj, request.query_string or '',
+                          hashlib.md5(repr(attrs)).hexdigest()])
+
+    def _learn(self, vertigo, obj, response):
+        """
+        Records whether the onget verdict of the object is
+        request-independent: no onget microcontrollers, or all of them in
+        the coalescing_request_independent_mcs list.
+        """
+        mc_list = vertigo.get_microcontroller_list(response.headers, 'get')
+        if not mc_list or self.independent_mcs.issuperset(mc_list):
+            self.independent[obj] = True
+            if len(self.independent) > self.max_tracked:
+                self.independent.popitem(last=False)
+        else:
+            self.independent.pop(obj, None)
+
+    def get_response(self, vertigo, obj, process):
+        """
+        Runs the GET pipeline, or joins an identical one in flight
+
+        :param vertigo: swift_vertigo.vertigo_handler.VertigoProxyHandler
+                        instance
+        :param obj: account/container/object
+        :param process: function that runs the GET pipeline
+        :returns: swob.Response instance
+        """
+        key = self._get_key(obj, vertigo.request)
+        fetch = self.in_flight.get(key)
+        if fetch is not None and not fetch.started:
+            if obj in self.independent:
+                # The waiter can be a different user
+                aresp = vertigo.authorize_object_access(obj)
+                if aresp:
+                    return aresp
+            response = fetch.join(vertigo.request)
+            if response is not None:
+                self.coalesced += 1
+                vertigo.logger.increment('vertigo.coalescing.coalesced')
+                return response
+
+        fetch = CoalescedFetch(self.buffer_size)
+        self.in_flight[key] = fetch
+        try:
+            response = process()
+        except Exception:
+            fetch.fail()
+            raise
+        finally:
+            if self.in_flight.get(key) is fetch:
+                del self.in_flight[key]
+
+        if response.status_int // 100 != 2:
+            fetch.fail()
+            return response
+
+        self._learn(vertigo, obj, response)
+        return fetch.start(response)
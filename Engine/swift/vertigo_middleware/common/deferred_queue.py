@@ -0,0 +1,220 @@
+from swift.common.swob import Request, Response
+from swift.common.utils import renamer
+from vertigo_middleware.common.triggers import TriggerTable
+from vertigo_middleware.gateways import VertigoGatewayDocker
+from eventlet import GreenPool
+import eventlet
+import errno
+import json
+import time
+import uuid
+import os
+
+
+# Request headers not persisted with the deferred invocations
+SECRET_HEADERS = frozenset(['X-Auth-Token', 'X-Storage-Token'])
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class DeferredQueue(object):
+    """
+    Bounded, durable, node-local queue of microcontroller invocations. Each
+    job is a JSON file, written and fsynced in tmp/ and renamed into queue/.
+    Workers claim a job by renaming it into processing/ with their pid, and
+    remove it once it has run, or queue it again to be retried later. The
+    jobs claimed by dead workers are queued again. Job names start with the
+    time from which they can be claimed.
+    """
+
+    def __init__(self, path, max_size, logger):
+        self.logger = logger
+        self.max_size = max_size
+        self.tmp_dir = os.path.join(path, 'tmp')
+        self.queue_dir = os.path.join(path, 'queue')
+        self.processing_dir = os.path.join(path, 'processing')
+        for directory in (self.tmp_dir, self.queue_dir,
+                          self.processing_dir):
+            if not os.path.exists(directory):
+                os.makedirs(directory, 0o700)
+
+    def __len__(self):
+        return len(os.listdir(self.queue_dir))
+
+    def put(self, job):
+        """
+        :param job: JSON-serializable dictionary
+        :returns: False if the queue is full
+        """
+        if len(self) >= self.max_size:
+            return False
+        self._write(job, time.time())
+        return True
+
+    def _write(self, job, not_before):
+        name = '%016.5f-%s.json' % (not_before, uuid.uuid4().hex)
+        tmp_path = os.path.join(self.tmp_dir, name)
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+            f.flush()
+            os.fsync(f.fileno())
+        renamer(tmp_path, os.path.join(self.queue_dir, name))
+
+    def claim(self):
+        """
+        :returns: (claimed path, job) of the oldest job, or None
+        """
+        now = time.time()
+        for name in sorted(os.listdir(self.queue_dir)):
+            if float(name.split('-', 1)[0]) > now:
+                # Retries not due yet, as all the names after them
+                break
+            claimed = os.path.join(self.processing_dir,
+                                   '%s.%d' % (name, os.getpid()))
+            try:
+                os.rename(os.path.join(self.queue_dir, name), claimed)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    # Claimed by another worker
+                    continue
+                raise
+            try:
+                with open(claimed) as f:
+                    return claimed, json.load(f)
+            except ValueError:
+                self.logger.error('Vertigo - Dropping corrupt deferred job ' +
+                                  name)
+                os.unlink(claimed)
+        return None
+
+    def done(self, claimed):
+        os.unlink(claimed)
+
+    def retry(self, claimed, job, delay):
+        """
+        Queues a claimed job again, to be claimed after delay seconds
+        """
+        self._write(job, time.time() + delay)
+        os.unlink(claimed)
+
+    def recover(self):
+        """
+        Queues again the jobs claimed by dead workers
+        """
+        for claimed in os.listdir(self.processing_dir):
+            name, pid = claimed.rsplit('.', 1)
+            if pid.isdigit() and not _pid_alive(int(pid)):
+                try:
+                    os.rename(os.path.join(self.processing_dir, claimed),
+                              os.path.join(self.queue_dir, name))
+                except OSError:
+                    pass
+
+
+class DeferredInvoker(object):
+    """
+    Drains a DeferredQueue in the background of a proxy worker, running
+    each job in the sandbox of its tenant. The drainer starts with the first
+    request that uses it, so it never runs in the parent process.
+    """
+
+    metric_prefix = 'vertigo.deferred.'
+
+    def __init__(self, conf, logger, queue, concurrency=1):
+        self.conf = conf
+        self.logger = logger
+        self.queue = queue
+        self.poll_interval = float(conf.get('ondelete_poll_interval', 1))
+        self.max_retries = int(conf.get('deferred_max_retries', 3))
+        self.retry_interval = float(conf.get('deferred_retry_interval', 60))
+        self.pool = GreenPool(concurrency)
+        self.invoked = 0
+        self.failed = 0
+        self.started = False
+
+    def start(self):
+        if not self.started:
+            self.started = True
+            self.queue.recover()
+            eventlet.spawn_n(self._run)
+
+    def enqueue(self, request, object_headers, mc_list, trigger_table):
+        """
+        :param request: swob.Request instance of the committed operation
+        :param object_headers: headers of the object before the operation
+        :param mc_list: microcontroller list
+        :param trigger_table: effective TriggerTable instance of the object
+        :returns: False if the queue is full
+        """
+        request_headers = dict((k, v) for k, v in request.headers.items()
+                               if k not in SECRET_HEADERS)
+        request_headers['X-Current-Server'] = self.conf['execution_server']
+        request_headers['X-Method'] = request.method.lower()
+        # Needed for the mc_engine
+        request_headers['Referer'] = '%s %s%s' % (
+            request.method, request.host_url, request.path_info)
+        job = {'method': request.method,
+               'path': request.path_info,
+               'request_headers': request_headers,
+               'object_headers': dict(object_headers),
+               'mc_list': mc_list,
+               'trigger_table': trigger_table.encode()}
+        return self.queue.put(job)
+
+    def invoke(self, job):
+        request = Request.blank(job['path'],
+                                environ={'REQUEST_METHOD': job['method']},
+                                headers=job['request_headers'])
+        response = Response(headers=job['object_headers'], request=request)
+        account = request.split_path(3, 4, rest_with_last=True)[1]
+        gateway = VertigoGatewayDocker(request, response, self.conf,
+                                       self.logger, account)
+        return gateway.execute_microcontrollers(
+            job['mc_list'], TriggerTable.decode(job['trigger_table']))
+
+    def _run(self):
+        while True:
+            try:
+                claimed = self.queue.claim()
+            except Exception:
+                self.logger.exception('Vertigo - Error reading the deferred '
+                                      'queue')
+                claimed = None
+            if claimed is None:
+                eventlet.sleep(self.poll_interval)
+                continue
+            # Blocks while all the workers are busy
+            self.pool.spawn_n(self._process, *claimed)
+
+    def _process(self, claimed_path, job):
+        """
+        Runs a claimed job. A failed job is retried up to
+        deferred_max_retries times, with an exponential backoff.
+        """
+        try:
+            self.invoke(job)
+            self.invoked += 1
+            self.logger.increment(self.metric_prefix + 'invoked')
+        except Exception:
+            self.failed += 1
+            self.logger.increment(self.metric_prefix + 'failed')
+            self.logger.exception('Vertigo - Error running deferred job on ' +
+                                  job['path'])
+            retries = job.get('retries', 0)
+            if retries < self.max_retries:
+                job['retries'] = retries + 1
+                try:
+                    self.queue.retry(claimed_path, job,
+                                     self.retry_interval * 2 ** retries)
+                    self.logger.increment(self.metric_prefix + 'retried')
+                    return
+                except Exception:
+                    self.logger.exception('Vertigo - Error queuing the '
+                                          'retry of ' + job['path'])
+        self.queue.done(claimed_path)
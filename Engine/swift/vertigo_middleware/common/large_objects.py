@@ -0,0 +1,128 @@
+from eventlet.queue import Queue
+from collections import deque
+import eventlet
+import json
+
+
+# Segment-local storlets forwarded by the proxy to the object server of a
+# segment. Clients can not set it: the gatekeeper strips X-Backend-* headers.
+BACKEND_STORLET_LIST_HEADER = 'X-Backend-Vertigo-Storlet-List'
+
+MAX_MANIFEST_DEPTH = 10
+
+_END = object()
+
+
+def is_slo_manifest(headers):
+    return headers.get('X-Static-Large-Object', '').lower() in \
+        ('true', '1', 'yes', 'on')
+
+
+def iter_segments(manifest, get_sub_manifest, depth=1):
+    """
+    Iterates the segments of a SLO manifest, nested manifests included
+
+    :param manifest: manifest body, as stored by the SLO middleware
+    :param get_sub_manifest: callable that returns the body of a nested
+                             manifest, from its segment entry
+    :returns: iterator of segment entries
+    """
+    if depth > MAX_MANIFEST_DEPTH:
+        raise ValueError('Vertigo - Too many nested SLO manifests')
+    for segment in json.loads(manifest):
+        if segment.get('sub_slo'):
+            for sub_segment in iter_segments(get_sub_manifest(segment),
+                                             get_sub_manifest, depth + 1):
+                yield sub_segment
+        else:
+            yield segment
+
+
+def check_segment(segment, response):
+    """
+    Checks a segment response against its manifest entry, as the SLO
+    middleware does: a segment replaced since the manifest was written
+    must not be spliced into the body
+
+    :param segment: segment entry of the manifest
+    :param response: swob.Response instance of the segment GET
+    :raises ValueError: if the ETag or the size do not match
+    """
+    etag = (response.headers.get('Etag') or '').strip('"')
+    if segment.get('hash') and etag != segment['hash']:
+        raise ValueError('Vertigo - Segment %s no longer valid: ETag %s '
+                         'does not match %s' % (segment['name'], etag,
+                                                segment['hash']))
+    if response.status_int == 200 and segment.get('bytes') is not None and \
+            response.content_length != segment['bytes']:
+        raise ValueError('Vertigo - Segment %s no longer valid: size %s '
+                         'does not match %s' % (segment['name'],
+                                                response.content_length,
+                                                segment['bytes']))
+
+
+class SegmentAssembler(object):
+    """
+    Body of a large object whose segments are read in parallel, up to
+    concurrency at a time, and reassembled in order. Each segment is read
+    into a queue of at most buffer_chunks chunks, so a segment read ahead
+    waits once its queue is full.
+    """
+
+    def __init__(self, segments, get_segment, concurrency=4,
+                 buffer_chunks=16):
+        """
+        :param segments: iterator of segment entries
+        :param get_segment: callable that returns the body iterator of a
+                            segment, from its entry
+        """
+        self.segments = iter(segments)
+        self.get_segment = get_segment
+        self.concurrency = concurrency
+        self.buffer_chunks = buffer_chunks
+        self.pending = deque()  # (queue, reader greenthread), in order
+
+    def _read(self, segment, queue):
+        body = None
+        try:
+            body = self.get_segment(segment)
+            for chunk in body:
+                queue.put(chunk)
+            queue.put(_END)
+        except Exception as e:
+            queue.put(e)
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    def _start_next(self):
+        for segment in self.segments:
+            queue = Queue(self.buffer_chunks)
+            self.pending.append((queue,
+                                 eventlet.spawn(self._read, segment, queue)))
+            return
+
+    def __iter__(self):
+        try:
+            while len(self.pending) < self.concurrency:
+                before = len(self.pending)
+                self._start_next()
+                if len(self.pending) == before:
+                    break
+            while self.pending:
+                queue, _ = self.pending[0]
+                item = queue.get()
+                while item is not _END:
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+                    item = queue.get()
+                self.pending.popleft()
+                self._start_next()
+        finally:
+            self.close()
+
+    def close(self):
+        while self.pending:
+            _, reader = self.pending.popleft()
+            reader.kill()
@@ -0,0 +1,333 @@
+from vertigo_middleware.common.utils import get_object_metadata, \
+    set_object_metadata
+from collections import OrderedDict
+import hashlib
+import mmap
+import time
+import os
+
+
+HOT_OBJECT_KEY_PREFIX = 'vertigo_hot_'
+PREFETCHED_HEADER = 'X-Vertigo-Prefetched'
+CHUNK_SIZE = 65536
+
+
+class HotObjectCache(object):
+    """
+    Size-bounded cache of hot objects for the proxy workers. Small objects
+    are kept in memory, and larger objects in memory-mapped local files.
+    Objects are admitted by size, and only after they are requested
+    min_hits times. The local files (and their headers, stored as xattr
+    metadata) are shared by all the workers of the node, so prefetched
+    objects are visible to every worker. Their total size is bounded for the
+    node with an LRU order, by file mtime, that each worker refreshes by
+    rescanning the directory.
+    """
+
+    def __init__(self, conf, logger):
+        self.logger = logger
+        self.mem_max_object_size = int(conf.get('hot_object_mem_max_size',
+                                                65536))
+        self.max_object_size = int(conf.get('hot_object_max_size', 8388608))
+        self.mem_capacity = int(conf.get('hot_object_mem_capacity', 67108864))
+        self.mmap_capacity = int(conf.get('hot_object_mmap_capacity',
+                                          1073741824))
+        self.min_hits = int(conf.get('hot_object_min_hits', 2))
+        self.max_tracked = int(conf.get('hot_object_max_tracked', 100000))
+        self.cache_dir = conf.get('hot_object_cache_dir',
+                                  '/var/cache/vertigo/objects')
+        self.rescan_interval = float(conf.get('hot_object_rescan_interval',
+                                              60))
+
+        # LRU order: the first item is the least recently used one
+        self.mem_tier = OrderedDict()  # obj: (headers, body)
+        self.mmap_tier = OrderedDict()  # obj: (headers, mmap, path)
+        self.mapped_files = dict()  # file name: obj
+        self.mem_size = 0
+        self.mmap_size = 0  # mapped by this worker
+        self.files = OrderedDict()  # file name: size, node-wide LRU order
+        self.files_size = 0
+        self.last_scan = 0
+        self.frequency = OrderedDict()  # obj: number of requests
+        self.prefetched = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.prefetch_hits = 0
+
+    def _get_file_path(self, obj):
+        return os.path.join(self.cache_dir, hashlib.md5(obj).hexdigest())
+
+    def is_admissible(self, size):
+        """
+        Checks whether an object of the given size fits in the cache
+        """
+        return size <= self.max_object_size
+
+    def record_access(self, obj):
+        """
+        Counts a request to an object that is not in the cache
+
+        :param obj: account/container/object
+        :returns: whether the object is hot enough to be admitted
+        """
+        hits = self.frequency.pop(obj, 0) + 1
+        self.frequency[obj] = hits
+        if len(self.frequency) > self.max_tracked:
+            self.frequency.popitem(last=False)
+
+        return hits >= self.min_hits
+
+    def get(self, obj):
+        """
+        Gets an object from the cache
+
+        :param obj: account/container/object
+        :returns: (headers, body) tuple or None. The body is a string for
+                  the memory tier, and a read-only mmap for the local tier
+        """
+        if obj in self.mem_tier:
+            entry = self.mem_tier.pop(obj)
+            self.mem_tier[obj] = entry
+        elif obj in self.mmap_tier:
+            entry = self.mmap_tier.pop(obj)
+            self.mmap_tier[obj] = entry
+            self._touch_file(entry[2])
+        else:
+            entry = self._load_local_file(obj)
+
+        if entry is None:
+            self.misses += 1
+            self.logger.increment('vertigo.hot_object.misses')
+            return None
+
+        self.hits += 1
+        self.logger.increment('vertigo.hot_object.hits')
+        if obj in self.prefetched:
+            self.prefetch_hits += 1
+            self.logger.increment('vertigo.prefetch.hits')
+        return entry[:2]
+
+    def is_cached(self, obj):
+        """
+        Checks whether an object is in the cache, without counting a request
+        """
+        return obj in self.mem_tier or obj in self.mmap_tier or \
+            os.path.exists(self._get_file_path(obj))
+
+    def _rescan(self):
+        """
+        Rebuilds the LRU order with the local files of all the workers, and
+        drops the maps of the files evicted by the other workers
+        """
+        files = list()
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, name, st.st_size))
+        files.sort()
+        self.files = OrderedDict((name, size) for _, name, size in files)
+        self.files_size = sum(self.files.values())
+        self.last_scan = time.time()
+        for name in set(self.mapped_files) - set(self.files):
+            self._evict_mmap(self.mapped_files[name], unlink=False)
+
+    def _touch_file(self, path):
+        """
+        Marks a local file as the most recently used, also for the other
+        workers
+        """
+        name = os.path.basename(path)
+        if name in self.files:
+            self.files[name] = self.files.pop(name)
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+    def _evict_file(self, name):
+        self.files_size -= self.files.pop(name)
+        if name in self.mapped_files:
+            self._evict_mmap(self.mapped_files[name])
+        else:
+            try:
+                os.unlink(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+
+    def _map_local_file(self, obj, headers, path):
+        with open(path, 'rb') as fn:
+            mm = mmap.mmap(fn.fileno(), 0, access=mmap.ACCESS_READ)
+        name = os.path.basename(path)
+        if name not in self.files:
+            # Stored by another worker since the last rescan
+            self.files[name] = len(mm)
+            self.files_size += len(mm)
+        self.mmap_tier[obj] = (headers, mm, path)
+        self.mapped_files[name] = obj
+        self.mmap_size += len(mm)
+        return self.mmap_tier[obj]
+
+    def _load_local_file(self, obj):
+        """
+        Adopts an object stored in the local tier by another worker
+        """
+        path = self._get_file_path(obj)
+        if not os.path.exists(path):
+            return None
+        try:
+            headers = get_object_metadata(path)
+            if not headers:
+                return None
+            if headers.pop(PREFETCHED_HEADER, None):
+                self.prefetched.add(obj)
+            return self._map_local_file(obj, headers, path)
+        except (IOError, OSError, ValueError):
+            # Evicted by another worker in the meantime
+            return None
+
+    def put(self, obj, headers, body, shared=False):
+        """
+        Stores an object into the cache, evicting the least recently used
+        objects if needed
+
+        :param obj: account/container/object
+        :param headers: object headers
+        :param body: object content
+        :param shared: store the object in the local tier, visible to all the
+                       workers, regardless of its size
+        """
+        size = len(body)
+        if not self.is_admissible(size):
+            return
+        self.invalidate(obj)
+        self.frequency.pop(obj, None)
+
+        if size <= self.mem_max_object_size and not shared:
+            while self.mem_tier and self.mem_size + size > self.mem_capacity:
+                self._evict_mem(next(iter(self.mem_tier)))
+            self.mem_tier[obj] = (headers, body)
+            self.mem_size += size
+            return
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, 0o700)
+
+        if time.time() - self.last_scan > self.rescan_interval:
+            self._rescan()
+        while self.files and self.files_size + size > self.mmap_capacity:
+            self._evict_file(next(iter(self.files)))
+
+        path = self._get_file_path(obj)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as fn:
+                fn.write(body)
+            if shared:
+                set_object_metadata(tmp_path,
+                                    dict(headers, **{PREFETCHED_HEADER: True}))
+            else:
+                set_object_metadata(tmp_path, headers)
+            # Atomic for the other workers of the node
+            os.rename(tmp_path, path)
+            self._map_local_file(obj, headers, path)
+        except Exception:
+            self.logger.exception('Vertigo - Error caching ' + obj)
+            for stale_path in (tmp_path, path):
+                if os.path.exists(stale_path):
+                    os.unlink(stale_path)
+            return
+        if shared:
+            self.prefetched.add(obj)
+
+    def _evict_mem(self, obj):
+        _, body = self.mem_tier.pop(obj)
+        self.mem_size -= len(body)
+
+    def _evict_mmap(self, obj, unlink=True):
+        _, mm, path = self.mmap_tier.pop(obj)
+        self.mapped_files.pop(os.path.basename(path), None)
+        self.mmap_size -= len(mm)
+        # Not closed here: responses may still be sending it. The map is
+        # released with its last reference, after the last reader.
+        if unlink:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    def invalidate(self, obj):
+        """
+        Removes an object from the cache
+
+        :param obj: account/container/object
+        """
+        self.prefetched.discard(obj)
+        if obj in self.mem_tier:
+            self._evict_mem(obj)
+        name = os.path.basename(self._get_file_path(obj))
+        self.files_size -= self.files.pop(name, 0)
+        if obj in self.mmap_tier:
+            self._evict_mmap(obj)
+        else:
+            try:
+                os.unlink(self._get_file_path(obj))
+            except OSError:
+                pass
+
+    def stats(self):
+        """
+        :returns: dictionary with the cache counters
+        """
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'prefetch_hits': self.prefetch_hits,
+                'mem_size': self.mem_size,
+                'mmap_size': self.mmap_size,
+                'files_size': self.files_size}
+
+
+def iter_body(body):
+    """
+    Iterates a cached body (string or mmap) in chunks. The iterator keeps
+    an evicted mmap alive until the body is sent.
+    """
+    for offset in range(0, len(body), CHUNK_SIZE):
+        yield body[offset:offset + CHUNK_SIZE]
+
+
+class CacheAdmissionIter(object):
+    """
+    Wraps the app_iter of a backend response. The object is stored into the
+    cache once the whole body has been sent to the client.
+    """
+
+    def __init__(self, app_iter, size, on_complete):
+        """
+        :param app_iter: backend response app_iter
+        :param size: object size (Content-Length)
+        :param on_complete: function called with the object body
+        """
+        self.app_iter = app_iter
+        self.size = size
+        self.on_complete = on_complete
+        self.chunks = list()
+        self.received = 0
+
+    def __iter__(self):
+        for chunk in self.app_iter:
+            self.received += len(chunk)
+            if self.received <= self.size:
+                self.chunks.append(chunk)
+            yield chunk
+        if self.received == self.size:
+            self.on_complete(''.join(self.chunks))
+        self.chunks = None
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
@@ -0,0 +1,176 @@
+import multiprocessing
+import os
+import time
+
+
+MB = 1048576.0
+
+# Storlets without an explicit server in the microcontroller verdict
+AUTO_SERVER = 'auto'
+
+# Request header with the load of the proxy, for the object server planner
+BACKEND_PROXY_LOAD_HEADER = 'X-Backend-Vertigo-Proxy-Load'
+
+# Response header with the explained plan (storlet_placement_debug)
+PLAN_HEADER = 'X-Vertigo-Storlet-Plan'
+
+
+def get_node_load():
+    """
+    :returns: 1-minute load average per CPU of this node
+    """
+    try:
+        return os.getloadavg()[0] / multiprocessing.cpu_count()
+    except (OSError, NotImplementedError):
+        return 0.0
+
+
+class ObservedIter(object):
+    """
+    Counts the output of a storlet, and the time spent producing it (not
+    the time the client takes to read it), and reports them once fully read
+    """
+
+    def __init__(self, data_iter, callback):
+        self.data_iter = data_iter
+        self.callback = callback
+
+    def __iter__(self):
+        size = 0
+        elapsed = 0
+        data_iter = iter(self.data_iter)
+        while True:
+            started = time.time()
+            try:
+                chunk = next(data_iter)
+            except StopIteration:
+                elapsed += time.time() - started
+                break
+            elapsed += time.time() - started
+            size += len(chunk)
+            yield chunk
+        self.callback(size, elapsed)
+
+    def close(self):
+        if hasattr(self.data_iter, 'close'):
+            self.data_iter.close()
+
+
+class StorletPlacementPlanner(object):
+    """
+    Places the stages of an onget storlet pipeline between the object server
+    and the proxy. The first stages run on the object server and the rest on
+    the proxy, split where the estimated cost is the lowest: the CPU time of
+    each stage, weighted by the load of the node that runs it, plus the
+    transfer of the data between both.
+
+    Each storlet has a selectivity (output/input size ratio) and a CPU cost
+    (seconds per MB of input), declared with X-Object-Meta-Storlet-Selectivity
+    and X-Object-Meta-Storlet-Cpu-Cost, and learned from its runs in this
+    worker.
+    """
+
+    def __init__(self, conf, logger):
+        self.logger = logger
+        self.default_selectivity = float(
+            conf.get('storlet_default_selectivity', 1.0))
+        self.default_cpu_cost = float(conf.get('storlet_default_cpu_cost',
+                                               0.01))
+        self.default_size = int(conf.get('storlet_default_object_size',
+                                         1048576))
+        self.network_cost = float(conf.get('storlet_network_cost', 0.01))
+        self.alpha = float(conf.get('storlet_stats_alpha', 0.2))
+        self.stats = dict()  # storlet: [selectivity, cpu_cost]
+        self.load = None
+        self.load_updated = 0
+
+    def get_load(self):
+        now = time.time()
+        if now - self.load_updated >= 1:
+            self.load = get_node_load()
+            self.load_updated = now
+        return self.load
+
+    def _get_declared(self, metadata, key, default):
+        try:
+            return float(metadata.get(key, default))
+        except ValueError:
+            return default
+
+    def get_stats(self, storlet, metadata):
+        """
+        :returns: (selectivity, cpu cost) of a storlet
+        """
+        stats = self.stats.get(storlet)
+        if stats:
+            return tuple(stats)
+        return (self._get_declared(metadata, 'Selectivity',
+                                   self.default_selectivity),
+                self._get_declared(metadata, 'Cpu-Cost',
+                                   self.default_cpu_cost))
+
+    def observe(self, storlet, metadata, input_size, output_size, seconds):
+        """
+        Updates the statistics of a storlet with a run over a whole object
+        """
+        if input_size <= 0:
+            return
+        selectivity = output_size / float(input_size)
+        cpu_cost = seconds / (input_size / MB)
+        stats = self.stats.get(storlet)
+        if stats is None:
+            stats = list(self.get_stats(storlet, metadata))
+            self.stats[storlet] = stats
+        stats[0] += self.alpha * (selectivity - stats[0])
+        stats[1] += self.alpha * (cpu_cost - stats[1])
+
+    def plan(self, stages, size, proxy_load):
+        """
+        :param stages: ordered list of (storlet, metadata, server), where
+                       server is 'object', 'proxy' or 'auto'
+        :param size: object size, or None if unknown
+        :param proxy_load: load per CPU of the proxy, or None if unknown
+        :returns: (index of the first stage on the proxy, explanation), or
+                  (None, explanation) if the pinned servers allow no split
+        """
+        object_load = self.get_load()
+        if proxy_load is None:
+            proxy_load = object_load
+        if size is None:
+            size = self.default_size
+        stats = [self.get_stats(storlet, metadata)
+                 for storlet, metadata, _ in stages]
+
+        first = 0  # after the last stage pinned to the object server
+        last = len(stages)  # before the first stage pinned to the proxy
+        for i, (_, _, server) in enumerate(stages):
+            if server == 'object':
+                first = i + 1
+            elif server == 'proxy' and last == len(stages):
+                last = i
+        if first > last:
+            return None, 'infeasible'
+
+        best = None
+        for split in range(first, last + 1):
+            cost = 0.0
+            data = size / MB
+            for i, (selectivity, cpu_cost) in enumerate(stats):
+                if i == split:
+                    cost += data * self.network_cost
+                load = object_load if i < split else proxy_load
+                cost += data * cpu_cost * (1 + load)
+                data *= selectivity
+            if split == len(stats):
+                cost += data * self.network_cost
+            if best is None or cost < best[1]:
+                best = (split, cost)
+
+        split, cost = best
+        explanation = 'split=%d cost=%.4f object_load=%.2f proxy_load=%.2f' \
+            % (split, cost, object_load, proxy_load)
+        for i, (storlet, _, _) in enumerate(stages):
+            explanation += ' %s@%s(sel=%.3f,cpu=%.4f)' % (
+                storlet, 'object' if i < split else 'proxy',
+                stats[i][0], stats[i][1])
+        return split, explanation
@@ -0,0 +1,195 @@
+from vertigo_middleware.common.triggers import load_trigger_table, \
+    get_policy_reference, get_effective_table, POLICY_VERSION_KEY
+from vertigo_middleware.common.utils import SYSMETA_OBJ_HEADER, LOCAL_PROXY
+from swift.common.internal_client import InternalClient
+from swift.common.utils import Timestamp
+from collections import OrderedDict
+from urllib import quote
+import os
+import time
+import uuid
+
+
+POLICY_CACHE_PREFIX = 'vertigo_'
+POLICY_GENERATION_PREFIX = 'vertigo_generation_'
+
+
+def is_newer_version(version, other):
+    """
+    :returns: whether a policy version is newer than the other one (None
+              is older than any version)
+    """
+    if other is None:
+        return version is not None
+    return version is not None and Timestamp(version) > Timestamp(other)
+
+
+def get_policy_metadata(headers):
+    """
+    Gets the policy metadata of a container or pseudo-folder, in the object
+    format
+    """
+    metadata = dict()
+    for key in headers:
+        object_key = key.replace('Container', 'Object')
+        if object_key.startswith(SYSMETA_OBJ_HEADER):
+            metadata[object_key] = headers[key]
+    return metadata
+
+
+def get_parent_policy_id(api_version, account, container, obj):
+    """
+    Gets the id of the policy inherited by an object: the path of its parent
+    pseudo-folder or container
+
+    :returns: policy id
+    """
+    obj_split = obj.rstrip('/').rsplit('/', 1)
+    if len(obj_split) > 1:
+        # object parent is pseudo-folder
+        return os.path.join('/', api_version, account, container,
+                            obj_split[0] + '/')
+    # object parent is container
+    return os.path.join('/', api_version, account, container)
+
+
+def get_object_trigger_table(metadata, policy_store):
+    """
+    Resolves the triggers of an object outside a request (daemons): its own
+    ones over the policy it references
+
+    :param metadata: swift metadata of the object
+    :param policy_store: BackendPolicyStore instance, or None to only get
+                         the triggers of the object
+    :returns: TriggerTable instance, or None if there are no triggers
+    """
+    reference = get_policy_reference(metadata, SYSMETA_OBJ_HEADER)
+    if not reference or policy_store is None:
+        return load_trigger_table(metadata, SYSMETA_OBJ_HEADER)
+    _, policy = policy_store.get(None, reference[0], reference[1])
+    return get_effective_table(metadata, SYSMETA_OBJ_HEADER, reference[0],
+                               policy)
+
+
+class PolicyStore(object):
+    """
+    Per-worker store of the trigger policies of containers and pseudo-folders,
+    inherited by reference by their objects. Policies are read from memcache
+    (or with a HEAD to the parent), and kept locally for policy_cache_ttl
+    seconds. A local policy is dropped as soon as its generation in memcache
+    changes, so an invalidation reaches every worker. A pseudo-folder policy
+    is resolved over the policy it inherits.
+    """
+
+    def __init__(self, conf, logger):
+        self.logger = logger
+        self.ttl = float(conf.get('policy_cache_ttl', 10))
+        self.max_size = int(conf.get('policy_cache_size', 1024))
+        # policy_id: (expires, generation, version, table)
+        self.policies = OrderedDict()
+
+    def _get_memcache(self, vertigo):
+        return vertigo.memcache
+
+    def _head(self, vertigo, policy_id):
+        """
+        :returns: headers of the container or pseudo-folder, or None
+        """
+        sub_req = vertigo.subrequest_factory.make_subrequest(
+            'HEAD', policy_id)
+        response = sub_req.get_response(vertigo.app)
+        return response.headers if response.is_success else None
+
+    def _load_metadata(self, vertigo, policy_id, min_version=None):
+        memcache = self._get_memcache(vertigo)
+        metadata = None
+        if memcache is not None:
+            metadata = memcache.get(POLICY_CACHE_PREFIX + policy_id)
+        if metadata is not None and is_newer_version(
+                min_version, metadata.get(SYSMETA_OBJ_HEADER +
+                                          POLICY_VERSION_KEY) or '0'):
+            metadata = None
+        if metadata is None:
+            headers = self._head(vertigo, policy_id)
+            metadata = get_policy_metadata(headers) if headers else dict()
+            if memcache is not None:
+                memcache.set(POLICY_CACHE_PREFIX + policy_id, metadata)
+        return metadata
+
+    def get(self, vertigo, policy_id, min_version=None):
+        """
+        Resolves a policy
+
+        :param vertigo: swift_vertigo.vertigo_handler.VertigoProxyHandler
+                        instance
+        :param policy_id: path of the container or pseudo-folder
+        :param min_version: version referenced by the object, if any. An
+                            older cached policy is reloaded.
+        :returns: (version, table) tuple. The table is a shared
+                  TriggerTable instance, or None
+        """
+        memcache = self._get_memcache(vertigo)
+        generation = memcache.get(POLICY_GENERATION_PREFIX + policy_id) \
+            if memcache is not None else None
+        entry = self.policies.pop(policy_id, None)
+        if entry and entry[0] > time.time() and entry[1] == generation and \
+                not is_newer_version(min_version, entry[2]):
+            self.policies[policy_id] = entry
+            return entry[2:]
+
+        metadata = self._load_metadata(vertigo, policy_id, min_version)
+        version = metadata.get(SYSMETA_OBJ_HEADER + POLICY_VERSION_KEY) or '0'
+        table = load_trigger_table(metadata, SYSMETA_OBJ_HEADER)
+
+        reference = get_policy_reference(metadata, SYSMETA_OBJ_HEADER)
+        if reference and reference[0] != policy_id and \
+                policy_id.startswith(reference[0]):
+            # Pseudo-folder that inherits from its own parent
+            _, parent = self.get(vertigo, reference[0])
+            if parent:
+                table = parent.overlay(table) or None
+
+        self.policies[policy_id] = (time.time() + self.ttl, generation,
+                                    version, table)
+        if len(self.policies) > self.max_size:
+            self.policies.popitem(last=False)
+        return version, table
+
+    def invalidate(self, vertigo, policy_id):
+        """
+        Drops a policy after its triggers change, in all the workers
+        """
+        self.policies.pop(policy_id, None)
+        memcache = self._get_memcache(vertigo)
+        if memcache is not None:
+            memcache.delete(POLICY_CACHE_PREFIX + policy_id)
+            memcache.set(POLICY_GENERATION_PREFIX + policy_id,
+                         uuid.uuid4().hex)
+
+
+class BackendPolicyStore(PolicyStore):
+    """
+    Policy store of the object servers and the daemons, which can not make
+    proxy subrequests: policies are read with an internal client, and only
+    kept locally. Used when the proxy did not forward the policy, or
+    forwarded a version older than the one referenced by the object.
+    """
+
+    def __init__(self, conf, logger):
+        super(BackendPolicyStore, self).__init__(conf, logger)
+        self.client = None
+
+    def _get_memcache(self, vertigo):
+        return None
+
+    def _head(self, vertigo, policy_id):
+        if self.client is None:
+            self.client = InternalClient(LOCAL_PROXY, 'SA', 1)
+        try:
+            response = self.client.make_request(
+                'HEAD', quote(policy_id), {}, (2, 404))
+        except Exception:
+            self.logger.exception('Vertigo - Error loading policy %s' %
+                                  policy_id)
+            return None
+        return response.headers if response.status_int // 100 == 2 else None
@@ -0,0 +1,93 @@
+from vertigo_middleware.common.object_cache import HOT_OBJECT_KEY_PREFIX
+from eventlet.semaphore import Semaphore
+import eventlet
+
+
+class PrefetchEngine(object):
+    """
+    Fetches the objects that the microcontrollers ask to prefetch, and
+    stores them into the node-local hot-object cache. The intents are
+    deduplicated, and fetched in parallel under a per-tenant concurrency
+    limit. The per-tenant state is only kept while the tenant has queued
+    intents.
+    """
+
+    def __init__(self, conf, logger, app, hot_object_cache):
+        self.logger = logger
+        self.app = app
+        self.hot_object_cache = hot_object_cache
+        self.concurrency = int(conf.get('prefetch_concurrency', 4))
+        self.max_pending = int(conf.get('prefetch_max_pending', 100))
+
+        self.pending = set()  # account/container/object of queued intents
+        self.tenant_pending = dict()  # account: number of queued intents
+        self.tenant_semaphores = dict()  # account: Semaphore
+
+        self.queued = 0
+        self.duplicated = 0
+        self.dropped = 0
+        self.fetched = 0
+
+    def prefetch(self, obj, sub_req, memcache):
+        """
+        Queues a prefetch intent
+
+        :param obj: account/container/object
+        :param sub_req: GET subrequest of the object
+        :param memcache: memcache client
+        :returns: whether the intent has been queued
+        """
+        if obj in self.pending or self.hot_object_cache.is_cached(obj):
+            self.duplicated += 1
+            self.logger.increment('vertigo.prefetch.duplicated')
+            return False
+
+        account = obj.split('/', 1)[0]
+        pending = self.tenant_pending.get(account, 0)
+        if pending >= self.max_pending:
+            self.dropped += 1
+            self.logger.increment('vertigo.prefetch.dropped')
+            return False
+
+        if not pending:
+            self.tenant_semaphores[account] = Semaphore(self.concurrency)
+        self.pending.add(obj)
+        self.tenant_pending[account] = pending + 1
+        self.queued += 1
+        eventlet.spawn_n(self._fetch, account, obj, sub_req, memcache)
+
+        return True
+
+    def _fetch(self, account, obj, sub_req, memcache):
+        try:
+            with self.tenant_semaphores[account]:
+                response = sub_req.get_response(self.app)
+                etag = response.headers.get('Etag')
+                if response.status_int == 200 and etag and \
+                        response.content_length is not None and \
+                        self.hot_object_cache.is_admissible(
+                            response.content_length):
+                    self.hot_object_cache.put(obj, dict(response.headers),
+                                              response.body, shared=True)
+                    memcache.set(HOT_OBJECT_KEY_PREFIX + obj, etag)
+                    self.fetched += 1
+                    self.logger.increment('vertigo.prefetch.fetched')
+                elif hasattr(response.app_iter, 'close'):
+                    response.app_iter.close()
+        except Exception:
+            self.logger.exception('Vertigo - Error prefetching ' + obj)
+        finally:
+            self.pending.discard(obj)
+            self.tenant_pending[account] -= 1
+            if not self.tenant_pending[account]:
+                del self.tenant_pending[account]
+                del self.tenant_semaphores[account]
+
+    def stats(self):
+        """
+        :returns: dictionary with the prefetch counters
+        """
+        return {'queued': self.queued,
+                'duplicated': self.duplicated,
+                'dropped': self.dropped,
+                'fetched': self.fetched}
@@ -0,0 +1,73 @@
+from swift.common.swob import multi_range_iterator
+from vertigo_middleware.common.object_cache import CHUNK_SIZE
+from tempfile import SpooledTemporaryFile
+
+
+class MultiRangeMixin(object):
+    """
+    Adds app_iter_ranges to a body with app_iter_range, so that swob also
+    applies multiple ranges to it, as to the disk file readers
+    """
+
+    def app_iter_ranges(self, ranges, content_type, boundary, size):
+        return multi_range_iterator(ranges, content_type, boundary, size,
+                                    self.app_iter_range)
+
+
+class RangeSafePipeline(MultiRangeMixin):
+    """
+    Output of a pipeline of range-safe storlets, which keep the offset of
+    every byte. A range of the output is the output of the pipeline over the
+    same range of the object, so only the requested bytes are read.
+    """
+
+    def __init__(self, run_pipeline, source):
+        """
+        :param run_pipeline: callable that returns the output of the
+                             pipeline over a data iterator
+        :param source: object body, with app_iter_range
+        """
+        self.run_pipeline = run_pipeline
+        self.source = source
+
+    def __iter__(self):
+        return iter(self.run_pipeline(self.source))
+
+    def app_iter_range(self, start, stop):
+        return self.run_pipeline(self.source.app_iter_range(start, stop))
+
+    def close(self):
+        if hasattr(self.source, 'close'):
+            self.source.close()
+
+
+class SpooledBody(MultiRangeMixin):
+    """
+    Transformed body of unknown length, spooled so its ranges can be served
+    """
+
+    def __init__(self, data_iter, max_memory):
+        self.spool = SpooledTemporaryFile(max_memory)
+        try:
+            for chunk in data_iter:
+                self.spool.write(chunk)
+        finally:
+            if hasattr(data_iter, 'close'):
+                data_iter.close()
+        self.length = self.spool.tell()
+
+    def __iter__(self):
+        return self.app_iter_range(0, self.length)
+
+    def app_iter_range(self, start, stop):
+        self.spool.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            chunk = self.spool.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        self.spool.close()
@@ -0,0 +1,319 @@
+from vertigo_middleware.common.timer_wheel import TimerWheel
+from vertigo_middleware.common.policies import get_object_trigger_table
+from vertigo_middleware.common.utils import get_object_metadata
+import json
+import time
+import zlib
+
+
+CATCH_UP_RULES = ('skip', 'once', 'all')
+
+
+class SystemClock(object):
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+
+class TokenBucket(object):
+    """
+    Rate limiter of the timer invocations of a tenant
+    """
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """
+        :returns: 0 if the invocation can run now, or the seconds to wait
+        """
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class TimerEntry(object):
+    """
+    ontimer microcontroller of an object
+    """
+    __slots__ = ('name', 'mc', 'account', 'data_file', 'interval',
+                 'catch_up', 'last_fired', 'nominal', 'pending')
+
+    def __init__(self, name, mc, data_file):
+        self.name = name
+        self.mc = mc
+        self.account = name.split('/')[1]
+        self.data_file = data_file
+        self.interval = None
+        self.catch_up = None
+        self.last_fired = None
+        self.nominal = None  # time of the firing in the timer rhythm
+        self.pending = 0  # firings left, more than 1 when catching up
+
+    @property
+    def key(self):
+        return (self.name, self.mc)
+
+
+class TimerScheduler(object):
+    """
+    Fires the ontimer microcontrollers of the objects of this node, found
+    in the trigger index. Timers are held in a hierarchical timer wheel.
+    Due timers are grouped by tenant (sandbox scope), and sent to the
+    sandbox in batches, each object with all its due microcontrollers.
+
+    The period of a timer is the 'interval' of its microcontroller
+    parameters (a JSON object), in seconds. Firings are spread with a stable
+    per-timer jitter, and limited per tenant with a token bucket. After a
+    downtime, the missed firings follow the 'catch_up' rule of the
+    parameters: 'skip' them, fire 'once', or fire 'all' of them (up to
+    timer_max_catch_up).
+
+    The ontimer microcontrollers inherited from a container or pseudo-folder
+    policy are resolved with the policy store. Only the objects accepted by
+    the owner function are fired, so that each object is fired by a single
+    node, and not by every replica.
+
+    The clock and the sandbox are injected: the sandbox only needs an
+    invoke_batch(account, [(name, data_file, mc_list), ...]) method that
+    returns a dictionary of name: result.
+    """
+
+    def __init__(self, index, sandbox, conf, logger, clock=None,
+                 policy_store=None, owner=None):
+        """
+        :param policy_store: BackendPolicyStore instance, or None to only
+                             fire the triggers of the objects themselves
+        :param owner: function that gets a data file, and returns whether
+                      this node fires its timers. By default, all of them.
+        """
+        self.index = index
+        self.sandbox = sandbox
+        self.logger = logger
+        self.clock = clock or SystemClock()
+        self.policy_store = policy_store
+        self.owner = owner
+        self.default_interval = float(conf.get('timer_default_interval',
+                                               3600))
+        self.min_interval = float(conf.get('timer_min_interval', 60))
+        self.jitter = float(conf.get('timer_jitter', 0.1))
+        self.max_jitter = float(conf.get('timer_max_jitter', 300))
+        self.batch_size = int(conf.get('timer_batch_size', 32))
+        self.tenant_rate = float(conf.get('timer_tenant_rate', 10))
+        self.tenant_burst = float(conf.get('timer_tenant_burst', 20))
+        self.catch_up = conf.get('timer_catch_up', 'once')
+        self.max_catch_up = int(conf.get('timer_max_catch_up', 10))
+        self.retry_interval = float(conf.get('timer_retry_interval', 60))
+        self.tick = float(conf.get('timer_tick', 1))
+
+        self.wheel = TimerWheel(self.tick, start=self.clock.time())
+        self.entries = dict()  # (name, mc): TimerEntry
+        self.buckets = dict()  # account: TokenBucket
+        self.fired = 0
+        self.deferred = 0
+        self.failed = 0
+
+    def _load_parameters(self, entry):
+        """
+        :returns: False if the object overrides the inherited
+                  microcontroller
+        """
+        entry.interval = self.default_interval
+        entry.catch_up = self.catch_up
+        metadata = get_object_metadata(entry.data_file)
+        table = get_object_trigger_table(metadata, self.policy_store)
+        if not table or entry.mc not in (table.get_list('ontimer') or ()):
+            return False
+        params = table.params.get(('ontimer', entry.mc))
+        if not params:
+            return True
+        try:
+            params = json.loads(params)
+            entry.interval = max(float(params.get('interval',
+                                                  entry.interval)),
+                                 self.min_interval)
+            if params.get('catch_up') in CATCH_UP_RULES:
+                entry.catch_up = params['catch_up']
+        except (ValueError, TypeError, AttributeError):
+            self.logger.warning('Vertigo - Invalid ontimer parameters of '
+                                '%s in %s' % (entry.mc, entry.name))
+        return True
+
+    def _get_jitter(self, entry):
+        """
+        Stable offset of a timer in its period, so the timers of the same
+        period do not fire all at once
+        """
+        spread = min(self.max_jitter, self.jitter * entry.interval)
+        key = (u'%s\n%s' % entry.key).encode('utf-8')
+        return (zlib.crc32(key) & 0xffffffff) / float(2 ** 32) * spread
+
+    def _schedule(self, entry, now):
+        if entry.last_fired is None:
+            entry.nominal = now + self._get_jitter(entry)
+            entry.pending = 1
+            deadline = entry.nominal
+        else:
+            nominal = entry.last_fired + entry.interval
+            missed = 0
+            if nominal <= now - self.tick:
+                missed = int((now - nominal) // entry.interval) + 1
+            if not missed:
+                entry.nominal = nominal
+                entry.pending = 1
+                deadline = nominal
+            elif entry.catch_up == 'skip':
+                entry.nominal = nominal + missed * entry.interval
+                entry.pending = 1
+                deadline = entry.nominal
+            else:
+                entry.pending = 1 if entry.catch_up == 'once' else \
+                    min(missed, self.max_catch_up)
+                # The last missed firings, oldest first
+                entry.nominal = nominal + (missed - entry.pending) * \
+                    entry.interval
+                deadline = now + self._get_jitter(entry)
+        self.wheel.schedule(entry.key, deadline, entry)
+
+    def sync(self):
+        """
+        Loads the ontimer microcontrollers from the trigger index: adds the
+        new timers and cancels the removed ones
+
+        :returns: number of scheduled timers
+        """
+        now = self.clock.time()
+        # The index has a row for each replica of an object on the node:
+        # only the ones of this owner are kept
+        owned = self.owner or (lambda data_file: True)
+        current = dict()
+        for name, data_file, _trigger, mc in self.index.find('ontimer'):
+            if owned(data_file):
+                current[(name, mc)] = data_file
+        if self.policy_store is not None:
+            for policy_id in list(self.index.get_policies()):
+                _, policy = self.policy_store.get(None, policy_id)
+                mc_list = policy.get_list('ontimer') if policy else None
+                if not mc_list:
+                    continue
+                for name, data_file in self.index.find_by_policy(policy_id):
+                    if not owned(data_file):
+                        continue
+                    for mc in mc_list:
+                        current.setdefault((name, mc), data_file)
+
+        for key in set(self.entries) - set(current):
+            self.wheel.cancel(key)
+            del self.entries[key]
+
+        last_fired = None
+        for key, data_file in current.items():
+            entry = self.entries.get(key)
+            if entry and entry.data_file == data_file:
+                continue
+            if entry is None:
+                entry = TimerEntry(key[0], key[1], data_file)
+                if last_fired is None:
+                    last_fired = self.index.get_last_fired()
+                entry.last_fired = last_fired.get(key)
+            entry.data_file = data_file
+            try:
+                if not self._load_parameters(entry):
+                    self.entries.pop(key, None)
+                    self.wheel.cancel(key)
+                    continue
+            except Exception:
+                # Replaced or deleted since it was indexed
+                self.logger.exception('Vertigo - Error loading the ontimer '
+                                      'parameters of ' + entry.name)
+                continue
+            self.entries[key] = entry
+            self._schedule(entry, now)
+        return len(self.entries)
+
+    def _get_bucket(self, account, now):
+        bucket = self.buckets.get(account)
+        if bucket is None:
+            bucket = TokenBucket(self.tenant_rate, self.tenant_burst, now)
+            self.buckets[account] = bucket
+        return bucket
+
+    def _invoke(self, account, objects, now):
+        """
+        :param objects: list of (name, data_file, [TimerEntry, ...])
+        """
+        batch = [(name, data_file, [entry.mc for entry in entries])
+                 for name, data_file, entries in objects]
+        try:
+            self.sandbox.invoke_batch(account, batch)
+        except Exception:
+            self.failed += len(batch)
+            self.logger.exception('Vertigo - Error firing ontimer '
+                                  'microcontrollers of ' + account)
+            for _name, _data_file, entries in objects:
+                for entry in entries:
+                    self.wheel.schedule(entry.key, now + self.retry_interval,
+                                        entry)
+            return
+
+        fired = list()
+        for _name, _data_file, entries in objects:
+            for entry in entries:
+                self.fired += 1
+                entry.pending -= 1
+                if entry.pending > 0:
+                    # Catching up: the next missed firing
+                    entry.nominal += entry.interval
+                    self.wheel.schedule(entry.key, now, entry)
+                    continue
+                entry.last_fired = entry.nominal
+                fired.append((entry.name, entry.mc, entry.last_fired))
+                self._schedule(entry, now)
+        self.index.set_last_fired(fired)
+
+    def run_pending(self):
+        """
+        Fires the due timers
+
+        :returns: number of fired microcontrollers
+        """
+        now = self.clock.time()
+        fired = self.fired
+        due = dict()  # account: {name: [TimerEntry, ...]}
+        for key, _deadline, entry in self.wheel.advance(now):
+            if self.entries.get(key) is not entry:
+                continue
+            wait = self._get_bucket(entry.account, now).take(now)
+            if wait:
+                self.deferred += 1
+                self.wheel.schedule(key, now + wait, entry)
+                continue
+            due.setdefault(entry.account, dict()).setdefault(
+                entry.name, list()).append(entry)
+
+        for account, objects in due.items():
+            objects = [(name, entries[0].data_file, entries)
+                       for name, entries in objects.items()]
+            for i in range(0, len(objects), self.batch_size):
+                self._invoke(account, objects[i:i + self.batch_size], now)
+        return self.fired - fired
+
+    def run_forever(self, sync_interval=300):
+        last_sync = None
+        while True:
+            now = self.clock.time()
+            if last_sync is None or now - last_sync >= sync_interval:
+                self.sync()
+                last_sync = now
+            self.run_pending()
+            self.clock.sleep(self.tick)
@@ -0,0 +1,185 @@
+from vertigo_middleware.common.object_cache import CHUNK_SIZE
+from collections import OrderedDict
+import hashlib
+import json
+import tempfile
+import time
+import os
+
+
+def make_storlet_cache_key(etag, storlets, options):
+    """
+    :param etag: Etag of the source object
+    :param storlets: ordered list of (storlet, parameters, timestamp)
+    :param options: storlet invocation headers of the request
+    :returns: cache key
+    """
+    return hashlib.sha256(json.dumps(
+        [etag, storlets, sorted(options.items())])).hexdigest()
+
+
+class CachedOutputIter(object):
+
+    def __init__(self, fp):
+        self.fp = fp
+
+    def __iter__(self):
+        try:
+            for chunk in iter(lambda: self.fp.read(CHUNK_SIZE), ''):
+                yield chunk
+        finally:
+            self.fp.close()
+
+    def close(self):
+        self.fp.close()
+
+
+class CacheWriteThroughIter(object):
+    """
+    Streams the output of a storlet pipeline, writing it into the cache.
+    The entry is only published if the whole output has been read.
+    """
+
+    def __init__(self, cache, key, data_iter):
+        self.cache = cache
+        self.key = key
+        self.data_iter = data_iter
+        self.tmp_path = None
+        self.fp = None
+
+    def _abort(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+            try:
+                os.unlink(self.tmp_path)
+            except OSError:
+                pass
+
+    def __iter__(self):
+        size = 0
+        try:
+            # Unique per writer: concurrent misses of the same key in a
+            # worker do not share it
+            fd, self.tmp_path = tempfile.mkstemp(
+                dir=self.cache.cache_dir, prefix=self.key + '.',
+                suffix='.tmp')
+            self.fp = os.fdopen(fd, 'wb')
+        except (IOError, OSError):
+            self.fp = None
+        try:
+            for chunk in self.data_iter:
+                if self.fp is not None:
+                    size += len(chunk)
+                    if size > self.cache.max_entry_size:
+                        self._abort()
+                    else:
+                        self.fp.write(chunk)
+                yield chunk
+        except Exception:
+            self._abort()
+            raise
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+            self.cache.publish(self.key, self.tmp_path, size)
+
+    def close(self):
+        self._abort()
+        if hasattr(self.data_iter, 'close'):
+            self.data_iter.close()
+
+
+class StorletOutputCache(object):
+    """
+    Node-local disk cache of the outputs of storlet pipelines, shared by
+    all the workers of the node. Entries are keyed by the Etag of the source
+    object, the ordered storlets with their parameters and artifact
+    timestamps, and the invocation options, so they never need to be
+    invalidated. The total size is bounded with an LRU order, by file
+    mtime, that each worker refreshes by rescanning the directory.
+    """
+
+    def __init__(self, conf, logger):
+        self.logger = logger
+        self.cache_dir = conf.get('storlet_cache_dir',
+                                  '/var/cache/vertigo/storlets')
+        self.capacity = int(conf.get('storlet_cache_capacity', 1073741824))
+        self.max_entry_size = int(conf.get('storlet_cache_max_size',
+                                           104857600))
+        self.rescan_interval = float(conf.get('storlet_cache_rescan_interval',
+                                              60))
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, 0o700)
+
+        self.entries = OrderedDict()  # key: size, least recently used first
+        self.size = 0
+        self.last_scan = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def _rescan(self):
+        """
+        Rebuilds the LRU order with the entries of all the workers
+        """
+        entries = list()
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                st = os.stat(self.get_path(name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+        entries.sort()
+        self.entries = OrderedDict((name, size) for _, name, size in entries)
+        self.size = sum(self.entries.values())
+        self.last_scan = time.time()
+
+    def get(self, key):
+        """
+        :returns: (iterator of the cached output, size), or None
+        """
+        path = self.get_path(key)
+        try:
+            fp = open(path, 'rb')
+            size = os.fstat(fp.fileno()).st_size
+            # Most recently used, also for the other workers
+            os.utime(path, None)
+        except (IOError, OSError):
+            self.misses += 1
+            self.logger.increment('vertigo.storlet_cache.misses')
+            return None
+        self.entries.pop(key, None)
+        self.entries[key] = size
+        self.hits += 1
+        self.logger.increment('vertigo.storlet_cache.hits')
+        return CachedOutputIter(fp), size
+
+    def wrap(self, key, data_iter):
+        """
+        :returns: iterator that streams the output and stores it
+        """
+        return CacheWriteThroughIter(self, key, data_iter)
+
+    def publish(self, key, tmp_path, size):
+        if time.time() - self.last_scan > self.rescan_interval:
+            self._rescan()
+        while self.entries and self.size + size > self.capacity:
+            old_key, old_size = self.entries.popitem(last=False)
+            self.size -= old_size
+            try:
+                os.unlink(self.get_path(old_key))
+            except OSError:
+                pass
+        try:
+            # Atomic for the other workers of the node
+            os.rename(tmp_path, self.get_path(key))
+        except OSError:
+            self.logger.exception('Vertigo - Error caching storlet output')
+            return
+        self.size += size - self.entries.pop(key, 0)
+        self.entries[key] = size
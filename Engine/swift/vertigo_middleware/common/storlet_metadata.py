@@ -0,0 +1,61 @@
+from collections import OrderedDict
+import time
+
+
+# Memcache key prefix of the last update time of a storlet
+STORLET_UPDATED_PREFIX = 'vertigo_storlet_'
+
+
+class StorletMetadataCache(object):
+    """
+    Per-worker cache of the parsed metadata of the storlets, or of the
+    failed access checks, per account, on the proxies. Entries are kept for
+    storlet_metadata_ttl seconds. Updates of the storlet container drop the
+    local entry, and leave their time in memcache, so the other workers
+    with memcache drop theirs too.
+    """
+
+    def __init__(self, conf, logger):
+        self.logger = logger
+        self.ttl = float(conf.get('storlet_metadata_ttl', 30))
+        self.max_size = int(conf.get('storlet_metadata_cache_size', 1024))
+        self.entries = OrderedDict()  # (account, storlet): (expires,
+        #                                                    loaded, metadata)
+
+    def get(self, account, storlet, memcache=None):
+        """
+        :param memcache: memcache client, if available
+        :returns: metadata dictionary, False if the storlet was not
+                  accessible, or None if not cached
+        """
+        key = (account, storlet)
+        entry = self.entries.pop(key, None)
+        if entry is None or entry[0] <= time.time():
+            return None
+        if memcache is not None:
+            updated = memcache.get(STORLET_UPDATED_PREFIX + account + '/' +
+                                   storlet)
+            if updated and float(updated) >= entry[1]:
+                return None
+        self.entries[key] = entry
+        return entry[2]
+
+    def set(self, account, storlet, metadata):
+        """
+        :param metadata: metadata dictionary, or False if not accessible
+        """
+        now = time.time()
+        key = (account, storlet)
+        self.entries.pop(key, None)
+        self.entries[key] = (now + self.ttl, now, metadata)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, account, storlet, memcache=None):
+        """
+        Drops a storlet after an update of its object
+        """
+        self.entries.pop((account, storlet), None)
+        if memcache is not None:
+            memcache.set(STORLET_UPDATED_PREFIX + account + '/' + storlet,
+                         repr(time.time()), time=int(self.ttl) + 1)
@@ -0,0 +1,85 @@
+from swift.common.exceptions import ChunkReadError
+
+
+class VerdictHeldInput(object):
+    """
+    wsgi.input wrapper that forwards the upload while the onput verdict is
+    computed, but holds its last bytes (and so the commit on the object
+    servers) until the verdict arrives. The forwarded bytes are spooled
+    until the verdict is known, so the upload can be replayed through the
+    storlets. Any verdict but CONTINUE aborts the upload.
+    """
+
+    def __init__(self, wsgi_input, content_length, invocation, spool):
+        """
+        :param wsgi_input: original wsgi.input
+        :param content_length: length of the upload, or None if chunked
+        :param invocation: GreenThread computing the verdict
+        :param spool: file where the forwarded bytes are kept
+        """
+        self.wsgi_input = wsgi_input
+        self.content_length = content_length
+        self.invocation = invocation
+        self.spool = spool
+        self.consumed = 0
+        self.verdict = None
+
+    def _get_verdict(self):
+        if self.verdict is None:
+            self.verdict = self.invocation.wait()
+            if self.verdict['command'] == 'CONTINUE':
+                # No replay: stop spooling
+                self.spool.close()
+                self.spool = None
+        return self.verdict
+
+    def read(self, size=-1):
+        data = self.wsgi_input.read(size)
+        self.consumed += len(data)
+        if self.spool is not None:
+            self.spool.write(data)
+
+        final = not data or (self.content_length is not None and
+                             self.consumed >= self.content_length)
+        if (final or self.invocation.dead) and \
+                self._get_verdict()['command'] != 'CONTINUE':
+            raise ChunkReadError('Vertigo - Upload aborted by the onput '
+                                 'verdict')
+        return data
+
+    def replay(self):
+        """
+        :returns: file-like object with the whole upload: the spooled bytes
+                  and the ones not read yet
+        """
+        self.spool.seek(0)
+        return ReplayInput(self.spool, self.wsgi_input)
+
+
+class ReplayInput(object):
+
+    def __init__(self, spool, wsgi_input, chunk_size=65536):
+        self.spool = spool
+        self.wsgi_input = wsgi_input
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        return iter(lambda: self.read(self.chunk_size), '')
+
+    def read(self, size=-1):
+        if self.spool is not None:
+            data = self.spool.read(size)
+            if data:
+                return data
+            self.spool.close()
+            self.spool = None
+        return self.wsgi_input.read(size)
+
+    def readline(self, size=-1):
+        if self.spool is not None:
+            data = self.spool.readline(size)
+            if data:
+                return data
+            self.spool.close()
+            self.spool = None
+        return self.wsgi_input.readline(size)
@@ -0,0 +1,123 @@
+import math
+
+
+class TimerWheel(object):
+    """
+    Hierarchical timer wheel. Level 0 has one slot per tick, and each slot
+    of level n spans a whole turn of level n - 1. Timers are inserted in the
+    lowest level whose range covers their deadline, and cascade down to the
+    lower levels as the wheel turns, so scheduling, cancelling and expiring
+    a timer is O(1) regardless of the number of timers. Deadlines beyond the
+    range of the top level wait in an overflow list.
+    """
+
+    def __init__(self, tick=1.0, slots=64, levels=4, start=0.0):
+        """
+        :param tick: resolution of the wheel, in seconds
+        :param slots: number of slots of each level
+        :param levels: number of levels
+        :param start: time of the first tick
+        """
+        self.tick = float(tick)
+        self.slots = slots
+        self.wheels = [[dict() for _ in range(slots)]
+                       for _ in range(levels)]
+        self.overflow = dict()
+        self.current = self._to_tick(start)
+        self.timers = dict()  # key: (deadline tick, item)
+
+    def _to_tick(self, t):
+        return int(math.ceil(t / self.tick))
+
+    def __len__(self):
+        return len(self.timers)
+
+    def __contains__(self, key):
+        return key in self.timers
+
+    def _place(self, key, deadline):
+        delta = deadline - self.current
+        span = 1
+        for wheel in self.wheels:
+            if delta < span * self.slots:
+                wheel[(deadline // span) % self.slots][key] = deadline
+                return
+            span *= self.slots
+        self.overflow[key] = deadline
+
+    def schedule(self, key, deadline, item):
+        """
+        Schedules a timer, replacing the previous timer of the key
+
+        :param key: unique key of the timer
+        :param deadline: time at which the timer expires
+        :param item: value returned when the timer expires
+        """
+        self.cancel(key)
+        deadline = max(self._to_tick(deadline), self.current + 1)
+        self.timers[key] = (deadline, item)
+        self._place(key, deadline)
+
+    def cancel(self, key):
+        """
+        :returns: the item of the cancelled timer, or None
+        """
+        timer = self.timers.pop(key, None)
+        if timer is None:
+            return None
+        # The slot entry is dropped lazily, when it expires or cascades
+        return timer[1]
+
+    def _cascade(self, level):
+        """
+        Moves the timers of the current slot of a level to the lower ones
+        """
+        span = self.slots ** level
+        slot = self.wheels[level][(self.current // span) % self.slots]
+        entries = list(slot.items())
+        slot.clear()
+        for key, deadline in entries:
+            if self.timers.get(key, (None,))[0] == deadline:
+                self._place(key, deadline)
+
+    def _turn(self):
+        self.current += 1
+        for level in range(1, len(self.wheels)):
+            if self.current % (self.slots ** level):
+                break
+            self._cascade(level)
+        else:
+            if self.current % (self.slots ** len(self.wheels)) == 0:
+                entries = list(self.overflow.items())
+                self.overflow.clear()
+                for key, deadline in entries:
+                    if self.timers.get(key, (None,))[0] == deadline:
+                        self._place(key, deadline)
+
+        slot = self.wheels[0][self.current % self.slots]
+        expired = list()
+        for key, deadline in slot.items():
+            timer = self.timers.get(key)
+            if timer and timer[0] == deadline:
+                del self.timers[key]
+                expired.append((key, deadline * self.tick, timer[1]))
+        slot.clear()
+        return expired
+
+    def advance(self, now):
+        """
+        Turns the wheel up to now
+
+        :param now: current time
+        :returns: list of (key, deadline, item) of the expired timers, in
+                  deadline order
+        """
+        target = int(math.floor(now / self.tick))
+        expired = list()
+        while self.current < target:
+            if not self.timers:
+                # Nothing to expire, jump to the target tick
+                self.current = target
+                break
+            expired.extend(self._turn())
+        return expired
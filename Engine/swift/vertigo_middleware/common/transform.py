@@ -0,0 +1,111 @@
+from swift.common.swob import Request, Response
+from swift.common.utils import Timestamp
+from vertigo_middleware.common.deferred_queue import DeferredInvoker
+from vertigo_middleware.common.object_cache import HOT_OBJECT_KEY_PREFIX
+from vertigo_middleware.common.utils import SYSMETA_OBJ_HEADER
+from vertigo_middleware.gateways import VertigoGatewayStorlet
+import json
+
+
+# Sysmeta key (after the Vertigo sysmeta prefix) with the storlet list of
+# an object committed before its onput transformation
+PENDING_TRANSFORM_KEY = 'Pending-Transform'
+PENDING_TRANSFORM_HEADER = SYSMETA_OBJ_HEADER + PENDING_TRANSFORM_KEY
+
+# Headers of the original object kept by the transformed one
+COPIED_HEADERS = frozenset(['Content-Type', 'Content-Encoding',
+                            'Content-Disposition', 'X-Delete-At'])
+
+
+def get_pending_storlet_list(headers, server):
+    """
+    :param headers: object headers
+    :param server: server that must run the storlets
+    :returns: storlet list of a pending transformation, or None
+    """
+    pending = headers.get(PENDING_TRANSFORM_HEADER)
+    if not pending:
+        return None
+    storlet_list = json.loads(pending)
+    for key in storlet_list:
+        storlet_list[key]['server'] = server
+    return storlet_list
+
+
+class TransformWorker(DeferredInvoker):
+    """
+    Runs the deferred onput storlet transformations, in a pool of
+    storlet_transform_workers greenthreads per proxy worker. The original
+    object is read, piped through the storlet list, and replaced by the
+    result with the timestamp of the original plus an offset, so the object
+    servers reject the swap if the object has been overwritten meanwhile.
+    """
+    metric_prefix = 'vertigo.transform.'
+
+    def __init__(self, conf, logger, queue, app):
+        super(TransformWorker, self).__init__(
+            conf, logger, queue,
+            int(conf.get('storlet_transform_workers', 4)))
+        self.app = app
+        self.memcache = None
+
+    def enqueue(self, path, etag):
+        """
+        :param path: /version/account/container/object
+        :param etag: Etag of the committed original, which keeps the
+                     storlet list to apply
+        :returns: False if the queue is full
+        """
+        return self.queue.put({'path': path, 'etag': etag})
+
+    def invoke(self, job):
+        path = job['path']
+        get_resp = Request.blank(path, headers={'Mc-Enabled': 'False'}) \
+            .get_response(self.app)
+        if not get_resp.is_success or \
+                get_resp.headers.get('Etag') != job['etag'] or \
+                PENDING_TRANSFORM_HEADER not in get_resp.headers:
+            # Overwritten or deleted meanwhile
+            if hasattr(get_resp.app_iter, 'close'):
+                get_resp.app_iter.close()
+            self.logger.info('Vertigo - Discarding transformation of ' + path)
+            return
+
+        headers = dict((key, value)
+                       for key, value in get_resp.headers.items()
+                       if key in COPIED_HEADERS or
+                       key.startswith('X-Object-Meta-') or
+                       key.startswith(SYSMETA_OBJ_HEADER))
+        del headers[PENDING_TRANSFORM_HEADER]
+        headers['Mc-Enabled'] = 'False'
+        headers['X-Timestamp'] = Timestamp(get_resp.headers['X-Timestamp'],
+                                           offset=1).internal
+        put_req = Request.blank(path, environ={'REQUEST_METHOD': 'PUT'},
+                                headers=headers)
+
+        version, account = put_req.split_path(4, 4, True)[:2]
+        storlet_list = get_pending_storlet_list(get_resp.headers,
+                                                self.conf['execution_server'])
+        gateway = VertigoGatewayStorlet(self.conf, self.logger, self.app,
+                                        version, account, 'PUT')
+        put_req = gateway.run(put_req, storlet_list, get_resp.app_iter)
+        if isinstance(put_req, Response):
+            # A storlet is not accessible: retrying does not help
+            if hasattr(get_resp.app_iter, 'close'):
+                get_resp.app_iter.close()
+            self.logger.warning('Vertigo - Discarding transformation of %s: '
+                                '%s' % (path, put_req.body))
+            return
+        put_req.environ.pop('CONTENT_LENGTH', None)
+        put_req.headers['Transfer-Encoding'] = 'chunked'
+
+        put_resp = put_req.get_response(self.app)
+        if put_resp.status_int == 409:
+            self.logger.info('Vertigo - Discarding transformation of ' +
+                             path + ': overwritten')
+        elif not put_resp.is_success:
+            raise ValueError('Vertigo - Error replacing %s: %s' %
+                             (path, put_resp.status))
+        elif self.memcache:
+            obj = path.split('/', 2)[2]
+            self.memcache.delete(HOT_OBJECT_KEY_PREFIX + obj)
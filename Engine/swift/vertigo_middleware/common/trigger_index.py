@@ -0,0 +1,299 @@
+from vertigo_middleware.common.triggers import get_policy_reference, \
+    load_trigger_table
+from vertigo_middleware.common.utils import SYSMETA_OBJ_HEADER
+from eventlet import tpool
+from eventlet.semaphore import Semaphore
+import sqlite3
+import os
+
+
+DEFAULT_INDEX_PATH = '/var/cache/vertigo/trigger_index.db'
+
+# Version 2 keys the objects by their directory: a node can hold several
+# replicas or handoffs of an object, on different devices
+SCHEMA_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    location TEXT PRIMARY KEY,
+    name TEXT,
+    data_file TEXT,
+    policy TEXT,
+    crawl INTEGER DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS objects_name ON objects (name);
+CREATE INDEX IF NOT EXISTS objects_data_file ON objects (data_file);
+CREATE INDEX IF NOT EXISTS objects_policy ON objects (policy);
+CREATE TABLE IF NOT EXISTS triggers (
+    location TEXT,
+    trigger TEXT,
+    mc TEXT,
+    PRIMARY KEY (location, trigger, mc)
+);
+CREATE INDEX IF NOT EXISTS triggers_mc ON triggers (trigger, mc);
+CREATE TABLE IF NOT EXISTS timers (
+    name TEXT,
+    mc TEXT,
+    last_fired REAL,
+    PRIMARY KEY (name, mc)
+);
+CREATE TABLE IF NOT EXISTS crawls (
+    crawl INTEGER PRIMARY KEY,
+    started REAL,
+    completed REAL
+);
+'''
+
+
+def get_location(data_file):
+    """
+    :returns: the object directory of a data file, which identifies a replica
+              of the object on a device
+    """
+    return os.path.normpath(os.path.dirname(data_file))
+
+
+class TriggerIndex(object):
+    """
+    Node-local SQLite index of the objects with Vertigo triggers. It keeps
+    the microcontrollers assigned to each object (its own triggers), and the
+    reference to the policy it inherits, for each replica of the object on
+    the node. It is built by the trigger indexer daemon and kept up to date
+    by the object-server middleware.
+    """
+
+    def __init__(self, db_path=DEFAULT_INDEX_PATH, timeout=5,
+                 check_same_thread=True):
+        """
+        :param check_same_thread: False if the index is used from other
+                                  threads, one at a time
+        """
+        db_dir = os.path.dirname(db_path)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir, 0o700)
+        self.conn = sqlite3.connect(db_path, timeout=timeout,
+                                    check_same_thread=check_same_thread)
+        # Readers do not block the middleware and the crawler
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        if version < SCHEMA_VERSION:
+            # The index is rebuilt by the next crawl
+            self.conn.executescript('DROP TABLE IF EXISTS objects;'
+                                    'DROP TABLE IF EXISTS triggers;')
+        self.conn.executescript(SCHEMA)
+        self.conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+
+    def close(self):
+        self.conn.close()
+
+    def get_data_files(self):
+        """
+        :returns: set with the data files of all indexed objects
+        """
+        return set(row[0] for row in self.conn.execute(
+            'SELECT data_file FROM objects'))
+
+    def start_crawl(self, started):
+        """
+        :returns: (crawl id, start time of the last completed crawl or 0)
+        """
+        with self.conn:
+            row = self.conn.execute(
+                'SELECT MAX(started) FROM crawls WHERE completed IS NOT NULL'
+            ).fetchone()
+            cursor = self.conn.execute(
+                'INSERT INTO crawls (started) VALUES (?)', (started,))
+        return cursor.lastrowid, row[0] or 0
+
+    def complete_crawl(self, crawl, completed):
+        """
+        Removes the objects not seen by a complete crawl, and records it
+
+        :returns: number of removed objects
+        """
+        with self.conn:
+            self.conn.execute(
+                'DELETE FROM triggers WHERE location IN '
+                '(SELECT location FROM objects WHERE crawl < ?)', (crawl,))
+            cursor = self.conn.execute('DELETE FROM objects WHERE crawl < ?',
+                                       (crawl,))
+            self.conn.execute('DELETE FROM timers WHERE name NOT IN '
+                              '(SELECT name FROM objects)')
+            self.conn.execute('UPDATE crawls SET completed = ? '
+                              'WHERE crawl = ?', (completed, crawl))
+            self.conn.execute('DELETE FROM crawls WHERE crawl < ?', (crawl,))
+        return cursor.rowcount
+
+    def commit(self):
+        self.conn.commit()
+
+    def update(self, data_file, metadata, crawl=None, commit=True):
+        """
+        Indexes the triggers of an object
+
+        :param data_file: full path of the data file
+        :param metadata: swift metadata of the object
+        :param crawl: id of the crawl that found the object. None for the
+                      middleware updates: they are credited to the latest
+                      crawl, so that a crawl running meanwhile does not
+                      prune them.
+        :param commit: commit now, or leave it to a later commit() call
+        """
+        name = metadata['name']
+        location = get_location(data_file)
+        if crawl is None:
+            crawl = self.conn.execute(
+                'SELECT COALESCE(MAX(crawl), 0) FROM crawls').fetchone()[0]
+        table = load_trigger_table(metadata, SYSMETA_OBJ_HEADER)
+        reference = get_policy_reference(metadata, SYSMETA_OBJ_HEADER)
+
+        self.conn.execute('DELETE FROM triggers WHERE location = ?',
+                          (location,))
+        if not table and not reference:
+            self.conn.execute('DELETE FROM objects WHERE location = ?',
+                              (location,))
+        else:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO objects '
+                '(location, name, data_file, policy, crawl) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (location, name, data_file,
+                 reference[0] if reference else None, crawl))
+            if table:
+                self.conn.executemany(
+                    'INSERT INTO triggers (location, trigger, mc) '
+                    'VALUES (?, ?, ?)',
+                    [(location, trigger, mc)
+                     for trigger, mc_list in table.triggers.items()
+                     for mc in mc_list])
+        if commit:
+            self.conn.commit()
+
+    def touch(self, data_file, crawl):
+        """
+        Marks an unchanged object as seen by a crawl. Committed with the next
+        commit() call.
+        """
+        self.conn.execute('UPDATE objects SET crawl = ? WHERE data_file = ?',
+                          (crawl, data_file))
+
+    def remove(self, location):
+        """
+        Removes a replica of an object, and the timers of the object once no
+        replica is left
+
+        :param location: object directory of the replica
+        """
+        location = os.path.normpath(location)
+        with self.conn:
+            self.conn.execute('DELETE FROM triggers WHERE location = ?',
+                              (location,))
+            self.conn.execute('DELETE FROM objects WHERE location = ?',
+                              (location,))
+            self.conn.execute('DELETE FROM timers WHERE name NOT IN '
+                              '(SELECT name FROM objects)')
+
+    def find(self, trigger=None, mc=None):
+        """
+        Finds the objects with microcontroller mc on a trigger. Inherited
+        triggers are not included: use find_by_policy with the policies
+        that assign mc.
+
+        :returns: iterator of (name, data_file, trigger, mc) tuples, one for
+                  each replica of an object on the node
+        """
+        query = 'SELECT o.name, o.data_file, t.trigger, t.mc FROM ' \
+                'triggers t JOIN objects o ON o.location = t.location'
+        conditions = list()
+        args = list()
+        if trigger:
+            conditions.append('t.trigger = ?')
+            args.append(trigger)
+        if mc:
+            conditions.append('t.mc = ?')
+            args.append(mc)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return self.conn.execute(query, args)
+
+    def find_by_policy(self, policy_id):
+        """
+        Finds the objects that inherit a policy
+
+        :returns: iterator of (name, data_file) tuples, one for each replica
+                  of an object on the node
+        """
+        return self.conn.execute(
+            'SELECT name, data_file FROM objects WHERE policy = ?',
+            (policy_id,))
+
+    def get_policies(self):
+        """
+        :returns: iterator of the ids of the policies inherited by the objects
+        """
+        return (policy_id for policy_id, in self.conn.execute(
+            'SELECT DISTINCT policy FROM objects WHERE policy IS NOT NULL'))
+
+    def get_triggers(self, name):
+        """
+        :returns: dictionary with the microcontrollers of each trigger
+        """
+        triggers = dict()
+        for trigger, mc in self.conn.execute(
+                'SELECT DISTINCT t.trigger, t.mc FROM triggers t JOIN '
+                'objects o ON o.location = t.location WHERE o.name = ?',
+                (name,)):
+            triggers.setdefault(trigger, list()).append(mc)
+        return triggers
+
+    def get_last_fired(self):
+        """
+        :returns: dictionary of (name, mc): last time the ontimer
+                  microcontroller was fired
+        """
+        return dict(((name, mc), last_fired) for name, mc, last_fired in
+                    self.conn.execute('SELECT name, mc, last_fired '
+                                      'FROM timers'))
+
+    def set_last_fired(self, fired):
+        """
+        :param fired: list of (name, mc, time) tuples
+        """
+        with self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO timers (name, mc, last_fired) '
+                'VALUES (?, ?, ?)', fired)
+
+    def stats(self):
+        objects = self.conn.execute(
+            'SELECT COUNT(DISTINCT name) FROM objects').fetchone()
+        triggers = self.conn.execute(
+            'SELECT trigger, COUNT(*) FROM triggers GROUP BY trigger')
+        return {'objects': objects[0],
+                'triggers': dict(triggers.fetchall())}
+
+
+class TriggerIndexWriter(object):
+    """
+    Runs the trigger index writes of the object-server middleware in a
+    native thread, one at a time, so that the SQLite locks and syncs do not
+    block the eventlet hub of the worker
+    """
+
+    def __init__(self, index):
+        """
+        :param index: TriggerIndex instance, created with
+                      check_same_thread=False
+        """
+        self.index = index
+        self.semaphore = Semaphore()
+
+    def _execute(self, func, *args):
+        with self.semaphore:
+            return tpool.execute(func, *args)
+
+    def update(self, data_file, metadata):
+        self._execute(self.index.update, data_file, metadata)
+
+    def remove(self, location):
+        self._execute(self.index.remove, location)
@@ -0,0 +1,345 @@
+import json
+import ast
+
+
+TRIGGERS = ('onget', 'onput', 'ondelete', 'ontimer')
+SHORT_TRIGGERS = {'onget': 'g', 'onput': 'p', 'ondelete': 'd', 'ontimer': 't'}
+LONG_TRIGGERS = dict((v, k) for k, v in SHORT_TRIGGERS.items())
+
+TRIGGER_FORMAT_VERSION = 1
+# Encoded tables are stored in a single sysmeta header
+MAX_TRIGGER_TABLE_SIZE = 7168
+
+# Sysmeta keys (after the Vertigo sysmeta prefix) of the inherited policy
+# reference of an object, and of the version of a container or
+# pseudo-folder policy
+POLICY_KEY = 'Policy'
+POLICY_VERSION_KEY = 'Policy-Version'
+
+# Inherited policy resolved by the proxy, forwarded to the object servers
+BACKEND_POLICY_REFERENCE_HEADER = 'X-Backend-Vertigo-Policy-Reference'
+BACKEND_POLICY_HEADER = 'X-Backend-Vertigo-Policy'
+
+
+def _native(value):
+    if isinstance(value, str):
+        return value
+    return value.encode('utf-8')
+
+
+class TriggerTable(object):
+    """
+    Microcontrollers assigned to each trigger of an object or container, with
+    their specific parameters.
+
+    The table is stored in the Microcontroller sysmeta key as
+    'v1:' + compact JSON: {"g": [["mc"], ["mc", "params"]], ...}, where the
+    keys are the short trigger names. The legacy format (a str(dict) of the
+    triggers, with one extra sysmeta key per microcontroller parameters) is
+    still understood on read.
+    """
+
+    def __init__(self):
+        self.triggers = dict()  # trigger: [mc, ...]
+        self.params = dict()  # (trigger, mc): parameters
+
+    def add(self, trigger, mc, params=None):
+        if trigger not in SHORT_TRIGGERS:
+            raise ValueError('Vertigo - Unknown trigger: ' + trigger)
+        mc_list = self.triggers.setdefault(trigger, list())
+        if mc not in mc_list:
+            mc_list.append(mc)
+        if params:
+            self.params[(trigger, mc)] = params
+        else:
+            self.params.pop((trigger, mc), None)
+
+    def remove(self, trigger, mc, keep_empty=False):
+        """
+        Removes a microcontroller from a trigger, or all of them if mc is
+        'all'
+
+        :param keep_empty: keep the trigger with an empty list, overriding
+                           the inherited microcontrollers
+        :raises ValueError: if the microcontroller is not assigned
+        """
+        mc_list = self.triggers.get(trigger)
+        if mc == 'all':
+            mc_list = self.triggers.pop(trigger, None) or list()
+            if keep_empty:
+                self.triggers[trigger] = list()
+        elif mc_list and mc in mc_list:
+            mc_list.remove(mc)
+            if not mc_list and not keep_empty:
+                del self.triggers[trigger]
+            mc_list = [mc]
+        else:
+            raise ValueError('Vertigo - Microcontroller not assigned')
+        for mc_k in mc_list:
+            self.params.pop((trigger, mc_k), None)
+
+    def clear(self):
+        self.triggers.clear()
+        self.params.clear()
+
+    def copy(self):
+        table = TriggerTable()
+        for trigger, mc_list in self.triggers.items():
+            table.triggers[trigger] = list(mc_list)
+        table.params.update(self.params)
+        return table
+
+    def inherit(self, policy, trigger):
+        """
+        Copies the microcontrollers of an inherited trigger into this
+        table, so they can be overridden one by one
+
+        :param policy: inherited TriggerTable instance, or None
+        """
+        if trigger in self.triggers or not policy:
+            return
+        self.triggers[trigger] = list(policy.triggers.get(trigger, ()))
+        for mc in self.triggers[trigger]:
+            params = policy.params.get((trigger, mc))
+            if params:
+                self.params[(trigger, mc)] = params
+
+    def overlay(self, table):
+        """
+        :param table: TriggerTable instance with the overrides, or None
+        :returns: new TriggerTable instance with the triggers of this one,
+                  each of them replaced by the one of table if it has it
+        """
+        effective = self.copy()
+        if table:
+            for trigger in table.triggers:
+                effective.triggers.pop(trigger, None)
+                for key in effective.params.keys():
+                    if key[0] == trigger:
+                        del effective.params[key]
+                effective.inherit(table, trigger)
+        return effective
+
+    def get_list(self, trigger):
+        return self.triggers.get(trigger) or None
+
+    def to_dict(self):
+        """
+        :returns: legacy-shaped dictionary, with all the triggers
+        """
+        return dict((trigger, list(self.triggers[trigger])
+                     if trigger in self.triggers else None)
+                    for trigger in TRIGGERS)
+
+    def __len__(self):
+        return len(self.triggers)
+
+    def encode(self):
+        """
+        :returns: versioned compact encoding of the table
+        :raises ValueError: if the encoding exceeds MAX_TRIGGER_TABLE_SIZE
+        """
+        table = dict()
+        for trigger, mc_list in self.triggers.items():
+            entries = list()
+            for mc in mc_list:
+                params = self.params.get((trigger, mc))
+                entries.append([mc, params] if params else [mc])
+            table[SHORT_TRIGGERS[trigger]] = entries
+        value = 'v%d:%s' % (TRIGGER_FORMAT_VERSION,
+                            json.dumps(table, separators=(',', ':'),
+                                       sort_keys=True))
+        if len(value) > MAX_TRIGGER_TABLE_SIZE:
+            raise ValueError('Vertigo - Trigger metadata exceeds %d bytes' %
+                             MAX_TRIGGER_TABLE_SIZE)
+        return value
+
+    @classmethod
+    def decode(cls, value):
+        """
+        :param value: encoded table, or legacy str(dict) or dict
+        :returns: TriggerTable instance
+        """
+        table = cls()
+        if isinstance(value, dict):
+            mc_dict = value
+        elif value.startswith('v1:'):
+            for short, entries in json.loads(value[3:]).items():
+                trigger = LONG_TRIGGERS[short]
+                # Empty lists override inherited triggers
+                table.triggers.setdefault(trigger, list())
+                for entry in entries:
+                    table.add(trigger, _native(entry[0]),
+                              _native(entry[1]) if len(entry) > 1 else None)
+            return table
+        elif value.startswith('v'):
+            raise ValueError('Vertigo - Unknown trigger metadata format')
+        else:
+            mc_dict = ast.literal_eval(value)
+
+        for trigger, mc_list in mc_dict.items():
+            for mc in mc_list or ():
+                table.add(trigger, mc)
+        return table
+
+
+def is_legacy_parameters_key(key, sysmeta_prefix):
+    """
+    Checks whether a sysmeta key holds microcontroller parameters in the
+    legacy format (one key per microcontroller, e.g.
+    X-Object-Sysmeta-Vertigo-Onget-<Mc>)
+    """
+    if not key.startswith(sysmeta_prefix):
+        return False
+    trigger = key[len(sysmeta_prefix):].split('-', 1)
+    return len(trigger) == 2 and trigger[0].lower() in SHORT_TRIGGERS
+
+
+def load_trigger_table(metadata, sysmeta_prefix):
+    """
+    Loads the trigger table from swift metadata or headers, in any format
+
+    :param metadata: metadata dictionary or headers
+    :param sysmeta_prefix: X-Object-Sysmeta-Vertigo- or
+                           X-Container-Sysmeta-Vertigo-
+    :returns: TriggerTable instance, or None if there are no triggers
+    """
+    value = metadata.get(sysmeta_prefix + 'Microcontroller')
+    if not value:
+        return None
+    table = TriggerTable.decode(value)
+    if not isinstance(value, dict) and value.startswith('v'):
+        return table or None
+
+    for trigger, mc_list in table.triggers.items():
+        for mc in mc_list:
+            params = metadata.get((sysmeta_prefix + trigger + '-' +
+                                   mc).title())
+            if params:
+                table.params[(trigger, mc)] = params
+    return table or None
+
+
+def store_trigger_table(metadata, table, sysmeta_prefix, empty_value=None):
+    """
+    Stores the trigger table into swift metadata in the compact format, and
+    drops the legacy parameter keys
+
+    :param metadata: metadata dictionary
+    :param table: TriggerTable instance
+    :param sysmeta_prefix: X-Object-Sysmeta-Vertigo- or
+                           X-Container-Sysmeta-Vertigo-
+    :param empty_value: None deletes the stale keys, any other value is
+                        assigned to them (e.g. '' for container POSTs)
+    :returns: whether the metadata has changed
+    """
+    mc_key = sysmeta_prefix + 'Microcontroller'
+    new_metadata = dict()
+    for key in metadata.keys():
+        if is_legacy_parameters_key(key, sysmeta_prefix) and \
+                metadata[key] != empty_value:
+            new_metadata[key] = empty_value
+    new_metadata[mc_key] = table.encode() if table else empty_value
+    if not metadata.get(mc_key) and not table:
+        del new_metadata[mc_key]
+
+    changed = False
+    for key, value in new_metadata.items():
+        if value is None:
+            if key in metadata:
+                del metadata[key]
+                changed = True
+        elif metadata.get(key) != value:
+            metadata[key] = value
+            changed = True
+    return changed
+
+
+def expand_trigger_parameters(headers, sysmeta_prefix, table=None):
+    """
+    Adds the legacy per-microcontroller parameter keys to a copy of the
+    headers, as expected by the microcontroller runtime
+
+    :param headers: object headers
+    :param table: TriggerTable instance, by default the one in the headers
+    :returns: new headers dictionary
+    """
+    headers = dict(headers)
+    if table is None:
+        table = load_trigger_table(headers, sysmeta_prefix)
+    if table:
+        for (trigger, mc), params in table.params.items():
+            headers[(sysmeta_prefix + trigger + '-' + mc).title()] = params
+    return headers
+
+
+def parse_policy_reference(value):
+    """
+    :returns: (policy_id, version) tuple
+    """
+    policy_id, version = value.rsplit('@', 1)
+    return policy_id, version
+
+
+def make_policy_reference(policy_id, version):
+    return '%s@%s' % (policy_id, version)
+
+
+def get_policy_reference(metadata, sysmeta_prefix):
+    """
+    :returns: (policy_id, version) tuple of the inherited policy referenced
+              by an object, or None
+    """
+    value = metadata.get(sysmeta_prefix + POLICY_KEY)
+    if not value:
+        return None
+    return parse_policy_reference(value)
+
+
+def get_forwarded_policy(request):
+    """
+    Gets the inherited policy forwarded by the proxy to the object server
+
+    :param request: swob.Request instance
+    :returns: (reference, TriggerTable instance) tuple, or (None, None) if
+              there is no policy, or it has no triggers
+    """
+    reference = request.headers.get(BACKEND_POLICY_REFERENCE_HEADER)
+    value = request.headers.get(BACKEND_POLICY_HEADER)
+    if not reference or not value:
+        return None, None
+    table = TriggerTable.decode(value)
+    if not table:
+        return None, None
+    return reference, table
+
+
+def inherits_policy(metadata, sysmeta_prefix, policy_id):
+    """
+    Checks whether an object inherits the given policy. Objects without a
+    policy reference inherit from their parent only if they have no
+    triggers of their own (objects that predate the references have a copy
+    instead).
+    """
+    reference = get_policy_reference(metadata, sysmeta_prefix)
+    if reference:
+        return reference[0] == policy_id
+    return not metadata.get(sysmeta_prefix + 'Microcontroller')
+
+
+def get_effective_table(metadata, sysmeta_prefix, policy_id, policy):
+    """
+    Resolves the triggers of an object: the inherited policy with the
+    triggers overridden by the object itself
+
+    :param metadata: object metadata or headers
+    :param sysmeta_prefix: X-Object-Sysmeta-Vertigo-
+    :param policy_id: id of the parent policy resolved for the request
+    :param policy: TriggerTable instance of the parent policy, or None
+    :returns: TriggerTable instance, or None if there are no triggers
+    """
+    table = load_trigger_table(metadata, sysmeta_prefix)
+    if not policy or not inherits_policy(metadata, sysmeta_prefix,
+                                         policy_id):
+        return table
+    return policy.overlay(table) or None
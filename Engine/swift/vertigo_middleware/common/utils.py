@@ -3,14 +3,29 @@ from swift.common.exceptions import DiskFileXattrNotSupported, DiskFileNoSpace
 from swift.common.exceptions import DiskFileNotExist
 from swift.obj.diskfile import get_data_dir as df_data_dir, _get_filename
 from swift.common.request_helpers import get_name_and_placement
-from swift.common.utils import storage_directory, hash_path, cache_from_env
-from swift.common.wsgi import make_subrequest
+from swift.common.utils import storage_directory, hash_path, Timestamp
+from swift.common.wsgi import make_subrequest, make_env
+from vertigo_middleware.common.triggers import TriggerTable, \
+    load_trigger_table, store_trigger_table, get_effective_table, \
+    get_forwarded_policy, inherits_policy, parse_policy_reference, \
+    TRIGGERS, POLICY_KEY, POLICY_VERSION_KEY
+from collections import OrderedDict
 import xattr
 import logging
 import pickle
 import errno
+import copy
+import time
 import os
 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
 
 PICKLE_PROTOCOL = 2
 
@@ -23,10 +38,50 @@ VERTIGO_MC_HEADER_CONTAINER = SYSMETA_CONTAINER_HEADER + 'Microcontroller'
 SWIFT_METADATA_KEY = 'user.swift.metadata'
 
 LOCAL_PROXY = '/etc/swift/storlet-proxy-server.conf'
-DEFAULT_MD_STRING = {'onget': None,
-                     'onput': None,
-                     'ondelete': None,
-                     'ontimer': None}
+
+LINK_CACHE_PREFIX = 'vertigo_link_'
+LINK_CACHE_TIME = 600
+MAX_LINK_HOPS = 10
+METADATA_CACHE_SIZE = 1024
+
+
+class SubrequestFactory(object):
+    """
+    Builds the Vertigo subrequests of an incoming request. The stripped base
+    environment is computed once per incoming request, so each subrequest
+    is derived from a small template instead of copying and scanning the
+    full WSGI environ.
+    """
+
+    def __init__(self, request):
+        """
+        :param request: swob.Request instance of the incoming request
+        """
+        # make_env only keeps the whitelisted swift keys, so the transfer
+        # encoding and the X-Vertigo-* headers are stripped here
+        self.base_env = make_env(request.environ, swift_source='Vertigo')
+        self.auth_token = request.headers.get('X-Auth-Token')
+
+    def make_subrequest(self, method, path, headers=None, query_string=None,
+                        body=None):
+        """
+        Makes a subrequest from the base environment
+
+        :param method: subrequest method
+        :param path: swift path of the subrequest
+        :param headers: subrequest headers. By default, only the X-Auth-Token
+                        of the incoming request
+        :param query_string: subrequest query string
+        :param body: subrequest body
+        :returns: swob.Request instance
+        """
+        if headers is None:
+            headers = {'X-Auth-Token': self.auth_token}
+        env = self.base_env
+        if query_string is not None:
+            env = dict(env, QUERY_STRING=query_string)
+        return make_subrequest(env, method, path, body=body, headers=headers,
+                               swift_source='Vertigo')
 
 
 def read_metadata(fd, md_key=None):
@@ -39,15 +94,15 @@ def read_metadata(fd, md_key=None):
     """
     meta_key = SWIFT_METADATA_KEY
 
-    metadata = ''
+    chunks = list()
     key = 0
     try:
         while True:
-            metadata += xattr.getxattr(fd, '%s%s' % (meta_key,
-                                                     (key or '')))
+            chunks.append(xattr.getxattr(fd, '%s%s' % (meta_key,
+                                                       (key or ''))))
             key += 1
     except (IOError, OSError) as e:
-        if metadata == '':
+        if not chunks:
             return False
         for err in 'ENOTSUP', 'EOPNOTSUPP':
             if hasattr(errno, err) and e.errno == getattr(errno, err):
@@ -57,7 +112,7 @@ def read_metadata(fd, md_key=None):
                 raise DiskFileXattrNotSupported(e)
         if e.errno == errno.ENOENT:
             raise DiskFileNotExist()
-    return pickle.loads(metadata)
+    return pickle.loads(''.join(chunks))
 
 
 def write_metadata(fd, metadata, xattr_size=65536, md_key=None):
@@ -106,12 +161,193 @@ def get_object_metadata(data_file):
     return metadata
 
 
+def _raise_xattr_error(fd, e):
+    """
+    Translates an xattr IOError/OSError into the DiskFile exceptions
+    """
+    for err in 'ENOTSUP', 'EOPNOTSUPP':
+        if hasattr(errno, err) and e.errno == getattr(errno, err):
+            msg = "Filesystem at %s does not support xattr" % \
+                  _get_filename(fd)
+            logging.exception(msg)
+            raise DiskFileXattrNotSupported(e)
+    if e.errno in (errno.ENOSPC, errno.EDQUOT):
+        msg = "No space left on device for %s" % _get_filename(fd)
+        logging.exception(msg)
+        raise DiskFileNoSpace()
+    if e.errno == errno.ENOENT:
+        raise DiskFileNotExist()
+    raise
+
+
+def read_metadata_chunks(fd):
+    """
+    Reads all the pickled metadata chunks of an object file, listing its
+    xattrs only once
+
+    :param fd: file descriptor of the object file
+    :returns: list of metadata chunks, in order
+    """
+    try:
+        names = set(xattr.listxattr(fd))
+        chunks = list()
+        key = 0
+        while True:
+            name = '%s%s' % (SWIFT_METADATA_KEY, key or '')
+            if name not in names:
+                return chunks
+            chunks.append(xattr.getxattr(fd, name))
+            key += 1
+    except (IOError, OSError) as e:
+        _raise_xattr_error(fd, e)
+
+
+def write_metadata_chunks(fd, old_chunks, metadata, xattr_size=65536):
+    """
+    Writes pickled metadata to an object file, only setting the chunks that
+    differ from old_chunks, and removing the stale trailing chunks
+
+    :param fd: file descriptor of the object file
+    :param old_chunks: metadata chunks currently stored in the object file
+    :param metadata: metadata to write
+    :returns: list of the metadata chunks stored in the object file
+    """
+    metastr = pickle.dumps(metadata, PICKLE_PROTOCOL)
+    chunks = [metastr[i:i + xattr_size]
+              for i in range(0, len(metastr), xattr_size)]
+    try:
+        for key, chunk in enumerate(chunks):
+            if key >= len(old_chunks) or old_chunks[key] != chunk:
+                xattr.setxattr(fd, '%s%s' % (SWIFT_METADATA_KEY, key or ''),
+                               chunk)
+        for key in range(len(chunks), len(old_chunks)):
+            xattr.removexattr(fd, '%s%s' % (SWIFT_METADATA_KEY, key or ''))
+    except (IOError, OSError) as e:
+        _raise_xattr_error(fd, e)
+
+    return chunks
+
+
+class StatKeyedCache(object):
+    """
+    Bounded LRU cache of values derived from files or directories. Entries
+    are keyed by path and validated against (device, inode, mtime, ctime),
+    so any change of the file invalidates them.
+    """
+
+    def __init__(self, max_size=METADATA_CACHE_SIZE):
+        self.max_size = max_size
+        self.entries = OrderedDict()  # path: (stat_key, value)
+
+    def get(self, path, stat_key):
+        entry = self.entries.pop(path, None)
+        if entry is None or entry[0] != stat_key:
+            return None
+        self.entries[path] = entry
+        return entry[1]
+
+    def put(self, path, stat_key, value):
+        self.entries.pop(path, None)
+        self.entries[path] = (stat_key, value)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, path):
+        self.entries.pop(path, None)
+
+
+def get_stat_key(st):
+    return (st.st_dev, st.st_ino, st.st_mtime, st.st_ctime)
+
+
+# Per-worker caches of the object server
+_data_file_cache = StatKeyedCache()  # data dir: data file
+_metadata_cache = StatKeyedCache()  # data file: (chunks, metadata)
+
+
+def update_object_metadata(data_file, mutate):
+    """
+    Metadata transaction over a data file: the file is opened once, the
+    metadata is read in a single pass, modified in place by mutate, and only
+    the changed chunks are written back. Nothing is written if mutate raises.
+
+    :param data_file: full path of the data file
+    :param mutate: function that receives the metadata dictionary and
+                   modifies it
+    :returns: the updated metadata dictionary
+    """
+    fd = open_data_file(data_file)
+    try:
+        chunks, metadata = _read_cached_metadata(fd, data_file)
+        # The cached dictionary is never modified
+        metadata = copy.deepcopy(metadata)
+        mutate(metadata)
+        chunks = write_metadata_chunks(fd, chunks, metadata)
+        _metadata_cache.put(data_file, get_stat_key(os.fstat(fd)),
+                            (chunks, metadata))
+    finally:
+        close_data_file(fd)
+
+    return metadata
+
+
+def _read_cached_metadata(fd, data_file):
+    stat_key = get_stat_key(os.fstat(fd))
+    cached = _metadata_cache.get(data_file, stat_key)
+    if cached is None:
+        chunks = read_metadata_chunks(fd)
+        if not chunks:
+            raise DiskFileNotExist()
+        cached = (chunks, pickle.loads(''.join(chunks)))
+        _metadata_cache.put(data_file, stat_key, cached)
+    return cached
+
+
+def get_cached_object_metadata(data_file):
+    """
+    Retrieves the swift metadata of a data file through the per-worker
+    metadata cache. The returned dictionary is shared, and must not be
+    modified.
+
+    :param data_file: full path of the data file
+    :returns: dictionary with all swift metadata
+    """
+    fd = open_data_file(data_file)
+    try:
+        return _read_cached_metadata(fd, data_file)[1]
+    finally:
+        close_data_file(fd)
+
+
+def get_missing_pseudo_folders(obj_list, prefix=''):
+    """
+    Gets the pseudo-folders (at any level of the hierarchy) that contain
+    objects of the list but that are not in the list themselves. The list is
+    indexed into a set once, so the lookup cost does not grow with the
+    listing size.
+
+    :param obj_list: object list
+    :param prefix: pseudo-folder listed, or '' for the whole container.
+                   The levels above it are not considered.
+    :returns: sorted list of missing pseudo-folders (parents before children)
+    """
+    listed = set(obj_list)
+    required = set()
+    for obj in obj_list:
+        end = obj.rfind('/')
+        while end > 0 and end >= len(prefix) - 1:
+            pseudo_folder = obj[:end + 1]
+            if pseudo_folder in required:
+                # All the upper levels are already indexed
+                break
+            required.add(pseudo_folder)
+            end = obj.rfind('/', 0, end)
+
+    return sorted(required - listed)
+
+
 def get_container_metadata(vertigo, container):
-    new_env = dict(vertigo.request.environ)
-    auth_token = vertigo.request.headers.get('X-Auth-Token')
-    sub_req = make_subrequest(new_env, 'HEAD', container,
-                              headers={'X-Auth-Token': auth_token},
-                              swift_source='Vertigo')
+    sub_req = vertigo.subrequest_factory.make_subrequest('HEAD', container)
     response = sub_req.get_response(vertigo.app)
     return response.headers
 
@@ -133,19 +369,16 @@ def set_container_metadata(vertigo, metadata):
 
     :param metadata: metadata dictionary
     """
-    memcache = cache_from_env(vertigo.request.environ)
     dest_path = os.path.join('/', vertigo.api_version, vertigo.account, vertigo.container)
     for key in metadata.keys():
         if not key.startswith(SYSMETA_CONTAINER_HEADER):
             del metadata[key]
-    # We store the Vertigo metadata in the memcached server (only 10 minutes)
-    memcache.set("vertigo_"+dest_path, metadata, time=600)
-    new_env = dict(vertigo.request.environ)
-    auth_token = vertigo.request.headers.get('X-Auth-Token')
-    metadata.update({'X-Auth-Token': auth_token})
-    sub_req = make_subrequest(new_env, 'POST', dest_path,
-                              headers=metadata,
-                              swift_source='Vertigo')
+    # The policy of the container is cached by the PolicyStore, which
+    # reloads it once invalidated
+    subrequest_factory = vertigo.subrequest_factory
+    metadata.update({'X-Auth-Token': subrequest_factory.auth_token})
+    sub_req = subrequest_factory.make_subrequest('POST', dest_path,
+                                                 headers=metadata)
     sub_req.get_response(vertigo.app)
 
 
@@ -176,20 +409,7 @@ def verify_access(vertigo, path):
     """
     vertigo.logger.debug('Vertigo - Verify access to %s' % path)
 
-    new_env = dict(vertigo.request.environ)
-    if 'HTTP_TRANSFER_ENCODING' in new_env.keys():
-        del new_env['HTTP_TRANSFER_ENCODING']
-
-    for key in DEFAULT_MD_STRING.keys():
-        env_key = 'HTTP_X_VERTIGO_' + key.upper()
-        if env_key in new_env.keys():
-            del new_env[env_key]
-
-    auth_token = vertigo.request.headers.get('X-Auth-Token')
-    sub_req = make_subrequest(
-        new_env, 'HEAD', path,
-        headers={'X-Auth-Token': auth_token},
-        swift_source='Vertigo')
+    sub_req = vertigo.subrequest_factory.make_subrequest('HEAD', path)
 
     return sub_req.get_response(vertigo.app)
 
@@ -206,31 +426,95 @@ def create_link(vertigo, link_path, dest_path, heads):
     vertigo.logger.debug('Vertigo - Creating link from %s to %s' % (link_path,
                                                                     dest_path))
 
-    new_env = dict(vertigo.request.environ)
-    if 'HTTP_TRANSFER_ENCODING' in new_env.keys():
-        del new_env['HTTP_TRANSFER_ENCODING']
-
-    if 'HTTP_X_COPY_FROM' in new_env.keys():
-        del new_env['HTTP_X_COPY_FROM']
-
-    auth_token = vertigo.request.headers.get('X-Auth-Token')
-
+    subrequest_factory = vertigo.subrequest_factory
+    link = link_path
     link_path = os.path.join('/', vertigo.api_version,
                              vertigo.account, link_path)
 
-    sub_req = make_subrequest(
-        new_env, 'PUT', link_path,
-        headers={'X-Auth-Token': auth_token,
+    sub_req = subrequest_factory.make_subrequest(
+        'PUT', link_path,
+        headers={'X-Auth-Token': subrequest_factory.auth_token,
                  'Content-Length': 0,
                  'Content-Type': 'vertigo/link',
                  'Original-Content-Length': heads["Content-Length"],
-                 'X-Object-Sysmeta-Vertigo-Link-to': dest_path},
-        swift_source='Vertigo')
+                 'X-Object-Sysmeta-Vertigo-Link-to': dest_path})
     resp = sub_req.get_response(vertigo.app)
 
+    if resp.is_success:
+        cache_link(vertigo, link, dest_path, heads)
+    else:
+        invalidate_link(vertigo, link)
+
     return resp
 
 
+def _get_link_cache_key(vertigo, link):
+    return LINK_CACHE_PREFIX + os.path.join(vertigo.account, link)
+
+
+def cache_link(vertigo, link, dest_path, heads):
+    """
+    Stores the link target, and its ETag and size, in the link cache. The
+    ETag is checked when the target is got directly, so that an entry is
+    dropped once its target is overwritten
+
+    :param vertigo: swift_vertigo.vertigo_handler.VertigoProxyHandler instance
+    :param link: container/object of the link
+    :param dest_path: container/object of the target
+    :param heads: target object headers
+    """
+    link_md = {'target': dest_path,
+               'etag': heads.get('Etag'),
+               'size': heads.get('Content-Length')}
+    vertigo.memcache.set(_get_link_cache_key(vertigo, link), link_md,
+                         time=LINK_CACHE_TIME)
+
+
+def invalidate_link(vertigo, link):
+    """
+    Removes a link from the link cache
+
+    :param vertigo: swift_vertigo.vertigo_handler.VertigoProxyHandler instance
+    :param link: container/object of the link
+    """
+    vertigo.memcache.delete(_get_link_cache_key(vertigo, link))
+
+
+def get_cached_link(vertigo, link):
+    """
+    Gets the link cache entry of an object
+
+    :param vertigo: swift_vertigo.vertigo_handler.VertigoProxyHandler instance
+    :param link: container/object of the link
+    :returns: dictionary with the target, etag and size, or None
+    """
+    return vertigo.memcache.get(_get_link_cache_key(vertigo, link))
+
+
+def get_cached_link_target(vertigo, link):
+    """
+    Resolves a (multi-hop) link chain through the link cache
+
+    :param vertigo: swift_vertigo.vertigo_handler.VertigoProxyHandler instance
+    :param link: container/object of the link
+    :returns: (target, etag) tuple: container/object and ETag of the last
+              known target, or (None, None) if the object is not a known link
+              or the cached chain has a cycle
+    """
+    visited = set([link])
+    target = etag = None
+    link_md = get_cached_link(vertigo, link)
+    while link_md:
+        target = link_md['target']
+        etag = link_md.get('etag')
+        if target in visited or len(visited) > MAX_LINK_HOPS:
+            return None, None
+        visited.add(target)
+        link_md = get_cached_link(vertigo, target)
+
+    return target, etag
+
+
 def get_data_dir(vertigo):
     """
     Gets the data directory full path
@@ -257,11 +541,27 @@ def get_data_file(vertigo):
     :returns: the data file path
     """
     data_dir = get_data_dir(vertigo)
-    files = os.listdir(data_dir)
+    stat_key = get_stat_key(os.stat(data_dir))
+    data_file = _data_file_cache.get(data_dir, stat_key)
+    if data_file is None:
+        data_file = _find_data_file(data_dir)
+        if data_file:
+            _data_file_cache.put(data_dir, stat_key, data_file)
+
+    return data_file
+
 
-    for swift_file in files:
-        if swift_file.endswith(".data"):
-            return os.path.join(data_dir, swift_file)
+def _find_data_file(data_dir):
+    if scandir is None:
+        for swift_file in os.listdir(data_dir):
+            if swift_file.endswith(".data"):
+                return os.path.join(data_dir, swift_file)
+        return None
+
+    for entry in scandir(data_dir):
+        if entry.name.endswith(".data"):
+            return entry.path
+    return None
 
 
 def open_data_file(data_file):
@@ -299,30 +599,20 @@ def set_microcontroller_container(vertigo, trigger, mc):
     # 1st: set microcontroller name to list
     metadata = get_container_metadata(vertigo, container)
     try:
-        mc_dict = get_microcontroller_dict_container(metadata)
+        table = load_trigger_table(metadata, SYSMETA_CONTAINER_HEADER) or \
+            TriggerTable()
     except:
         raise ValueError('Vertigo - ERROR: There was an error getting trigger'
                          ' dictionary from the object.\n')
 
-    if not mc_dict:
-        mc_dict = DEFAULT_MD_STRING
-    if not mc_dict[trigger]:
-        mc_dict[trigger] = list()
-    if mc not in mc_dict[trigger]:
-        mc_dict[trigger].append(mc)
-
     # 2nd: Get microcontroller specific metadata
     specific_md = vertigo.request.body.rstrip()
 
     # 3rd: Assign all metadata to the container
     try:
-        metadata[VERTIGO_MC_HEADER_CONTAINER] = mc_dict
-        sysmeta_key = (SYSMETA_CONTAINER_HEADER + trigger + '-' + mc).title()
-        if specific_md:
-            metadata[sysmeta_key] = specific_md
-        else:
-            if sysmeta_key in metadata:
-                del metadata[sysmeta_key]
+        table.add(trigger, mc, specific_md)
+        store_trigger_table(metadata, table, SYSMETA_CONTAINER_HEADER, '')
+        stamp_policy_version(metadata, SYSMETA_CONTAINER_HEADER)
         set_container_metadata(vertigo, metadata)
     except:
         raise ValueError('Vertigo - ERROR: There was an error setting trigger'
@@ -344,43 +634,21 @@ def delete_microcontroller_container(vertigo, trigger, mc):
     container = os.path.join('/', vertigo.api_version, vertigo.account, vertigo.container)
     metadata = get_container_metadata(vertigo, container)
     try:
-        mc_dict = get_microcontroller_dict_container(metadata)
+        table = load_trigger_table(metadata, SYSMETA_CONTAINER_HEADER)
     except:
         raise ValueError('Vertigo - ERROR: There was an error getting trigger'
                          ' metadata from the object.\n')
 
     try:
         if trigger == "vertigo" and mc == "all":
-            for key in metadata.keys():
-                if key.startswith(SYSMETA_CONTAINER_HEADER):
-                    del metadata[key]
+            table = None
+        elif table:
+            table.remove(trigger, mc)
         else:
-            if metadata[VERTIGO_MC_HEADER_CONTAINER]:
-                if isinstance(metadata[VERTIGO_MC_HEADER_CONTAINER], dict):
-                    mc_dict = metadata[VERTIGO_MC_HEADER_CONTAINER]
-                else:
-                    mc_dict = eval(metadata[VERTIGO_MC_HEADER_CONTAINER])
-
-                if mc == 'all':
-                    mc_list = mc_dict[trigger]
-                    mc_dict[trigger] = None
-                    for mc_k in mc_list:
-                        sysmeta_key = (SYSMETA_CONTAINER_HEADER + trigger + '-' + mc_k).title()
-                        if sysmeta_key in metadata:
-                            metadata[sysmeta_key] = ''
-                elif mc in mc_dict[trigger]:
-                    mc_dict[trigger].remove(mc)
-                    sysmeta_key = (SYSMETA_CONTAINER_HEADER + trigger + '-' + mc).title()
-                    if sysmeta_key in metadata:
-                        metadata[sysmeta_key] = ''
-                else:
-                    raise
-
-                metadata[VERTIGO_MC_HEADER_CONTAINER] = mc_dict
-                metadata = clean_microcontroller_dict_container(metadata)
-            else:
-                raise
+            raise ValueError()
 
+        store_trigger_table(metadata, table, SYSMETA_CONTAINER_HEADER, '')
+        stamp_policy_version(metadata, SYSMETA_CONTAINER_HEADER)
         set_container_metadata(vertigo, metadata)
     except:
         pass
@@ -398,37 +666,30 @@ def set_microcontroller_object(vertigo, trigger, mc):
     :param mc: microcontroller name
     :raises HTTPInternalServerError: If it fails
     """
-
-    # 1st: set microcontroller name to list
-    try:
-        mc_dict = get_microcontroller_dict_object(vertigo)
-    except:
-        raise ValueError('Vertigo - ERROR: There was an error getting trigger'
-                         ' dictionary from the object.\n')
-
-    if not mc_dict:
-        mc_dict = DEFAULT_MD_STRING
-    if not mc_dict[trigger]:
-        mc_dict[trigger] = list()
-    if mc not in mc_dict[trigger]:
-        mc_dict[trigger].append(mc)
-
-    # 2nd: Set microcontroller specific metadata
+    # Microcontroller specific metadata
     specific_md = vertigo.request.body.rstrip()
+    reference, policy = get_forwarded_policy(vertigo.request)
 
-    # 3rd: Assign all metadata to the object
-    try:
-        data_file = get_data_file(vertigo)
-        metadata = get_object_metadata(data_file)
-        metadata[VERTIGO_MC_HEADER_OBJ] = mc_dict
-        sysmeta_key = (SYSMETA_OBJ_HEADER + trigger + '-' + mc).title()
-        if specific_md:
-            metadata[sysmeta_key] = specific_md
-        else:
-            if sysmeta_key in metadata:
-                del metadata[sysmeta_key]
+    def assign_microcontroller(metadata):
+        # 1st: set microcontroller name to list
+        try:
+            table = load_trigger_table(metadata, SYSMETA_OBJ_HEADER) or \
+                TriggerTable()
+        except:
+            raise ValueError('Vertigo - ERROR: There was an error getting '
+                             'trigger dictionary from the object.\n')
+
+        # 2nd: Assign all metadata to the object. The trigger is
+        # overridden, starting from the inherited microcontrollers.
+        _override_inherited_trigger(vertigo, metadata, table, trigger,
+                                    reference, policy)
+        table.add(trigger, mc, specific_md)
+        store_trigger_table(metadata, table, SYSMETA_OBJ_HEADER)
 
-        set_object_metadata(data_file, metadata)
+    try:
+        update_object_metadata(get_data_file(vertigo), assign_microcontroller)
+    except ValueError:
+        raise
     except:
         raise ValueError('Vertigo - ERROR: There was an error setting trigger'
                          ' dictionary from the object.\n')
@@ -448,86 +709,77 @@ def delete_microcontroller_object(vertigo, trigger, mc):
 
     try:
         data_file = get_data_file(vertigo)
-        metadata = get_object_metadata(data_file)
     except:
         raise ValueError('Vertigo - ERROR: There was an error getting trigger'
                          ' metadata from the object.\n')
 
-    try:
+    reference, policy = get_forwarded_policy(vertigo.request)
+
+    def remove_microcontroller(metadata):
         if trigger == "vertigo" and mc == "all":
+            inherited = reference and inherits_policy(
+                metadata, SYSMETA_OBJ_HEADER,
+                parse_policy_reference(reference)[0])
             for key in metadata.keys():
                 if key.startswith(SYSMETA_OBJ_HEADER):
                     del metadata[key]
-        else:
-            if metadata[VERTIGO_MC_HEADER_OBJ]:
-                if isinstance(metadata[VERTIGO_MC_HEADER_OBJ], dict):
-                    mc_dict = metadata[VERTIGO_MC_HEADER_OBJ]
-                else:
-                    mc_dict = eval(metadata[VERTIGO_MC_HEADER_OBJ])
-                if mc == 'all':
-                    mc_list = mc_dict[trigger]
-                    mc_dict[trigger] = None
-                    for mc_k in mc_list:
-                        sysmeta_key = (SYSMETA_OBJ_HEADER + trigger + '-' + mc_k).title()
-                        if sysmeta_key in metadata:
-                            del metadata[sysmeta_key]
-                elif mc in mc_dict[trigger]:
-                    mc_dict[trigger].remove(mc)
-                    sysmeta_key = (SYSMETA_OBJ_HEADER + trigger + '-' + mc).title()
-                    if sysmeta_key in metadata:
-                        del metadata[sysmeta_key]
-                else:
-                    raise
-                metadata[VERTIGO_MC_HEADER_OBJ] = mc_dict
-                metadata = clean_microcontroller_dict_object(metadata)
-            else:
-                raise
-        set_object_metadata(data_file, metadata)
+            if inherited:
+                # Override all the inherited triggers with empty lists
+                table = TriggerTable()
+                for trigger_k in TRIGGERS:
+                    table.remove(trigger_k, 'all', keep_empty=True)
+                metadata[SYSMETA_OBJ_HEADER + POLICY_KEY] = reference
+                store_trigger_table(metadata, table, SYSMETA_OBJ_HEADER)
+            _stamp_pseudo_folder(vertigo, metadata)
+            return
+
+        table = load_trigger_table(metadata, SYSMETA_OBJ_HEADER) or \
+            TriggerTable()
+        inherited = _override_inherited_trigger(vertigo, metadata, table,
+                                                trigger, reference, policy)
+        table.remove(trigger, mc, keep_empty=inherited)
+        store_trigger_table(metadata, table, SYSMETA_OBJ_HEADER)
+
+    try:
+        update_object_metadata(data_file, remove_microcontroller)
     except:
         raise ValueError('Vertigo - Error: Microcontroller "' + mc + '" not'
                          ' assigned to the "' + trigger + '" trigger.\n')
 
-    data_dir = get_data_dir(vertigo)
-    vertigo.logger.debug('Vertigo - Object path: ' + data_dir)
+    vertigo.logger.debug('Vertigo - Object path: ' + data_file)
 
 
-def clean_microcontroller_dict_object(metadata):
+def stamp_policy_version(metadata, sysmeta_prefix):
     """
-    Auxiliary function that cleans the microcontroller dictionary, deleting
-    empty lists for each trigger, and deleting all dictionary whether all
-    values are None.
-
-    :param microcontroller_dict: microcontroller dictionary
-    :returns microcontroller_dict: microcontroller dictionary
+    Sets a new version to the policy of a container or pseudo-folder, after
+    changing its triggers
     """
-    for trigger in metadata[VERTIGO_MC_HEADER_OBJ].keys():
-        if not metadata[VERTIGO_MC_HEADER_OBJ][trigger]:
-            metadata[VERTIGO_MC_HEADER_OBJ][trigger] = None
+    metadata[sysmeta_prefix + POLICY_VERSION_KEY] = \
+        Timestamp(time.time()).internal
 
-    if all(value is None for value in metadata[VERTIGO_MC_HEADER_OBJ].values()):
-        del metadata[VERTIGO_MC_HEADER_OBJ]
 
-    return metadata
+def _stamp_pseudo_folder(vertigo, metadata):
+    if vertigo.obj.endswith('/'):
+        stamp_policy_version(metadata, SYSMETA_OBJ_HEADER)
 
 
-def clean_microcontroller_dict_container(metadata):
+def _override_inherited_trigger(vertigo, metadata, table, trigger,
+                                reference, policy):
     """
-    Auxiliary function that cleans the microcontroller dictionary, deleting
-    empty lists for each trigger, and deleting all dictionary whether all
-    values are None.
+    Prepares the trigger table of an object to override one trigger: the
+    microcontrollers inherited from the policy are copied into the table, and
+    the object keeps its policy reference for the other triggers
 
-    :param microcontroller_dict: microcontroller dictionary
-    :returns microcontroller_dict: microcontroller dictionary
+    :returns: whether the object inherits the policy
     """
-    mc_dict = eval(metadata[VERTIGO_MC_HEADER_CONTAINER])
-    for trigger in mc_dict.keys():
-        if not mc_dict[trigger]:
-            mc_dict[trigger] = None
-
-    if all(value is None for value in mc_dict.values()):
-        metadata[VERTIGO_MC_HEADER_CONTAINER] = ''
-
-    return metadata
+    _stamp_pseudo_folder(vertigo, metadata)
+    if not reference or not inherits_policy(
+            metadata, SYSMETA_OBJ_HEADER, parse_policy_reference(reference)[0]):
+        return False
+    if not metadata.get(SYSMETA_OBJ_HEADER + POLICY_KEY):
+        metadata[SYSMETA_OBJ_HEADER + POLICY_KEY] = reference
+    table.inherit(policy, trigger)
+    return True
 
 
 def get_microcontroller_dict_object(vertigo):
@@ -540,15 +792,20 @@ def get_microcontroller_dict_object(vertigo):
     :returns: microcontroller dictionary
     """
     data_file = get_data_file(vertigo)
-    metadata = get_object_metadata(data_file)
+    metadata = get_cached_object_metadata(data_file)
 
-    if VERTIGO_MC_HEADER_OBJ in metadata:
-        if isinstance(metadata[VERTIGO_MC_HEADER_OBJ], dict):
-            return metadata[VERTIGO_MC_HEADER_OBJ]
-        else:
-            return eval(metadata[VERTIGO_MC_HEADER_OBJ])
-    else:
-        return None
+    return get_microcontroller_dict_from_metadata(metadata)
+
+
+def get_microcontroller_dict_from_metadata(metadata):
+    """
+    Gets the microcontroller dictionary from the swift metadata of an object
+
+    :param metadata: swift metadata dictionary of the object
+    :returns: microcontroller dictionary
+    """
+    table = load_trigger_table(metadata, SYSMETA_OBJ_HEADER)
+    return table.to_dict() if table else None
 
 
 def get_microcontroller_dict_container(metadata):
@@ -557,19 +814,15 @@ def get_microcontroller_dict_container(metadata):
     This method retrieves a dictionary with all triggers and all
     microcontrollers associated to each trigger.
 
-    :param vertigo: swift_vertigo.vertigo_handler.VertigoProxyHandler instance
+    :param metadata: container metadata
     :returns: microcontroller dictionary
     """
-    if VERTIGO_MC_HEADER_CONTAINER in metadata:
-        if isinstance(metadata[VERTIGO_MC_HEADER_CONTAINER], dict):
-            return metadata[VERTIGO_MC_HEADER_CONTAINER]
-        else:
-            return eval(metadata[VERTIGO_MC_HEADER_CONTAINER])
-    else:
-        return None
+    table = load_trigger_table(metadata, SYSMETA_CONTAINER_HEADER)
+    return table.to_dict() if table else None
 
 
-def get_microcontroller_list_object(headers, method):
+def get_microcontroller_list_object(headers, method, policy_id=None,
+                                    policy=None):
     """
     Gets the list of associated microcontrollers to the requested object.
     This method gets the microcontroller dictionary from the object headers,
@@ -578,15 +831,12 @@ def get_microcontroller_list_object(headers, method):
 
     :param headers: response headers of the object
     :param method: current method
+    :param policy_id: id of the policy inherited from the parent
+    :param policy: TriggerTable instance of the inherited policy
     :returns: microcontroller list associated to the type of the request
     """
-    if headers[VERTIGO_MC_HEADER_OBJ]:
-        if isinstance(headers[VERTIGO_MC_HEADER_OBJ], dict):
-            microcontroller_dict = headers[VERTIGO_MC_HEADER_OBJ]
-        else:
-            microcontroller_dict = eval(headers[VERTIGO_MC_HEADER_OBJ])
-        mc_list = microcontroller_dict["on" + method]
-    else:
-        mc_list = None
-
-    return mc_list
+    table = get_effective_table(headers, SYSMETA_OBJ_HEADER, policy_id,
+                                policy)
+    if table:
+        return table.get_list("on" + method)
+    return None
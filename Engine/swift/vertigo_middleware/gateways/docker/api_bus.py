@@ -0,0 +1,132 @@
+from eventlet.green import socket
+from eventlet.timeout import Timeout
+from vertigo_middleware.common.utils import SubrequestFactory
+from urllib import quote
+import eventlet
+import json
+
+
+API_METHODS = ('HEAD', 'POST', 'PUT', 'DELETE')
+
+# Headers that the microcontrollers can send. The subrequests enter below
+# the gatekeeper, so nothing else (sysmeta, backend headers) is trusted.
+API_HEADER_PREFIXES = ('x-object-meta-', 'x-vertigo-on')
+API_HEADERS = frozenset(['x-copy-from', 'x-vertigo-link-to',
+                         'x-vertigo-prefetch'])
+# Set in the environ of the subrequests of the API calls
+API_BUS_ENV_KEY = 'vertigo.api_bus'
+
+
+def is_api_header(key):
+    key = key.lower()
+    return key in API_HEADERS or key.startswith(API_HEADER_PREFIXES)
+
+
+def is_private_header(key):
+    """
+    Headers never returned to the microcontrollers
+    """
+    key = key.lower()
+    return '-sysmeta-' in key or key.startswith('x-backend-') or \
+        key == 'mc-enabled'
+
+
+class ApiBus(object):
+    """
+    Serves the Swift API calls of the microcontrollers of an invocation. The
+    remote end of a socket pair is sent to the sandbox with the invocation,
+    and each call is a JSON line with the method, the object (relative to
+    the account of the request), the headers and the body. The calls run as
+    in-process subrequests of the request that triggered the
+    microcontrollers, through the Vertigo middleware, so they keep its
+    authorization. Only the API headers are forwarded, and no private
+    headers are returned. Each one is answered with a JSON line with the
+    status and the headers of the response.
+    """
+
+    def __init__(self, app, request, api_version, account, logger, timeout):
+        """
+        :param app: WSGI application of the Vertigo middleware
+        :param request: swob.Request instance that triggered the
+                        microcontrollers
+        :param timeout: seconds to serve the calls of the invocation
+        """
+        self.app = app
+        self.api_version = api_version
+        self.account = account
+        self.logger = logger
+        self.timeout = timeout
+        self.subrequest_factory = SubrequestFactory(request)
+        self.local_sock, self.remote_sock = socket.socketpair()
+        self.server = None
+
+    def get_remote_fd(self):
+        return self.remote_sock.fileno()
+
+    def start(self):
+        self.server = eventlet.spawn(self._serve)
+
+    def close(self):
+        """
+        Closes the local copy of the remote end, once sent. The calls are
+        served until the sandbox closes its copy.
+        """
+        self.remote_sock.close()
+        if self.server is None:
+            self.local_sock.close()
+
+    def _serve(self):
+        fp = self.local_sock.makefile('rb')
+        try:
+            with Timeout(self.timeout):
+                # The sandbox closes its end after the microcontrollers
+                for line in iter(fp.readline, ''):
+                    try:
+                        response = self._execute(line)
+                    except Exception:
+                        # A failed call does not end the bus
+                        self.logger.exception('Vertigo - Error serving a '
+                                              'microcontroller API call')
+                        response = {'status': 500, 'headers': {}}
+                    self.local_sock.sendall(json.dumps(response) + '\n')
+        except Timeout:
+            self.logger.error('Vertigo - Timeout serving the microcontroller '
+                              'API calls')
+        except Exception:
+            self.logger.exception('Vertigo - Error serving the '
+                                  'microcontroller API calls')
+        finally:
+            fp.close()
+            self.local_sock.close()
+
+    def _execute(self, line):
+        try:
+            call = json.loads(line)
+            method = str(call['method'].upper())
+            path = '/%s/%s/%s' % (self.api_version, self.account,
+                                  call['object'])
+            headers = dict(
+                (key.encode('utf-8'), value.encode('utf-8'))
+                for key, value in (call.get('headers') or {}).items()
+                if is_api_header(key))
+            body = (call.get('body') or '').encode('utf-8')
+        except (ValueError, KeyError, AttributeError, UnicodeError):
+            return {'status': 400, 'headers': {}}
+        if method not in API_METHODS:
+            return {'status': 405, 'headers': {}}
+
+        headers['X-Auth-Token'] = self.subrequest_factory.auth_token
+        sub_req = self.subrequest_factory.make_subrequest(
+            method, quote(path.encode('utf-8')), headers=headers, body=body)
+        sub_req.environ[API_BUS_ENV_KEY] = True
+        response = sub_req.get_response(self.app)
+        # Drains the body, so the subrequest is finished
+        for _ in response.app_iter or []:
+            pass
+        if hasattr(response.app_iter, 'close'):
+            response.app_iter.close()
+        self.logger.increment('vertigo.api_bus.calls')
+        return {'status': response.status_int,
+                'headers': dict((key, value) for key, value
+                                in response.headers.items()
+                                if not is_private_header(key))}
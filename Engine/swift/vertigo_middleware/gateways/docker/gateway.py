@@ -1,13 +1,20 @@
 from vertigo_middleware.common.utils import make_swift_request, \
-    set_object_metadata, get_object_metadata
+    set_object_metadata, get_object_metadata, SYSMETA_OBJ_HEADER
+from vertigo_middleware.common.triggers import expand_trigger_parameters
 from vertigo_middleware.gateways.docker.runtime import RunTimeSandbox, \
     VertigoInvocationProtocol
+from vertigo_middleware.gateways.docker.api_bus import ApiBus
+from swift.common.utils import config_true_value
 from shutil import copy2
+import tempfile
 import os
 
 
 MC_MAIN_HEADER = "X-Object-Meta-Microcontroller-Main"
 MC_DEP_HEADER = "X-Object-Meta-Microcontroller-Library-Dependency"
+# Access of a microcontroller to the object data: 'full', 'sample' (the
+# first mc_data_sample_size bytes) or none
+MC_DATA_HEADER = "X-Object-Meta-Microcontroller-Data-Access"
 
 
 class VertigoGatewayDocker():
@@ -29,7 +36,8 @@ class VertigoGatewayDocker():
         self.pipe_path = os.path.join(conf["pipes_dir"], self.scope)
         self.mc_pipe_path = os.path.join(self.pipe_path, conf["mc_pipe"])
 
-    def execute_microcontrollers(self, mc_list):
+    def execute_microcontrollers(self, mc_list, trigger_table=None,
+                                 data_file=None, start_sandbox=True):
         """
         Exeutes the microcontroller list.
          1. Starts the docker container (sandbox).
@@ -37,26 +45,127 @@ class VertigoGatewayDocker():
          4. Executes the microcontroller list.
 
         :param mc_list: microcontroller list
+        :param trigger_table: effective TriggerTable of the object, with the
+                              inherited microcontrollers
+        :param data_file: data file of the object, in the object servers
+        :param start_sandbox: False if the caller already started it
         :returns: response from the microcontrollers
         """
-        RunTimeSandbox(self.logger, self.conf, self.account).start()
+        if start_sandbox:
+            RunTimeSandbox(self.logger, self.conf, self.account).start()
 
         mc_metadata = self._get_microcontroller_metadata(mc_list)
-        object_headers = self._get_object_headers()
-
-        protocol = VertigoInvocationProtocol(self.mc_pipe_path,
-                                             self.logger_path,
-                                             dict(self.request.headers),
-                                             object_headers,
-                                             mc_list,
-                                             mc_metadata,
-                                             self.mc_timeout,
-                                             self.logger)
-        return protocol.communicate()
-
-    def _get_object_headers(self):
+        object_headers = self._get_object_headers(trigger_table)
+
+        mc_data = data_fds = None
+        if data_file:
+            mc_data, data_fds = self._open_data_files(mc_metadata, data_file)
+        api_bus = self._get_api_bus()
+        try:
+            if api_bus:
+                api_bus.start()
+            protocol = VertigoInvocationProtocol(self.mc_pipe_path,
+                                                 self.logger_path,
+                                                 dict(self.request.headers),
+                                                 object_headers,
+                                                 mc_list,
+                                                 mc_metadata,
+                                                 self.mc_timeout,
+                                                 self.logger,
+                                                 mc_data,
+                                                 api_bus.get_remote_fd()
+                                                 if api_bus else None)
+            return protocol.communicate()
+        finally:
+            for data_fd in data_fds or []:
+                os.close(data_fd)
+            if api_bus:
+                # Only the sandbox keeps the remote end, until the
+                # microcontrollers end
+                api_bus.close()
+
+    def _get_api_bus(self):
+        """
+        :returns: ApiBus instance, or None if the microcontrollers use the
+                  HTTP API (object servers, timers, background invocations
+                  or api_bus disabled)
+        """
+        app = self.conf.get('vertigo_app')
+        if app is None or \
+                not config_true_value(self.conf.get('api_bus', True)):
+            return None
+        if 'swift.authorize' not in self.request.environ:
+            # Background invocations (deferred jobs) have no authorized
+            # request to run the calls as
+            return None
+        api_version = self.request.path.split('/')[1]
+        return ApiBus(app, self.request, api_version, self.account,
+                      self.logger, float(self.conf.get('api_bus_timeout', 60)))
+
+    def _open_data_files(self, mc_metadata, data_file):
+        """
+        Opens the object data for the microcontrollers that declare access
+        to it. A 'full' microcontroller gets a read-only fd of the data file
+        itself, so the data is read (or mapped) without copies or requests.
+        A 'sample' microcontroller gets a read-only copy of the first
+        mc_data_sample_size bytes, so it can not read past them. The data
+        can only reach the client through the verdict, as any other
+        decision.
+
+        :returns: (dict of microcontroller: (fd, (offset, length)), list of
+                  the opened fds)
+        """
+        access = dict((mc_name, metadata.get(MC_DATA_HEADER, '').lower())
+                      for mc_name, metadata in mc_metadata.items())
+        mc_data = dict()
+        fds = list()
+        if not set(access.values()) & set(['full', 'sample']):
+            return mc_data, fds
+        try:
+            data_fd = os.open(data_file, os.O_RDONLY)
+        except OSError:
+            # Replaced or deleted meanwhile
+            return mc_data, fds
+        fds.append(data_fd)
+        size = os.fstat(data_fd).st_size
+
+        sample = None
+        for mc_name, level in access.items():
+            if level == 'full':
+                mc_data[mc_name] = (data_fd, (0, size))
+            elif level == 'sample':
+                if sample is None:
+                    sample = self._copy_sample(data_fd, size)
+                    fds.append(sample[0])
+                mc_data[mc_name] = sample
+        return mc_data, fds
+
+    def _copy_sample(self, data_fd, size):
+        """
+        :returns: (read-only fd of an unlinked copy of the sample,
+                   (0, sample size))
+        """
+        remaining = min(size, int(self.conf.get('mc_data_sample_size',
+                                                65536)))
+        tmp_fd, tmp_path = tempfile.mkstemp()
+        try:
+            sample_fd = os.open(tmp_path, os.O_RDONLY)
+            os.unlink(tmp_path)
+            length = 0
+            while remaining > 0:
+                chunk = os.read(data_fd, min(remaining, 65536))
+                if not chunk:
+                    break
+                os.write(tmp_fd, chunk)
+                remaining -= len(chunk)
+                length += len(chunk)
+        finally:
+            os.close(tmp_fd)
+        return sample_fd, (0, length)
+
+    def _get_object_headers(self, trigger_table=None):
         headers = dict()
-        if self.method == "get":
+        if self.method in ("get", "delete", "timer"):
             headers = self.response.headers
         elif self.method == "put":
             if 'Content-Length' in self.request.headers:
@@ -67,10 +176,15 @@ class VertigoGatewayDocker():
                 if header.startswith('X-Object'):
                     headers[header] = self.request.headers[header]
 
+        if self.method in ("put", "delete"):
+            # Client requests: the proxy only sets it for the object servers
             referer = self.request.method+' '+self.request.host_url+self.request.path_info
             self.request.headers['Referer'] = referer  # Needed for the mc_engine
 
-        return headers
+        # The mc_engine reads the parameters of each microcontroller from
+        # its own sysmeta header
+        return expand_trigger_parameters(headers, SYSMETA_OBJ_HEADER,
+                                         trigger_table)
 
     def _update_local_cache_from_swift(self, swift_container, object_name):
         """
@@ -12,6 +12,9 @@ SBUS_FD_INPUT_OBJECT = 0
 SBUS_FD_OUTPUT_OBJECT = 1
 SBUS_FD_OUTPUT_OBJECT_METADATA = 2
 SBUS_FD_LOGGER = 4
+# The SBus facade of the sandbox only knows the storlets fd types, so the
+# API bus travels as the (otherwise unused) output metadata fd
+SBUS_FD_API = SBUS_FD_OUTPUT_OBJECT_METADATA
 
 SBUS_CMD_EXECUTE = 1
 
@@ -153,7 +156,13 @@ class MicroController(object):
 class VertigoInvocationProtocol(object):
 
     def __init__(self, mc_pipe_path, mc_logger_path, req_headers,
-                 object_headers, mc_list, mc_metadata, timeout, logger):
+                 object_headers, mc_list, mc_metadata, timeout, logger,
+                 mc_data=None, api_fd=None):
+        """
+        :param mc_data: dict of microcontroller: (read-only fd, (offset,
+                        length)) of the object data that it can read
+        :param api_fd: remote end of the API bus, if any
+        """
         self.logger = logger
         self.mc_pipe_path = mc_pipe_path
         self.mc_logger_path = mc_logger_path
@@ -162,6 +171,8 @@ class VertigoInvocationProtocol(object):
         self.object_md = object_headers
         self.mc_list = mc_list  # Ordered microcontroller execution list
         self.mc_md = mc_metadata  # Microcontroller metadata
+        self.mc_data = mc_data or dict()
+        self.api_fd = api_fd
         self.microcontrollers = list()  # Microcontroller object list
 
         # remote side file descriptors and their metadata lists
@@ -207,6 +218,25 @@ class VertigoInvocationProtocol(object):
         md['json_md'] = json.dumps(headers)
         self.fdmd.append(md)
 
+    def _add_object_data(self):
+        for mc_name in self.mc_list:
+            if mc_name not in self.mc_data:
+                continue
+            data_fd, (offset, length) = self.mc_data[mc_name]
+            self.fds.append(data_fd)
+            md = dict()
+            md['type'] = SBUS_FD_INPUT_OBJECT
+            md['microcontroller'] = mc_name
+            md['data_offset'] = str(offset)
+            md['data_length'] = str(length)
+            self.fdmd.append(md)
+
+    def _add_api_bus(self):
+        self.fds.append(self.api_fd)
+        md = dict()
+        md['type'] = SBUS_FD_API
+        self.fdmd.append(md)
+
     def _prepare_invocation_descriptors(self):
         # Add the response stream
         self.response_read_fd, self.response_write_fd = os.pipe()
@@ -216,12 +246,20 @@ class VertigoInvocationProtocol(object):
         self._add_object_req_md()
         # Add output pipe
         self._add_output_stream()
+        # Add the object data and the API bus, before the loggers that
+        # start the microcontrollers
+        self._add_object_data()
+        if self.api_fd is not None:
+            self._add_api_bus()
         # Add the loggers
         self._add_logger_stream()
 
     def _close_remote_side_descriptors(self):
         if self.response_write_fd:
             os.close(self.response_write_fd)
+        if self.null_write_fd:
+            os.close(self.null_write_fd)
+            os.close(self.null_read_fd)
 
     def _invoke(self):
         dtg = Datagram()
@@ -271,7 +309,7 @@ class VertigoInvocationProtocol(object):
                 out_data['command'] = command
                 if 'list' not in out_data:
                     out_data['list'] = dict()
-                for k in sorted(mc_response[mc_name]['list']):
+                for k in sorted(mc_response[mc_name]['list'], key=int):
                     new_key = len(out_data['list'])
                     out_data['list'][new_key] = mc_response[mc_name]['list'][k]
             if command == 'CONTINUE':
@@ -293,16 +331,20 @@ class VertigoInvocationProtocol(object):
 
         self._prepare_invocation_descriptors()
 
+        # The invocation can be killed while it waits for the response
+        # (e.g. a speculative GET whose backend request failed)
         try:
-            self._invoke()
-        except Exception as e:
-            raise e
+            try:
+                self._invoke()
+            except Exception as e:
+                raise e
+            finally:
+                self._close_remote_side_descriptors()
+                for mc in self.microcontrollers:
+                    mc.close()
+
+            out_data = self._read_response()
         finally:
-            self._close_remote_side_descriptors()
-            for mc in self.microcontrollers:
-                mc.close()
-
-        out_data = self._read_response()
-        os.close(self.response_read_fd)
+            os.close(self.response_read_fd)
 
         return out_data
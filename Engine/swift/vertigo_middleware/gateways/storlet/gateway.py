@@ -1,8 +1,13 @@
 from swift.common.swob import Request, HTTPUnauthorized
-from swift.common.utils import config_true_value
+from swift.common.utils import config_true_value, cache_from_env
 from storlet_middleware.handlers.base import SwiftFileManager
 import json
+import os
 
+from vertigo_middleware.common.placement import ObservedIter, \
+    AUTO_SERVER, BACKEND_PROXY_LOAD_HEADER, PLAN_HEADER
+from vertigo_middleware.common.ranges import RangeSafePipeline
+from vertigo_middleware.common.storlet_cache import make_storlet_cache_key
 from vertigo_middleware.common.utils import make_swift_request
 
 
@@ -90,32 +95,46 @@ class VertigoGatewayStorlet():
                 params[key[len('X-Object-Meta-Storlet-'):]] = headers[key]
         return params
 
-    def _verify_access_to_storlet(self, storlet):
+    def _verify_access_to_storlet(self, storlet, memcache=None):
         """
         Verify access to the storlet object
         :params storlet: storlet name
+        :params memcache: memcache client, if available
         :return: is accessible
         :raises HTTPUnauthorized: If it fails to verify access
         """
-        spath = '/'.join(['', self.api_version, self.account,
-                          self.storlet_container, storlet])
-        self.logger.debug('Verify access to %s' % spath)
-
-        resp = make_swift_request("HEAD", self.account,
-                                  self.storlet_container,
-                                  storlet)
-
-        if not resp.is_success:
+        metadata_cache = self.conf.get('storlet_metadata_cache')
+        metadata = None
+        if metadata_cache is not None:
+            metadata = metadata_cache.get(self.account, storlet, memcache)
+
+        if metadata is None:
+            spath = '/'.join(['', self.api_version, self.account,
+                              self.storlet_container, storlet])
+            self.logger.debug('Verify access to %s' % spath)
+
+            resp = make_swift_request("HEAD", self.account,
+                                      self.storlet_container,
+                                      storlet)
+
+            metadata = False
+            if resp.is_success:
+                metadata = self._parse_storlet_params(resp.headers)
+                for key in ['Content-Length', 'X-Timestamp']:
+                    metadata[key] = resp.headers[key]
+            if metadata_cache is not None:
+                metadata_cache.set(self.account, storlet, metadata)
+
+        if not metadata:
             return False
 
         self.storlet_name = storlet
-        self.storlet_metadata = self._parse_storlet_params(resp.headers)
-        for key in ['Content-Length', 'X-Timestamp']:
-            self.storlet_metadata[key] = resp.headers[key]
+        self.storlet_metadata = metadata
 
         return True
 
-    def _build_storlet_request(self, req_resp, params, data_iter):
+    def _build_storlet_request(self, req_resp, params, data_iter,
+                               data_fd=None):
         storlet_id = self.storlet_name
 
         new_env = dict(req_resp.environ)
@@ -126,39 +145,185 @@ class VertigoGatewayStorlet():
         self._augment_storlet_request(req)
         options = self._get_storlet_invocation_options(req)
 
-        if hasattr(data_iter, '_fp'):
+        if data_fd is not None:
             sreq = self.sreq_class(storlet_id, req.params, dict(),
-                                   data_fd=data_iter._fp.fileno(),
-                                   options=options)
+                                   data_fd=data_fd, options=options)
         else:
             sreq = self.sreq_class(storlet_id, req.params, dict(),
                                    data_iter, options=options)
 
         return sreq
 
-    def _call_gateway(self, req_resp, params, data_iter):
-        sreq = self._build_storlet_request(req_resp, params, data_iter)
-        sresp = self.gateway.invocation_flow(sreq)
+    def _run_pipeline(self, req_resp, storlets, data_iter):
+        """
+        Runs the storlets of this server as a single pipeline: each stage
+        reads the output pipe of the previous one, so the intermediate data
+        never goes through this process
+
+        :param storlets: ordered list of (storlet, parameters, metadata)
+        :returns: data iterator of the last stage
+        """
+        self._setup_gateway()
+        self.logger.info('Vertigo - Go to execute pipeline ' +
+                         ' | '.join(storlet + ' "' + params + '"'
+                                    for storlet, params, _ in storlets))
 
-        return sresp.data_iter
+        data_fd = None
+        if hasattr(data_iter, '_fp'):
+            data_fd = data_iter._fp.fileno()
+        stage_fd = None  # output pipe of the previous stage
+
+        for i, (storlet, params, metadata) in enumerate(storlets):
+            self.storlet_name = storlet
+            self.storlet_metadata = metadata
+            sreq = self._build_storlet_request(req_resp, params, data_iter,
+                                               data_fd)
+            sresp = self.gateway.invocation_flow(sreq)
+            if stage_fd is not None:
+                # Already handed to the sandbox of this stage
+                os.close(stage_fd)
+                stage_fd = None
+
+            if i < len(storlets) - 1 and \
+                    getattr(sresp, 'data_fd', None) is not None:
+                data_fd = stage_fd = sresp.data_fd
+                data_iter = None
+            else:
+                data_fd = None
+                data_iter = sresp.data_iter
 
-    def run(self, req_resp, storlet_list, data_iter):
+        return data_iter
+
+    def _get_cache_key(self, req_resp, local_storlets):
+        """
+        :returns: storlet output cache key of the pipeline, or None if the
+                  output can not be cached
+        """
+        if isinstance(req_resp, Request) or self.method != 'GET':
+            return None
+        etag = req_resp.headers.get('Etag')
+        req = Request(req_resp.environ)
+        if not etag or 'Range' in req.headers or \
+                'X-Storlet-Range' in req.headers:
+            return None
+        options = dict((key, value) for key, value in req.headers.items()
+                       if key.startswith('X-Storlet-'))
+        storlets = [(storlet, params, metadata['X-Timestamp'])
+                    for storlet, params, metadata in local_storlets]
+        return make_storlet_cache_key(etag, storlets, options)
+
+    def split_segment_local(self, storlet_list):
+        """
+        Splits a storlet list at the first storlet that is not segment-local
+        (declared with X-Object-Meta-Storlet-Segment-Local). The storlets
+        before it can run on each segment of a large object separately, in
+        the object servers, and the rest run here over the reassembled object.
+
+        :returns: (segment storlet list, rest of the storlet list)
+        """
+        segment_list = dict()
+        rest = dict()
+        for key in sorted(storlet_list, key=int):
+            storlet, params, _ = self._get_storlet_data(storlet_list[key])
+            if not rest and self._verify_access_to_storlet(storlet) and \
+                    config_true_value(
+                        self.storlet_metadata.get('Segment-Local')):
+                segment_list[len(segment_list)] = {'storlet': storlet,
+                                                   'params': params,
+                                                   'server': 'object'}
+            else:
+                rest[len(rest)] = {'storlet': storlet,
+                                   'params': params,
+                                   'server': self.server}
+        return segment_list, rest
+
+    def _is_range_safe(self, local_storlets, data_iter):
+        """
+        Whether a range of the output can be computed from the same range of
+        the object: all the storlets declare to be range-safe, with
+        X-Object-Meta-Storlet-Range-Safe, and the object body can seek
+        """
+        return hasattr(data_iter, 'app_iter_range') and \
+            all(config_true_value(metadata.get('Range-Safe'))
+                for _, _, metadata in local_storlets)
+
+    def _place_storlets(self, req_resp, storlet_list, memcache):
+        """
+        Assigns a server to the storlets of the list without one. With a
+        placement planner, the object servers split the onget pipelines
+        between them and the proxy. Otherwise, or for PUTs, they run on the
+        object server, or here if this is the last server of the pipeline.
+        """
+        planner = self.conf.get('storlet_planner')
+        keys = sorted(storlet_list, key=int)
+        if not any(storlet_list[key]['server'] == AUTO_SERVER
+                   for key in keys):
+            return
+
+        if planner is None:
+            default = 'object'
+        elif self.server != 'object' or isinstance(req_resp, Request):
+            default = self.server
+        else:
+            stages = list()
+            for key in keys:
+                storlet, _, server = self._get_storlet_data(storlet_list[key])
+                metadata = dict()
+                if self._verify_access_to_storlet(storlet, memcache):
+                    metadata = self.storlet_metadata
+                stages.append((storlet, metadata, server))
+            try:
+                proxy_load = float(Request(req_resp.environ).headers.get(
+                    BACKEND_PROXY_LOAD_HEADER))
+            except (TypeError, ValueError):
+                proxy_load = None
+            split, explanation = planner.plan(
+                stages, req_resp.content_length, proxy_load)
+            self.logger.debug('Vertigo - Storlet plan: ' + explanation)
+            if config_true_value(self.conf.get('storlet_placement_debug')):
+                req_resp.headers[PLAN_HEADER] = explanation
+            for i, key in enumerate(keys):
+                if storlet_list[key]['server'] == AUTO_SERVER:
+                    storlet_list[key]['server'] = 'object' \
+                        if split is None or i < split else 'proxy'
+            return
+
+        for key in keys:
+            if storlet_list[key]['server'] == AUTO_SERVER:
+                storlet_list[key]['server'] = default
+
+    def _observe(self, req_resp, local_storlets, data_iter):
+        """
+        Reports the selectivity and the CPU cost of a storlet that ran
+        alone over a whole object to the placement planner
+        """
+        planner = self.conf.get('storlet_planner')
+        input_size = req_resp.headers.get('Content-Length')
+        if planner is None or len(local_storlets) != 1 or \
+                isinstance(req_resp, Request) or not input_size:
+            return data_iter
+        storlet, _, metadata = local_storlets[0]
+        return ObservedIter(data_iter, lambda size, seconds: planner.observe(
+            storlet, metadata, int(input_size), size, seconds))
+
+    def run(self, req_resp, storlet_list, data_iter, ranged=False):
+        """
+        :param ranged: the response is the whole object for a range request
+        """
         on_other_server = {}
+        local_storlets = list()
+        memcache = cache_from_env(req_resp.environ, True)
+        self._place_storlets(req_resp, storlet_list, memcache)
 
-        # Execute multiple Storlets, PIPELINE, if any.
-        for key in sorted(storlet_list):
+        for key in sorted(storlet_list, key=int):
             storlet, params, server = self._get_storlet_data(storlet_list[key])
 
             if server == self.server:
-                self._setup_gateway()
-                self.logger.info('Vertigo - Go to execute ' + storlet +
-                                 ' storlet with parameters "' + params + '"')
-
-                if not self._verify_access_to_storlet(storlet):
+                if not self._verify_access_to_storlet(storlet, memcache):
                     return HTTPUnauthorized('Vertigo - Storlet ' + storlet +
                                             ': No permission')
-                self._setup_gateway()
-                data_iter = self._call_gateway(req_resp, params, data_iter)
+                local_storlets.append((storlet, params,
+                                       self.storlet_metadata))
             else:
                 storlet_execution = {'storlet': storlet,
                                      'params': params,
@@ -166,6 +331,31 @@ class VertigoGatewayStorlet():
                 launch_key = len(on_other_server.keys())
                 on_other_server[launch_key] = storlet_execution
 
+        cache = self.conf.get('storlet_output_cache')
+        cache_key = None
+        if cache and local_storlets and not on_other_server:
+            cache_key = self._get_cache_key(req_resp, local_storlets)
+        cached = cache_key and cache.get(cache_key)
+
+        if cached:
+            if hasattr(data_iter, 'close'):
+                data_iter.close()
+            data_iter = cached[0]
+            self.logger.info('Vertigo - Storlet output served from cache')
+        else:
+            if local_storlets and ranged and not on_other_server and \
+                    self._is_range_safe(local_storlets, data_iter):
+                data_iter = RangeSafePipeline(
+                    lambda source: self._run_pipeline(req_resp,
+                                                      local_storlets, source),
+                    data_iter)
+            elif local_storlets:
+                data_iter = self._observe(
+                    req_resp, local_storlets,
+                    self._run_pipeline(req_resp, local_storlets, data_iter))
+            if cache_key:
+                data_iter = cache.wrap(cache_key, data_iter)
+
         if on_other_server:
             req_resp.headers['Storlet-List'] = json.dumps(on_other_server)
 
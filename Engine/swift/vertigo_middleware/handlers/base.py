@@ -3,12 +3,49 @@ from swift.common.swob import HTTPUnauthorized, HTTPBadRequest, Range
 from swift.common.utils import config_true_value
 from vertigo_middleware.gateways import VertigoGatewayDocker
 from vertigo_middleware.gateways import VertigoGatewayStorlet
+from vertigo_middleware.common.ranges import RangeSafePipeline, \
+    SpooledBody
+from vertigo_middleware.common.utils import SubrequestFactory
+
+
+ASSIGNATION_HEADERS = ('X-Vertigo-Onget',
+                       'X-Vertigo-Ondelete',
+                       'X-Vertigo-Onput',
+                       'X-Vertigo-Ontimer')
+DELETION_HEADERS = ('X-Vertigo-Onget-Delete',
+                    'X-Vertigo-Ondelete-Delete',
+                    'X-Vertigo-Onput-Delete',
+                    'X-Vertigo-Ontimer-Delete',
+                    'X-Vertigo-Delete')
+
+
+def header_to_env_key(header):
+    return 'HTTP_' + header.upper().replace('-', '_')
+
+
+# WSGI environ keys of the headers that request Vertigo operations
+ASSIGNATION_ENV_KEYS = frozenset(header_to_env_key(h)
+                                 for h in ASSIGNATION_HEADERS)
+DELETION_ENV_KEYS = frozenset(header_to_env_key(h) for h in DELETION_HEADERS)
+OPERATION_ENV_KEYS = ASSIGNATION_ENV_KEYS | DELETION_ENV_KEYS | \
+    frozenset(['HTTP_X_VERTIGO_GROUP', 'HTTP_X_VERTIGO_LINK_TO',
+               'HTTP_X_VERTIGO_PREFETCH'])
 
 
 class NotVertigoRequest(Exception):
     pass
 
 
+def has_any_env_key(env, env_keys):
+    """
+    Checks whether any of the env_keys is in the WSGI environ
+    """
+    for key in env_keys:
+        if key in env:
+            return True
+    return False
+
+
 def _request_instance_property():
     """
     Set and retrieve the request instance.
@@ -35,33 +72,30 @@ class VertigoBaseHandler(object):
     """
     This is an abstract handler for Proxy/Object Server middleware
     """
+    __slots__ = ('_request', '_api_version', '_account', '_container', '_obj',
+                 'vertigo_containers', 'app', 'logger', 'conf', 'method',
+                 'execution_server', '_subrequest_factory',
+                 'mc_docker_gateway', 'storlet_gateway')
+
     request = _request_instance_property()
 
+    available_assignation_headers = ASSIGNATION_HEADERS
+    available_deletion_headers = DELETION_HEADERS
+
     def __init__(self, request, conf, app, logger):
         """
         :param request: swob.Request instance
         :param conf: gatway conf dict
         """
         self.request = request
-        self.vertigo_containers = [conf.get('mc_container'),
-                                   conf.get('mc_dependency'),
-                                   conf.get('storlet_container'),
-                                   conf.get('storlet_dependency')]
-        self.available_assignation_headers = ['X-Vertigo-Onget',
-                                              'X-Vertigo-Ondelete',
-                                              'X-Vertigo-Onput',
-                                              'X-Vertigo-Ontimer']
-        self.available_deletion_headers = ['X-Vertigo-Onget-Delete',
-                                           'X-Vertigo-Ondelete-Delete',
-                                           'X-Vertigo-Onput-Delete',
-                                           'X-Vertigo-Ontimer-Delete',
-                                           'X-Vertigo-Delete']
+        self.vertigo_containers = conf['vertigo_containers']
 
         self.app = app
         self.logger = logger
         self.conf = conf
         self.method = self.request.method.lower()
         self.execution_server = conf["execution_server"]
+        self._subrequest_factory = None
 
     def _setup_docker_gateway(self, response=None):
         self.request.headers['X-Current-Server'] = self.execution_server
@@ -85,9 +119,35 @@ class VertigoBaseHandler(object):
         self._api_version, self._account, self._container, self._obj = \
             self._parse_vaco()
 
+    @classmethod
+    def is_vertigo_request(cls, env, conf):
+        """
+        Cheap classification of the incoming request, made before building
+        any handler. It only relies on the WSGI environ and it is
+        conservative: False means that the handler would just forward the
+        request, True means that the handler must decide.
+
+        :param env: WSGI environ of the incoming request
+        :param conf: gateway conf dict
+        :return: Whether the request may require Vertigo work
+        """
+        raise NotImplementedError()
+
+    @classmethod
+    def bypass_request(cls, req, app):
+        """
+        Forwards a non-Vertigo request to the next middleware without
+        building any handler
+
+        :param req: swob.Request instance
+        :param app: next WSGI application
+        :return: swob.Response instance
+        """
+        return req.get_response(app)
+
     def get_mc_assignation_data(self):
         header = [i for i in self.available_assignation_headers
-                  if i in self.request.headers.keys()]
+                  if i in self.request.headers]
         if len(header) > 1:
             raise HTTPUnauthorized('Vertigo - The system can only set 1'
                                    ' microcontroller each time.\n')
@@ -97,7 +157,7 @@ class VertigoBaseHandler(object):
 
     def get_mc_deletion_data(self):
         header = [i for i in self.available_deletion_headers
-                  if i in self.request.headers.keys()]
+                  if i in self.request.headers]
         if len(header) > 1:
             raise HTTPUnauthorized('Vertigo - The system can only delete 1'
                                    ' microcontroller each time.\n')
@@ -121,6 +181,16 @@ class VertigoBaseHandler(object):
     def obj(self):
         return self._obj
 
+    @property
+    def subrequest_factory(self):
+        """
+        Subrequest factory of the incoming request. It is built on the first
+        subrequest, so requests without subrequests don't pay for it.
+        """
+        if self._subrequest_factory is None:
+            self._subrequest_factory = SubrequestFactory(self.request)
+        return self._subrequest_factory
+
     def _parse_vaco(self):
         """
         Parse method of path from self.request which depends on child class
@@ -210,13 +280,11 @@ class VertigoBaseHandler(object):
 
     @property
     def is_trigger_assignation(self):
-        return any((True for x in self.available_assignation_headers
-                    if x in self.request.headers.keys()))
+        return has_any_env_key(self.request.environ, ASSIGNATION_ENV_KEYS)
 
     @property
     def is_trigger_deletion(self):
-        return any((True for x in self.available_deletion_headers
-                    if x in self.request.headers.keys()))
+        return has_any_env_key(self.request.environ, DELETION_ENV_KEYS)
 
     @property
     def is_object_grouping(self):
@@ -226,6 +294,10 @@ class VertigoBaseHandler(object):
     def is_object_move(self):
         return 'X-Vertigo-Link-To' in self.request.headers
 
+    @property
+    def is_object_prefetch(self):
+        return 'X-Vertigo-Prefetch' in self.request.headers
+
     def is_slo_response(self, resp):
         self.logger.debug(
             'Verify if {0}/{1}/{2} is an SLO assembly object'.format(
@@ -257,17 +329,37 @@ class VertigoBaseHandler(object):
         """
         self._setup_storlet_gateway()
         data_iter = resp.app_iter
-        response = self.storlet_gateway.run(resp, storlet_list, data_iter)
+        # The object servers read the whole object for range requests
+        ranged = self.is_range_request and resp.status_int == 200
+        response = self.storlet_gateway.run(resp, storlet_list, data_iter,
+                                            ranged)
 
-        if 'Content-Length' in response.headers:
-            response.headers.pop('Content-Length')
         if 'Transfer-Encoding' in response.headers:
             response.headers.pop('Transfer-Encoding')
         if 'Etag' in response.headers:
             response.headers['Etag'] = ''
 
+        if ranged and response.status_int == 200 and \
+                'Storlet-List' not in response.headers:
+            self.serve_request_ranges(response)
+        elif 'Content-Length' in response.headers:
+            response.headers.pop('Content-Length')
+
         return response
 
+    def serve_request_ranges(self, response):
+        """
+        Serves the requested ranges of a transformed body, spooled to know
+        its length unless the storlets were range-safe
+        """
+        if not isinstance(response.app_iter, RangeSafePipeline):
+            response.app_iter = SpooledBody(
+                response.app_iter,
+                int(self.conf.get('storlet_range_spool_size', 1048576)))
+            response.content_length = response.app_iter.length
+        response.request = self.request
+        response.conditional_response = True
+
     def apply_storlet_on_put(self, req, storlet_list):
         """
         Call gateway module to get result of storlet execution
@@ -1,24 +1,98 @@
-from swift.common.swob import HTTPMethodNotAllowed, Response
-from swift.common.utils import public
+from swift.common.swob import HTTPMethodNotAllowed, HeaderKeyDict, \
+    Request, Response
+from swift.common.utils import public, config_true_value
 from vertigo_middleware.handlers import VertigoBaseHandler
-from vertigo_middleware.common.utils import get_microcontroller_list_object
+from vertigo_middleware.handlers.base import ASSIGNATION_ENV_KEYS, \
+    DELETION_ENV_KEYS, has_any_env_key, header_to_env_key
+from vertigo_middleware.common.utils import SYSMETA_OBJ_HEADER
+from vertigo_middleware.common.triggers import get_forwarded_policy, \
+    get_effective_table, get_policy_reference, parse_policy_reference, \
+    BACKEND_POLICY_REFERENCE_HEADER
+from vertigo_middleware.common.policies import is_newer_version
 from vertigo_middleware.common.utils import set_microcontroller_object
 from vertigo_middleware.common.utils import delete_microcontroller_object
+from vertigo_middleware.common.utils import get_data_file, get_data_dir, \
+    get_cached_object_metadata
+from vertigo_middleware.common.large_objects import is_slo_manifest, \
+    BACKEND_STORLET_LIST_HEADER
+import eventlet
+import json
 import time
 
 
+BACKEND_STORLET_LIST_ENV_KEY = header_to_env_key(BACKEND_STORLET_LIST_HEADER)
+CONDITIONAL_HEADERS = ('If-Match', 'If-None-Match', 'If-Modified-Since',
+                       'If-Unmodified-Since')
+
+
+class BufferedIter(object):
+    """
+    Body iterator that yields the chunks read ahead before the rest of the
+    backend iterator
+    """
+
+    def __init__(self, chunks, app_iter, source):
+        self.chunks = chunks
+        self.app_iter = app_iter
+        self.source = source
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            yield chunk
+        for chunk in self.app_iter:
+            yield chunk
+
+    def close(self):
+        if hasattr(self.source, 'close'):
+            self.source.close()
+
+
 class VertigoObjectHandler(VertigoBaseHandler):
+    __slots__ = ()
+
+    VERTIGO_METHODS = frozenset(['GET', 'PUT', 'DELETE'])
 
     def __init__(self, request, conf, app, logger):
         super(VertigoObjectHandler, self).__init__(
             request, conf, app, logger)
 
+    @classmethod
+    def is_vertigo_request(cls, env, conf):
+        method = env['REQUEST_METHOD']
+        if method not in cls.VERTIGO_METHODS:
+            return False
+
+        # /device/partition/account/container/object
+        dpaco = env['PATH_INFO'].split('/', 5)
+        if len(dpaco) < 6 or not dpaco[5]:
+            return False
+        if method == 'GET' and BACKEND_STORLET_LIST_ENV_KEY in env:
+            # Segment of a large object, with its segment-local storlets
+            return True
+        if dpaco[4] in conf['vertigo_containers']:
+            return False
+        if method != 'GET' and 'trigger_index' in conf:
+            # Overwrites and deletions keep the trigger index up to date
+            return True
+        if method == 'DELETE' or 'HTTP_X_COPY_FROM' in env or \
+                env.get('HTTP_MC_ENABLED') == 'False':
+            return False
+
+        if method == 'GET':
+            # Pseudo-folders never run microcontrollers
+            return not dpaco[5].endswith('/')
+        return env.get('CONTENT_TYPE') == 'vertigo/link' or \
+            has_any_env_key(env, ASSIGNATION_ENV_KEYS) or \
+            has_any_env_key(env, DELETION_ENV_KEYS)
+
     def _parse_vaco(self):
         _, _, acc, cont, obj = self.request.split_path(
             5, 5, rest_with_last=True)
         return ('v1', acc, cont, obj)
 
     def handle_request(self):
+        if BACKEND_STORLET_LIST_HEADER in self.request.headers:
+            return self._get_segment()
         if hasattr(self, self.request.method) and self.is_valid_request:
             try:
                 handler = getattr(self, self.request.method)
@@ -39,6 +113,14 @@ class VertigoObjectHandler(VertigoBaseHandler):
 
         elif mc_data['command'] == 'STORLET':
             slist = mc_data['list']
+            if is_slo_manifest(response.headers):
+                # The proxy runs them over the segments, never over the
+                # manifest, which goes back whole
+                self.logger.info('Vertigo - Storlets forwarded to the proxy '
+                                 'for a large object: ' + str(slist))
+                response.headers['Storlet-List'] = json.dumps(slist)
+                response.conditional_response = False
+                return response
             self.logger.info('Vertigo - Go to execute Storlets: ' + str(slist))
             return self.apply_storlet_on_get(response, slist)
 
@@ -47,30 +129,203 @@ class VertigoObjectHandler(VertigoBaseHandler):
             return Response(body=msg + '\n', headers={'etag': ''},
                             request=self.request)
 
-    @public
-    def GET(self):
+    def _get_segment(self):
         """
-        GET handler on Object
+        GETs a segment of a large object, and runs on it the segment-local
+        storlets forwarded by the proxy. The microcontrollers ran once, on
+        the manifest.
         """
+        storlet_list = json.loads(
+            self.request.headers[BACKEND_STORLET_LIST_HEADER])
         response = self.request.get_response(self.app)
+        if not response.is_success:
+            return response
+        return self.apply_storlet_on_get(response, storlet_list)
 
-        # start = time.time()
+    def _get_trigger_table(self, headers):
+        """
+        Gets the triggers of the object: its own ones over the policy
+        forwarded by the proxy. The policy referenced by the object is
+        resolved here when it was not forwarded (requests that did not go
+        through the proxy handler), or when the forwarded one is older.
+        """
+        reference, policy = get_forwarded_policy(self.request)
+        forwarded = self.request.headers.get(BACKEND_POLICY_REFERENCE_HEADER)
+        policy_id, version = parse_policy_reference(forwarded) \
+            if forwarded else (None, None)
+        own_reference = get_policy_reference(headers, SYSMETA_OBJ_HEADER)
+        policy_store = self.conf.get('policy_store')
+        if own_reference and policy_store and \
+                (not forwarded or (own_reference[0] == policy_id and
+                                   is_newer_version(own_reference[1],
+                                                    version))):
+            policy_id = own_reference[0]
+            _, policy = policy_store.get(self, policy_id, own_reference[1])
+        return get_effective_table(headers, SYSMETA_OBJ_HEADER, policy_id,
+                                   policy)
+
+    def _read_disk_headers(self):
+        """
+        Reads the object headers straight from the on-disk metadata
+
+        :return: (data file, HeaderKeyDict instance), or (None, None) if
+                 there is no data file
+        """
+        try:
+            data_file = get_data_file(self)
+            if not data_file:
+                return None, None
+            metadata = get_cached_object_metadata(data_file)
+        except Exception:
+            return None, None
+        return data_file, HeaderKeyDict(
+            (key, value) for key, value in metadata.items() if key != 'name')
+
+    def _get_data_file(self):
+        try:
+            return get_data_file(self)
+        except Exception:
+            return None
+
+    def _buffer_until_verdict(self, response, invocation):
+        """
+        Reads the first chunks of the body while the microcontrollers run,
+        up to speculative_buffer_size bytes
+        """
+        max_size = int(self.conf.get('speculative_buffer_size', 65536))
+        source = response.app_iter
+        app_iter = iter(source)
+        chunks = list()
+        size = 0
+        while size < max_size and not invocation.dead:
+            try:
+                chunk = next(app_iter)
+            except StopIteration:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+            # Disk reads do not yield, let the invocation make progress
+            eventlet.sleep(0)
+        response.app_iter = BufferedIter(chunks, app_iter, source)
+
+    def _get_mc_list(self, headers):
+        table = self._get_trigger_table(headers) if headers else None
+        return table.get_list('on' + self.method) if table else None
+
+    def _backend_get(self, whole=None):
+        """
+        GETs the object. If it has onget microcontrollers, the range of a
+        range request is not forwarded, so the microcontrollers and the
+        storlets see the whole object, and the range is applied to the final
+        body when it is sent. An untransformed body is still only read where
+        requested, as the disk file reader seeks to the ranges.
+
+        :param whole: whether the microcontrollers run. By default, it is
+                      found in the on-disk trigger table.
+        """
+        if not self.is_range_request:
+            return self.request.get_response(self.app)
+        if whole is None:
+            whole = bool(self._get_mc_list(self._read_disk_headers()[1]))
+        if not whole:
+            response = self.request.get_response(self.app)
+            if response.status_int != 206 or \
+                    not self._get_mc_list(response.headers):
+                return response
+            # Replaced since its metadata was read
+            if hasattr(response.app_iter, 'close'):
+                response.app_iter.close()
+        env = dict(self.request.environ)
+        del env['HTTP_RANGE']
+        response = Request(env).get_response(self.app)
+        if response.status_int == 200:
+            response.request = self.request
+            response.conditional_response = True
+        return response
+
+    def _speculative_get(self):
+        """
+        Starts the microcontrollers from the on-disk metadata, in parallel
+        with the backend GET
+
+        :return: swob.Response instance, or None if the object has no
+                 microcontrollers, or the request is conditional
+        """
+        if any(header in self.request.headers
+               for header in CONDITIONAL_HEADERS):
+            # The microcontrollers must not run for a 304 or a 412
+            return None
+        data_file, headers = self._read_disk_headers()
+        table = self._get_trigger_table(headers) if headers else None
+        mc_list = table.get_list('on' + self.method) if table else None
+        if not mc_list:
+            return None
+
+        self.logger.info('Vertigo - There are microcontrollers' +
+                         ' to execute: ' + str(mc_list))
+        self._setup_docker_gateway(Response(headers=headers,
+                                            request=self.request))
+        invocation = eventlet.spawn(
+            self.mc_docker_gateway.execute_microcontrollers, mc_list, table,
+            data_file)
+        # Lets the invocation send its datagram: the backend GET does not
+        # yield until it reads the body
+        eventlet.sleep(0)
 
+        response = self._backend_get(whole=True)
+        if not response.is_success:
+            invocation.kill()
+            return response
+        if response.headers.get('X-Timestamp') != \
+                headers.get('X-Timestamp'):
+            # Replaced since its metadata was read
+            invocation.wait()
+            self.logger.info('Vertigo - Stale speculative execution')
+            return self._execute_microcontrollers(response)
+
+        if not self.is_range_request:
+            # Range requests keep the seekable reader
+            self._buffer_until_verdict(response, invocation)
+        return self._process_mc_data(response, invocation.wait())
+
+    def _execute_microcontrollers(self, response):
         if self.obj.endswith('/'):
             # is a pseudo-folder
-            mc_list = None
+            table = None
         else:
-            mc_list = get_microcontroller_list_object(response.headers, self.method)
+            # The proxy forwards the policy inherited from the parent
+            table = self._get_trigger_table(response.headers)
+        mc_list = table.get_list('on' + self.method) if table else None
 
         if mc_list:
             self.logger.info('Vertigo - There are microcontrollers' +
                              ' to execute: ' + str(mc_list))
             self._setup_docker_gateway(response)
-            mc_data = self.mc_docker_gateway.execute_microcontrollers(mc_list)
+            mc_data = self.mc_docker_gateway.execute_microcontrollers(
+                mc_list, table, self._get_data_file())
             response = self._process_mc_data(response, mc_data)
         else:
             self.logger.info('Vertigo - No microcontrollers to execute')
 
+        return response
+
+    @public
+    def GET(self):
+        """
+        GET handler on Object. The microcontrollers start from the on-disk
+        metadata while the backend opens the data file, and the first body
+        chunks are buffered until their verdict.
+        """
+        # start = time.time()
+
+        if config_true_value(self.conf.get('speculative_get', True)) and \
+                not self.obj.endswith('/'):
+            response = self._speculative_get()
+            if response is not None:
+                return response
+
+        response = self._execute_microcontrollers(self._backend_get())
+
         # end = time.time() - start
         # f = open("/tmp/vertigo/vertigo_get_overhead.log", 'a')
         # f.write(str(int(round(end * 1000)))+'\n')
@@ -78,6 +333,27 @@ class VertigoObjectHandler(VertigoBaseHandler):
 
         return response
 
+    def _update_trigger_index(self, deleted=False):
+        """
+        Keeps the node-local trigger index up to date after an assignment,
+        a deletion, an overwrite or a delete. Index failures never fail the
+        request: the indexer daemon fixes the entry on its next crawl.
+
+        :param deleted: whether the object has been deleted
+        """
+        index = self.conf.get('trigger_index')
+        if not index:
+            return
+        try:
+            if deleted:
+                index.remove(get_data_dir(self))
+                return
+            data_file = get_data_file(self)
+            index.update(data_file, get_cached_object_metadata(data_file))
+        except Exception:
+            self.logger.exception('Vertigo - Error updating the trigger '
+                                  'index')
+
     @public
     def PUT(self):
         """
@@ -88,6 +364,7 @@ class VertigoObjectHandler(VertigoBaseHandler):
 
             try:
                 set_microcontroller_object(self, trigger, micro_controller)
+                self._update_trigger_index()
                 msg = 'Vertigo - Microcontroller "' + micro_controller + \
                     '" correctly assigned to the "' + trigger + '" trigger.\n'
             except ValueError as e:
@@ -102,6 +379,7 @@ class VertigoObjectHandler(VertigoBaseHandler):
 
             try:
                 delete_microcontroller_object(self, trigger, micro_controller)
+                self._update_trigger_index()
                 msg = 'Vertigo - Microcontroller "' + micro_controller +\
                     '" correctly removed from the "' + trigger + '" trigger.\n'
             except ValueError as e:
@@ -110,11 +388,26 @@ class VertigoObjectHandler(VertigoBaseHandler):
             response = Response(body=msg, headers={'etag': ''},
                                 request=self.request)
 
-        elif self.request.headers['Content-Type'] == 'vertigo/link':
+        elif self.request.headers.get('Content-Type') == 'vertigo/link':
             response = self.request.get_response(self.app)
             response.headers['Content-Type'] = 'vertigo/link'
+            if response.is_success:
+                self._update_trigger_index()
 
         else:
             response = self.request.get_response(self.app)
+            if response.is_success:
+                # The new object replaces the indexed one
+                self._update_trigger_index()
+
+        return response
 
+    @public
+    def DELETE(self):
+        """
+        DELETE handler on Object
+        """
+        response = self.request.get_response(self.app)
+        if response.is_success or response.status_int == 404:
+            self._update_trigger_index(deleted=True)
         return response
@@ -1,19 +1,52 @@
 from vertigo_middleware.handlers import VertigoBaseHandler
+from vertigo_middleware.handlers.base import OPERATION_ENV_KEYS, \
+    has_any_env_key
 from vertigo_middleware.common.utils import verify_access, create_link
 from vertigo_middleware.common.utils import set_microcontroller_container
 from vertigo_middleware.common.utils import delete_microcontroller_container
-from vertigo_middleware.common.utils import get_microcontroller_list_object
-
-from swift.common.swob import HTTPMethodNotAllowed, HTTPNotFound, HTTPUnauthorized, Response
-from swift.common.utils import public, cache_from_env
-from swift.common.wsgi import make_subrequest
-import pickle
+from vertigo_middleware.common.utils import get_missing_pseudo_folders
+from vertigo_middleware.common.utils import cache_link, invalidate_link
+from vertigo_middleware.common.utils import get_cached_link_target
+from vertigo_middleware.common.utils import MAX_LINK_HOPS
+from vertigo_middleware.common.utils import SYSMETA_OBJ_HEADER, \
+    SYSMETA_CONTAINER_HEADER
+from vertigo_middleware.common.triggers import load_trigger_table, \
+    get_effective_table, make_policy_reference, get_policy_reference, \
+    TriggerTable, POLICY_KEY, \
+    BACKEND_POLICY_REFERENCE_HEADER, BACKEND_POLICY_HEADER
+from vertigo_middleware.common.policies import get_parent_policy_id, \
+    is_newer_version
+from vertigo_middleware.common.object_cache import CacheAdmissionIter, \
+    HOT_OBJECT_KEY_PREFIX, iter_body
+from vertigo_middleware.common.streaming_put import VerdictHeldInput
+from vertigo_middleware.common.transform import PENDING_TRANSFORM_HEADER, \
+    get_pending_storlet_list
+from vertigo_middleware.common.large_objects import SegmentAssembler, \
+    check_segment, iter_segments, is_slo_manifest, \
+    BACKEND_STORLET_LIST_HEADER
+from vertigo_middleware.common.placement import BACKEND_PROXY_LOAD_HEADER
+from vertigo_middleware.gateways import VertigoGatewayStorlet
+from vertigo_middleware.gateways.docker.api_bus import API_BUS_ENV_KEY
+
+from swift.common.swob import HTTPMethodNotAllowed, HTTPNotFound, HTTPUnauthorized, \
+    HTTPConflict, HTTPForbidden, Response
+from swift.common.utils import public, cache_from_env, config_true_value
+from urllib import quote
+from swift.proxy.controllers.base import get_container_info
+from eventlet import GreenPool
+import eventlet
+import tempfile
+import base64
 import json
 import os
 import time
 
 
 class VertigoProxyHandler(VertigoBaseHandler):
+    __slots__ = ('mc_container', 'memcache', 'cached_object',
+                 'hot_object_cache', 'policy_store', '_parent_policy')
+
+    VERTIGO_METHODS = frozenset(['GET', 'PUT', 'POST', 'HEAD', 'DELETE'])
 
     def __init__(self, request, conf, app, logger):
         super(VertigoProxyHandler, self).__init__(
@@ -23,40 +56,167 @@ class VertigoProxyHandler(VertigoBaseHandler):
         self.memcache = None
         self.request.headers['mc-enabled'] = True
         self.memcache = cache_from_env(self.request.environ)
+        self.hot_object_cache = self.conf.get('hot_object_cache')
+        self.cached_object = None
+        self.policy_store = self.conf['policy_store']
+        self._parent_policy = None
+
+    @classmethod
+    def is_vertigo_request(cls, env, conf):
+        method = env['REQUEST_METHOD']
+        if method not in cls.VERTIGO_METHODS:
+            return False
+
+        # /version/account/container[/object]
+        vaco = env['PATH_INFO'].split('/', 4)
+        if len(vaco) < 4 or not vaco[3]:
+            # Account request
+            return False
+        if vaco[3] in conf['vertigo_containers'] or \
+                'HTTP_X_COPY_FROM' in env:
+            return False
+
+        if len(vaco) < 5 or not vaco[4]:
+            # Container request: only HEAD shows Vertigo metadata
+            return method == 'HEAD' and bool(conf['metadata_visibility'])
+        if method == 'POST':
+            # POSTs also invalidate the hot-object cache
+            return has_any_env_key(env, OPERATION_ENV_KEYS) or \
+                conf.get('hot_object_cache') is not None
+        if method == 'HEAD':
+            return bool(conf['metadata_visibility'])
+        # GETs may hit links or Storlet-List responses, PUTs inherit the
+        # parent microcontrollers and PUTs/DELETEs invalidate the caches
+        return True
+
+    @classmethod
+    def bypass_request(cls, req, app):
+        # The object servers must not trust a client mc-enabled header
+        req.headers['mc-enabled'] = True
+        return req.get_response(app)
 
     def _parse_vaco(self):
         return self.request.split_path(3, 4, rest_with_last=True)
 
     def _is_object_in_cache(self, obj):
         """
-        Checks if an object is in memcache. If exists, the object is stored
-        in self.cached_object.
+        Checks if an object is in the hot-object cache. If exists, the object
+        is stored in self.cached_object. The cached copy is only valid while
+        memcache keeps the ETag that it was admitted with, so any proxy
+        can invalidate it.
         :return: True/False
         """
-        self.logger.info('Vertigo - Checking in cache: ' + obj)
-        # self.cached_object = self.memcache.get(obj)
-
         self.cached_object = None
+        if self.hot_object_cache is None or self.is_range_request:
+            return False
+
+        self.logger.debug('Vertigo - Checking in cache: ' + obj)
+        cached_obj = self.hot_object_cache.get(obj)
+        if cached_obj:
+            etag = self.memcache.get(HOT_OBJECT_KEY_PREFIX + obj)
+            if etag and etag == cached_obj[0].get('Etag'):
+                self.cached_object = cached_obj
+            else:
+                self.hot_object_cache.invalidate(obj)
 
         return self.cached_object is not None
 
+    def authorize_object_access(self, obj):
+        """
+        Authorizes the access to an object that is not going to be requested
+        to the backend, as the proxy object controller would do.
+        :param obj: account/container/object
+        :return: an error Response, or None if access is granted
+        """
+        path = os.path.join('/', self.api_version, obj)
+        sub_req = self.subrequest_factory.make_subrequest('GET', path)
+        container_info = get_container_info(sub_req.environ, self.app)
+        sub_req.acl = container_info['read_acl']
+        if 'swift.authorize' in sub_req.environ:
+            return sub_req.environ['swift.authorize'](sub_req)
+        return None
+
     def _get_cached_object(self, obj):
         """
-        Gets the object from memcache. Executes associated microcontrollers.
+        Gets the object from the hot-object cache. Executes associated
+        onget microcontrollers before serving the cached body.
         :return: Response object
         """
         self.logger.info('Vertigo - Object %s in cache', obj)
-        cached_obj = pickle.loads(self.cached_object)
-        resp_headers = cached_obj["Headers"]
-        resp_headers['content-length'] = len(cached_obj["Body"])
-
-        response = Response(body=cached_obj["Body"],
+        aresp = self.authorize_object_access(obj)
+        if aresp:
+            return aresp
+
+        cached_headers, body = self.cached_object
+        resp_headers = dict(cached_headers)
+        resp_headers['Content-Length'] = len(body)
+        response = Response(app_iter=iter_body(body),
                             headers=resp_headers,
-                            request=self.request)
+                            request=self.request,
+                            conditional_response=True)
+
+        table = self.get_trigger_table(cached_headers)
+        mc_list = table.get_list('on' + self.method) if table else None
+        if mc_list:
+            self.logger.info('Vertigo - There are microcontrollers' +
+                             ' to execute: ' + str(mc_list))
+            self._setup_docker_gateway(response)
+            mc_data = self.mc_docker_gateway.execute_microcontrollers(
+                mc_list, table)
+            if mc_data['command'] == 'CANCEL':
+                return Response(body=mc_data['message'] + '\n',
+                                headers={'etag': ''}, request=self.request)
+            elif mc_data['command'] == 'STORLET':
+                # The object is already here: run the storlets on the proxy
+                slist = mc_data['list']
+                for key in slist:
+                    slist[key]['server'] = self.execution_server
+                response.headers['Storlet-List'] = json.dumps(slist)
+
+        return response
+
+    def _admit_to_cache(self, obj, response):
+        """
+        Stores a backend response into the hot-object cache, once it has been
+        sent to the client, if the object is small and hot enough.
+        :param obj: account/container/object
+        :param response: backend response
+        :return: Response object
+        """
+        if self.hot_object_cache is None:
+            return response
+
+        etag = response.headers.get('Etag')
+        if response.status_int != 200 or self.is_range_request or not etag \
+                or 'Storlet-List' in response.headers \
+                or response.headers.get('Content-Type') == 'vertigo/link' \
+                or response.content_length is None \
+                or not self.hot_object_cache.is_admissible(
+                    response.content_length) \
+                or not self.hot_object_cache.record_access(obj):
+            return response
+
+        headers = dict(response.headers)
+        hot_object_cache = self.hot_object_cache
+        memcache = self.memcache
+
+        def admit(body):
+            hot_object_cache.put(obj, headers, body)
+            memcache.set(HOT_OBJECT_KEY_PREFIX + obj, etag)
 
-        # TODO: Execute microcontrollers
+        response.app_iter = CacheAdmissionIter(
+            response.app_iter, response.content_length, admit)
         return response
 
+    def _invalidate_cached_object(self, obj):
+        """
+        Invalidates an object in the hot-object cache of all the proxies
+        :param obj: account/container/object
+        """
+        if self.hot_object_cache is not None:
+            self.hot_object_cache.invalidate(obj)
+            self.memcache.delete(HOT_OBJECT_KEY_PREFIX + obj)
+
     def handle_request(self):
         if hasattr(self, self.request.method) and self.is_valid_request:
             try:
@@ -100,30 +260,38 @@ class VertigoProxyHandler(VertigoBaseHandler):
         else:
             return response
 
-    def _augment_object_list(self, obj_list):
+    def _create_pseudo_folder(self, pseudo_folder):
+        """
+        Creates the pseudo-folder marker object
+        :param pseudo_folder: pseudo-folder name (ended with '/')
+        :return: swift.common.swob.Response Instance
+        """
+        path = os.path.join('/', self.api_version, self.account,
+                            self.container, pseudo_folder)
+        auth_token = self.subrequest_factory.auth_token
+        sub_req = self.subrequest_factory.make_subrequest(
+            'PUT', path, headers={'X-Auth-Token': auth_token,
+                                  'Content-Length': 0})
+        return sub_req.get_response(self.app)
+
+    def _augment_object_list(self, obj_list, prefix=''):
         """
         Checks the object list and creates those pseudo-folders that are not in
-        the obj_list, but there are objects within them.
+        the obj_list, but there are objects within them. The markers are
+        created concurrently.
          :param obj_list: object list
+         :param prefix: pseudo-folder listed, or '' for the whole container
         """
-        for obj in obj_list:
-            if '/' in obj:
-                obj_split = obj.rsplit('/', 1)
-                pseudo_folder = obj_split[0] + '/'
-                if pseudo_folder not in obj_list:
-                    path = os.path.join('/', self.api_version, self.account,
-                                        self.container, pseudo_folder)
-                    new_env = dict(self.request.environ)
-                    auth_token = self.request.headers.get('X-Auth-Token')
-                    sub_req = make_subrequest(new_env, 'PUT', path,
-                                              headers={'X-Auth-Token': auth_token,
-                                                       'Content-Length': 0},
-                                              swift_source='Vertigo')
-                    response = sub_req.get_response(self.app)
-                    if response.is_success:
-                        obj_list.append(pseudo_folder)
-                    else:
-                        raise ValueError("Vertigo - Error creating pseudo-folder")
+        pseudo_folders = get_missing_pseudo_folders(obj_list, prefix)
+        if not pseudo_folders:
+            return
+
+        pool = GreenPool(int(self.conf['pseudo_folder_concurrency']))
+        responses = pool.imap(self._create_pseudo_folder, pseudo_folders)
+        for pseudo_folder, response in zip(pseudo_folders, responses):
+            if not response.is_success:
+                raise ValueError("Vertigo - Error creating pseudo-folder")
+            obj_list.append(pseudo_folder)
 
     def _get_object_list(self, path):
         """
@@ -135,8 +303,8 @@ class VertigoProxyHandler(VertigoBaseHandler):
         obj_list = list()
 
         dest_path = os.path.join('/', self.api_version, self.account, self.container)
-        new_env = dict(self.request.environ)
-        auth_token = self.request.headers.get('X-Auth-Token')
+        query_string = None
+        pseudo_folder = ''
 
         if path == '*':
             # All objects inside a container hierarchy
@@ -145,20 +313,94 @@ class VertigoProxyHandler(VertigoBaseHandler):
             # All objects inside a pseudo-folder hierarchy
             obj_split = self.obj.rsplit('/', 1)
             pseudo_folder = obj_split[0] + '/'
-            new_env['QUERY_STRING'] = 'prefix='+pseudo_folder
+            query_string = 'prefix='+pseudo_folder
 
-        sub_req = make_subrequest(new_env, 'GET', dest_path,
-                                  headers={'X-Auth-Token': auth_token},
-                                  swift_source='Vertigo')
+        sub_req = self.subrequest_factory.make_subrequest(
+            'GET', dest_path, query_string=query_string)
         response = sub_req.get_response(self.app)
         for obj in response.body.split('\n'):
             if obj != '':
                 obj_list.append(obj)
 
-        self._augment_object_list(obj_list)
+        self._augment_object_list(obj_list, pseudo_folder)
 
         return obj_list
 
+    def _get_link_target(self, dest_obj):
+        """
+        Gets the target object of a link, from the cache if possible
+        :param dest_obj: container/object
+        :return: swift.common.swob.Response Instance
+        """
+        obj = os.path.join(self.account, dest_obj)
+        if self._is_object_in_cache(obj):
+            return self._get_cached_object(obj)
+        return self._admit_to_cache(obj, self._get_linked_object(dest_obj))
+
+    def _follow_link_chain(self, link, response, get_target):
+        """
+        Follows a (multi-hop) link chain until a real object, storing every
+        hop into the link cache
+        :param link: container/object of the response object
+        :param response: swift.common.swob.Response Instance of the link
+        :param get_target: function that gets the response of a container/object
+        :raise HTTPConflict: if the link chain has a cycle
+        :return: container/object and response of the real object
+        """
+        visited = set([link])
+        while response.headers['Content-Type'] == 'vertigo/link':
+            dest_obj = response.headers['X-Object-Sysmeta-Vertigo-Link-to']
+            if dest_obj in visited or len(visited) > MAX_LINK_HOPS:
+                raise HTTPConflict('Vertigo - Error: Link loop detected in "' +
+                                   link + '".\n')
+            visited.add(dest_obj)
+            response = get_target(dest_obj)
+            if response.is_success:
+                cache_link(self, link, dest_obj, response.headers)
+            link = dest_obj
+
+        return link, response
+
+    @staticmethod
+    def _is_stale_link_target(response, etag):
+        """
+        Checks whether the target got by a link cache entry is not the object
+        the entry was cached for
+        :param response: swift.common.swob.Response Instance of the target
+        :param etag: ETag of the target stored in the link cache
+        :return: True if the target was overwritten since it was cached
+        """
+        if response.headers.get('Content-Type') == 'vertigo/link':
+            # The target became a link: the chain is followed from here
+            return False
+        target_etag = response.headers.get('Etag')
+        return bool(etag and target_etag and
+                    etag.strip('"') != target_etag.strip('"'))
+
+    def _verify_access_to_link_target(self, cont, obj):
+        """
+        Verifies access to the specified object in swift. Whether the object
+        is a link, verifies access to its target.
+        :param cont: swift container name
+        :param obj: swift object name
+        :return: container/object of the real object
+        """
+        def verify_access_to(dest_obj):
+            return self._verify_access(*dest_obj.split('/', 1))
+
+        link = os.path.join(cont, obj)
+        dest_obj, _ = get_cached_link_target(self, link)
+        if dest_obj:
+            try:
+                return self._follow_link_chain(
+                    dest_obj, verify_access_to(dest_obj), verify_access_to)[0]
+            except HTTPNotFound:
+                # Stale link cache entry
+                invalidate_link(self, link)
+
+        return self._follow_link_chain(link, verify_access_to(link),
+                                       verify_access_to)[0]
+
     def _get_linked_object(self, dest_obj):
         """
         Makes a subrequest to the provided container/object
@@ -166,66 +408,68 @@ class VertigoProxyHandler(VertigoBaseHandler):
         :return: swift.common.swob.Response Instance
         """
         dest_path = os.path.join('/', self.api_version, self.account, dest_obj)
-        new_env = dict(self.request.environ)
-        sub_req = make_subrequest(new_env, 'GET', dest_path,
-                                  headers=self.request.headers,
-                                  swift_source='Vertigo')
+        headers = dict(self.request.headers)
+        dest_cont, dest_obj = dest_obj.split('/', 1)
+        self._forward_policy(headers, get_parent_policy_id(
+            self.api_version, self.account, dest_cont, dest_obj))
+        sub_req = self.subrequest_factory.make_subrequest(
+            'GET', dest_path, headers=headers)
 
         return sub_req.get_response(self.app)
 
-    def _get_parent_vertigo_metadata(self):
+    @property
+    def parent_policy(self):
         """
-        Makes a HEAD to the parent pseudo-folder or container (7ms overhead)
-        in order to get the microcontroller assignated metadata.
-        :return: vertigo metadata dictionary
+        Policy inherited by the object from its parent container or
+        pseudo-folder, resolved once per request
+        :return: (policy_id, version, TriggerTable instance or None) tuple
         """
-        obj_split = self.obj.rsplit('/', 1)
-
-        if len(obj_split) > 1:
-            # object parent is pseudo-foldder
-            psudo_folder = obj_split[0] + '/'
-            mc_key = 'X-Object-Sysmeta-Vertigo-Microcontroller'
-            dest_path = os.path.join('/', self.api_version, self.account, self.container, psudo_folder)
+        if self._parent_policy is None:
+            policy_id = get_parent_policy_id(self.api_version, self.account,
+                                             self.container, self.obj)
+            version, table = self.policy_store.get(self, policy_id)
+            self._parent_policy = (policy_id, version, table)
+        return self._parent_policy
+
+    def get_trigger_table(self, headers):
+        """
+        Gets the triggers of the requested object: its own ones over the
+        inherited policy
+        :param headers: object headers
+        :return: TriggerTable instance or None
+        """
+        policy_id, version, policy = self.parent_policy
+        reference = get_policy_reference(headers, SYSMETA_OBJ_HEADER)
+        if reference and reference[0] == policy_id and \
+                is_newer_version(reference[1], version):
+            # The object was assigned a policy newer than the cached one
+            version, policy = self.policy_store.get(self, policy_id,
+                                                    reference[1])
+            self._parent_policy = (policy_id, version, policy)
+        return get_effective_table(headers, SYSMETA_OBJ_HEADER, policy_id,
+                                   policy)
+
+    def get_microcontroller_list(self, headers, method):
+        table = self.get_trigger_table(headers)
+        return table.get_list('on' + method) if table else None
+
+    def _forward_policy(self, headers, policy_id=None):
+        """
+        Forwards the inherited policy to the object server, which can not
+        resolve it
+        :param headers: headers of the request to the object server
+        :param policy_id: policy to forward. By default, the one of the
+                          requested object.
+        """
+        if policy_id is None:
+            policy_id, version, policy = self.parent_policy
         else:
-            # object parent is container
-            mc_key = 'X-Container-Sysmeta-Vertigo-Microcontroller'
-            dest_path = os.path.join('/', self.api_version, self.account, self.container)
-
-        # We first try to get the microcontroller execution list from the memcache
-        vertigo_metadata = self.memcache.get("vertigo_"+dest_path)
-
-        if vertigo_metadata:
-            for key in vertigo_metadata.keys():
-                if key.replace('Container', 'Object').startswith('X-Object-Sysmeta-Vertigo-'):
-                    if key == mc_key:
-                        mc = eval(vertigo_metadata.pop(key))
-                        vertigo_metadata[key.replace('Container', 'Object')] = mc
-                    else:
-                        vertigo_metadata[key.replace('Container', 'Object')] = vertigo_metadata.pop(key)
-            return vertigo_metadata
-
-        # If the microcontroller execution list is not in memcache, we get it from Swift
-        new_env = dict(self.request.environ)
-        auth_token = self.request.headers.get('X-Auth-Token')
-        sub_req = make_subrequest(new_env, 'HEAD', dest_path,
-                                  headers={'X-Auth-Token': auth_token},
-                                  swift_source='Vertigo')
-        response = sub_req.get_response(self.app)
-
-        vertigo_metadata = dict()
-        if response.is_success:
-            for key in response.headers:
-                if key.replace('Container', 'Object').startswith('X-Object-Sysmeta-Vertigo-'):
-                    # if key.replace('Container', 'Object').startswith('X-Object-Sysmeta-Vertigo-Onput'):
-                    #    continue
-                    if key == mc_key:
-                        mc = eval(response.headers[key])
-                        # del mc['onput']
-                        vertigo_metadata[key.replace('Container', 'Object')] = mc
-                    else:
-                        vertigo_metadata[key.replace('Container', 'Object')] = response.headers[key]
-        self.memcache.set("vertigo_"+dest_path, vertigo_metadata)
-        return vertigo_metadata
+            version, policy = self.policy_store.get(self, policy_id)
+        # An empty policy is forwarded too, so the object server does not
+        # resolve it again
+        headers[BACKEND_POLICY_REFERENCE_HEADER] = \
+            make_policy_reference(policy_id, version)
+        headers[BACKEND_POLICY_HEADER] = (policy or TriggerTable()).encode()
 
     def _process_trigger_assignation_deletion_request(self):
         """
@@ -238,11 +482,6 @@ class VertigoProxyHandler(VertigoBaseHandler):
             _, micro_controller = self.get_mc_assignation_data()
             self._verify_access(self.mc_container, micro_controller)
 
-        if '*' in self.obj:
-            obj_list = self._get_object_list(self.obj)
-        else:
-            obj_list.append(self.obj)
-
         specific_md = self.request.body
 
         if self.obj == '*':
@@ -250,23 +489,41 @@ class VertigoProxyHandler(VertigoBaseHandler):
             if self.is_trigger_assignation:
                 trigger, micro_controller = self.get_mc_assignation_data()
                 set_microcontroller_container(self, trigger, micro_controller)
+                msg = 'Vertigo - Microcontroller "' + micro_controller + \
+                    '" correctly assigned to the "' + trigger + '" trigger.\n'
             elif self.is_trigger_deletion:
                 trigger, micro_controller = self.get_mc_deletion_data()
                 delete_microcontroller_container(self, trigger, micro_controller)
+                msg = 'Vertigo - Microcontroller "' + micro_controller + \
+                    '" correctly removed from the "' + trigger + '" trigger.\n'
+            container_path = os.path.join('/', self.api_version, self.account,
+                                          self.container)
+            self.policy_store.invalidate(self, container_path)
+            if not config_true_value(self.conf.get('policy_fanout')):
+                # The objects inherit the container policy by reference
+                return Response(body=msg, headers={'etag': ''},
+                                request=self.request)
+
+        if '*' in self.obj:
+            obj_list = self._get_object_list(self.obj)
+        else:
+            obj_list.append(self.obj)
 
         for obj in obj_list:
             self.request.body = specific_md
-            response = self._verify_access(self.container, obj)
-            new_path = os.path.join('/', self.api_version, self.account, self.container, obj)
-            if response.headers['Content-Type'] == 'vertigo/link':
-                link = response.headers["X-Object-Sysmeta-Vertigo-Link-to"]
-                container, obj = link.split('/', 2)
-                self._verify_access(container, obj)
-                new_path = os.path.join('/', self.api_version, self.account, container, obj)
+            dest_obj = self._verify_access_to_link_target(self.container, obj)
+            self._invalidate_cached_object(os.path.join(self.account, dest_obj))
+            new_path = os.path.join('/', self.api_version, self.account, dest_obj)
             self.request.environ['PATH_INFO'] = new_path
             self._augment_empty_request()
+            dest_cont, dest_obj = dest_obj.split('/', 1)
+            self._forward_policy(self.request.headers, get_parent_policy_id(
+                self.api_version, self.account, dest_cont, dest_obj))
 
             response = self.request.get_response(self.app)
+            if dest_obj.endswith('/'):
+                # The objects in the pseudo-folder inherit its policy
+                self.policy_store.invalidate(self, new_path)
 
         return response
 
@@ -278,6 +535,8 @@ class VertigoProxyHandler(VertigoBaseHandler):
         link_path = os.path.join(self.container, self.obj)
         dest_path = self.request.headers['X-Vertigo-Link-To']
         if link_path != dest_path:
+            self._invalidate_cached_object(
+                os.path.join(self.account, link_path))
             response = self._verify_access(self.container, self.obj)
             headers = response.headers
             if "X-Object-Sysmeta-Vertigo-Link-to" not in response.headers \
@@ -294,6 +553,37 @@ class VertigoProxyHandler(VertigoBaseHandler):
                                 request=self.request)
         return response
 
+    def _process_object_prefetch(self):
+        """
+        Queues a prefetch intent sent by a microcontroller through the API
+        bus for the requested object. The object is fetched in background,
+        without running its microcontrollers, into the hot-object cache.
+        The bus only exists on the proxy: prefetching is not available to
+        the microcontrollers run by the object servers or the timers.
+        """
+        if not self.request.environ.get(API_BUS_ENV_KEY):
+            msg = 'Vertigo - Error: Prefetch intents are only accepted ' \
+                'from microcontrollers.\n'
+            return HTTPForbidden(body=msg, request=self.request)
+        prefetch_engine = self.conf.get('prefetch_engine')
+        if prefetch_engine is None:
+            msg = 'Vertigo - Error: Prefetching is disabled.\n'
+            return Response(body=msg, headers={'etag': ''}, status=400,
+                            request=self.request)
+
+        obj = os.path.join(self.account, self.container, self.obj)
+        path = os.path.join('/', self.api_version, obj)
+        sub_req = self.subrequest_factory.make_subrequest(
+            'GET', path,
+            headers={'X-Auth-Token': self.subrequest_factory.auth_token,
+                     'mc-enabled': False})
+        if prefetch_engine.prefetch(obj, sub_req, self.memcache):
+            msg = 'Vertigo - Object "' + obj + '" queued for prefetching.\n'
+        else:
+            msg = 'Vertigo - Object "' + obj + '" already prefetched.\n'
+        return Response(body=msg, headers={'etag': ''}, status=202,
+                        request=self.request)
+
     def _check_microcntroller_execution(self, obj):
         user_agent = self.request.headers['User-Agent']
         if user_agent == "vertigo/microcontroller":
@@ -316,7 +606,7 @@ class VertigoProxyHandler(VertigoBaseHandler):
         elif mc_data['command'] == 'STORLET':
             slist = mc_data['list']
             self.logger.info('Vertigo - Go to execute Storlets: ' + str(slist))
-            return self.apply_storlet_on_put(self.request, slist)
+            return self._put_with_storlets(slist)
 
         elif mc_data['command'] == 'CANCEL':
             msg = mc_data['message']
@@ -328,27 +618,67 @@ class VertigoProxyHandler(VertigoBaseHandler):
         """
         GET handler on Proxy
         """
+        coalescer = self.conf.get('request_coalescer')
+        if coalescer is None:
+            return self._process_get()
+
+        obj = os.path.join(self.account, self.container, self.obj)
+        return coalescer.get_response(self, obj, self._process_get)
+
+    def _process_get(self):
+        """
+        Runs the GET pipeline: backend fetch (or cache), link resolution and
+        proxy storlets
+        """
         obj = os.path.join(self.account, self.container, self.obj)
         # self._check_microcntroller_execution(obj)
 
-        if self._is_object_in_cache(obj):
-            response = self._get_cached_object(obj)
-        else:
-            response = self.request.get_response(self.app)
+        response = None
+        self._forward_policy(self.request.headers)
+        planner = self.conf.get('storlet_planner')
+        if planner is not None:
+            # For the placement of the storlets in the object server
+            self.request.headers[BACKEND_PROXY_LOAD_HEADER] = \
+                '%.2f' % planner.get_load()
+        link = os.path.join(self.container, self.obj)
+        dest_obj, dest_etag = get_cached_link_target(self, link)
+        if dest_obj:
+            # Known link: go straight to the target
+            response = self._get_link_target(dest_obj)
+            if response.is_success and \
+                    not self._is_stale_link_target(response, dest_etag):
+                link = dest_obj
+            else:
+                # Stale link cache entry
+                invalidate_link(self, link)
+                response = None
 
-        if response.headers['Content-Type'] == 'vertigo/link':
-            dest_obj = response.headers['X-Object-Sysmeta-Vertigo-Link-to']
-            obj = os.path.join(self.account, dest_obj)
+        if response is None:
             if self._is_object_in_cache(obj):
                 response = self._get_cached_object(obj)
             else:
-                response = self._get_linked_object(dest_obj)
+                response = self._admit_to_cache(
+                    obj, self.request.get_response(self.app))
+
+        _, response = self._follow_link_chain(link, response,
+                                              self._get_link_target)
+
+        storlet_list = get_pending_storlet_list(response.headers,
+                                                self.execution_server)
+        if storlet_list and not self.is_range_request and \
+                self.conf.get('storlet_pending_get') == 'transform':
+            # Transformation still pending: run it on demand
+            self.logger.info('Vertigo - Pending transformation on demand')
+            response = self.apply_storlet_on_get(response, storlet_list)
 
         if 'Storlet-List' in response.headers and \
                 self.is_account_storlet_enabled():
             self.logger.info('Vertigo - There are Storlets to execute')
             storlet_list = json.loads(response.headers.pop('Storlet-List'))
-            response = self.apply_storlet_on_get(response, storlet_list)
+            if is_slo_manifest(response.headers):
+                response = self._get_large_object(response, storlet_list)
+            else:
+                response = self.apply_storlet_on_get(response, storlet_list)
 
         if 'Content-Length' not in response.headers:
             response.headers['Content-Length'] = None
@@ -357,6 +687,161 @@ class VertigoProxyHandler(VertigoBaseHandler):
 
         return response
 
+    def _get_sub_manifest(self, segment):
+        path = '/' + self.api_version + '/' + self.account + segment['name']
+        sub_req = self.subrequest_factory.make_subrequest(
+            'GET', quote(path) + '?multipart-manifest=get',
+            headers={'X-Auth-Token': self.subrequest_factory.auth_token,
+                     'mc-enabled': False})
+        response = sub_req.get_response(self.app)
+        if not response.is_success:
+            raise ValueError('Vertigo - Error reading the manifest %s: %s' %
+                             (segment['name'], response.status))
+        return response.body
+
+    def _get_segment(self, segment, storlet_list):
+        """
+        GETs a segment of a large object, with its segment-local storlets
+        run by the object server that holds it. Only these segment reads
+        skip the microcontrollers of the segment; the ones made by the SLO
+        middleware run them as any other GET.
+        """
+        if 'data' in segment:
+            # Inline segment: its storlets run here
+            response = Response(body=base64.b64decode(segment['data']),
+                                request=self.request)
+            if not storlet_list:
+                return response.app_iter
+            for entry in storlet_list.values():
+                entry['server'] = self.execution_server
+            gateway = VertigoGatewayStorlet(
+                self.conf, self.logger, self.app, self.api_version,
+                self.account, self.request.method)
+            return gateway.run(response, storlet_list,
+                               response.app_iter).app_iter
+
+        headers = {'X-Auth-Token': self.subrequest_factory.auth_token,
+                   'mc-enabled': False}
+        if segment.get('range'):
+            headers['Range'] = 'bytes=' + segment['range']
+        if storlet_list:
+            headers[BACKEND_STORLET_LIST_HEADER] = json.dumps(storlet_list)
+        path = '/' + self.api_version + '/' + self.account + segment['name']
+        response = self.subrequest_factory.make_subrequest(
+            'GET', quote(path), headers=headers).get_response(self.app)
+        if not response.is_success:
+            if hasattr(response.app_iter, 'close'):
+                response.app_iter.close()
+            raise ValueError('Vertigo - Error reading the segment %s: %s' %
+                             (segment['name'], response.status))
+        if not storlet_list:
+            # The segment-local storlets change the ETag and the size
+            try:
+                check_segment(segment, response)
+            except ValueError:
+                if hasattr(response.app_iter, 'close'):
+                    response.app_iter.close()
+                raise
+        return response.app_iter
+
+    def _get_large_object(self, manifest_response, storlet_list):
+        """
+        Runs the storlets of an onget STORLET verdict over a SLO. The
+        leading segment-local storlets run on each segment, in the object
+        servers, in parallel. The segments are reassembled in order, and the
+        rest of the storlets run here over the whole object.
+        """
+        self._setup_storlet_gateway()
+        segment_list, rest = \
+            self.storlet_gateway.split_segment_local(storlet_list)
+
+        segments = iter_segments(manifest_response.body,
+                                 self._get_sub_manifest)
+        body = SegmentAssembler(
+            segments,
+            lambda segment: self._get_segment(segment, dict(
+                (key, dict(entry)) for key, entry in segment_list.items())),
+            int(self.conf.get('slo_segment_concurrency', 4)),
+            int(self.conf.get('slo_segment_buffer_chunks', 16)))
+
+        headers = dict((key, value)
+                       for key, value in manifest_response.headers.items()
+                       if key not in ('X-Static-Large-Object',
+                                      'Content-Length', 'Etag') and
+                       not key.startswith('X-Object-Sysmeta-Slo-'))
+        if 'Content-Type' in headers:
+            headers['Content-Type'] = ';'.join(
+                param for param in headers['Content-Type'].split(';')
+                if not param.strip().startswith('swift_bytes='))
+        response = Response(app_iter=body, headers=headers,
+                            request=self.request)
+
+        if rest:
+            return self.apply_storlet_on_get(response, rest)
+        if self.is_range_request:
+            self.serve_request_ranges(response)
+        return response
+
+    def _put_with_storlets(self, storlet_list):
+        """
+        Puts the object through the storlets of an onput STORLET verdict.
+        With a transform worker (storlet_put_mode = deferred), the original
+        is committed right away, marked as pending, and transformed in the
+        background.
+        """
+        worker = self.conf.get('transform_worker')
+        if worker is None:
+            self.apply_storlet_on_put(self.request, storlet_list)
+            return self.request.get_response(self.app)
+
+        self.request.headers[PENDING_TRANSFORM_HEADER] = \
+            json.dumps(storlet_list)
+        response = self.request.get_response(self.app)
+        if response.is_success:
+            worker.memcache = self.memcache
+            worker.start()
+            path = os.path.join('/', self.api_version, self.account,
+                                self.container, self.obj)
+            if not worker.enqueue(path, response.headers.get('Etag')):
+                self.logger.increment('vertigo.transform.dropped')
+                self.logger.error('Vertigo - Transform queue full, ' +
+                                  path + ' stays untransformed')
+        return response
+
+    def _streaming_put(self, mc_list, policy):
+        """
+        Forwards the upload while the onput verdict is computed, holding
+        its commit until the verdict arrives. CANCEL aborts the upload, and
+        STORLET replays it through the storlets.
+        """
+        self.logger.info('Vertigo - There are microcontrollers' +
+                         ' to execute while streaming: ' + str(mc_list))
+        self._setup_docker_gateway()
+        invocation = eventlet.spawn(
+            self.mc_docker_gateway.execute_microcontrollers, mc_list, policy)
+        spool = tempfile.SpooledTemporaryFile(
+            int(self.conf.get('streaming_put_spool_size', 1048576)))
+        held_input = VerdictHeldInput(self.request.environ['wsgi.input'],
+                                      self.request.content_length,
+                                      invocation, spool)
+        self.request.environ['wsgi.input'] = held_input
+
+        response = self.request.get_response(self.app)
+        if held_input.verdict is None and not response.is_success:
+            # Failed before the end of the upload
+            return response
+        mc_data = held_input.verdict or invocation.wait()
+
+        if mc_data['command'] == 'STORLET':
+            self.logger.info('Vertigo - Upload restarted to execute '
+                             'Storlets: ' + str(mc_data['list']))
+            self.request.environ['wsgi.input'] = held_input.replay()
+            return self._put_with_storlets(mc_data['list'])
+        elif mc_data['command'] == 'CANCEL':
+            return Response(body=mc_data['message'] + '\n',
+                            headers={'etag': ''}, request=self.request)
+        return response
+
     @public
     def PUT(self):
         """
@@ -373,14 +858,23 @@ class VertigoProxyHandler(VertigoBaseHandler):
             # parent container or pseudo-folder are assigned by default to
             # the new object. Onput microcontrollers are executed here.
             # start = time.time()
-            mc_metadata = self._get_parent_vertigo_metadata()
-            self.request.headers.update(mc_metadata)
-            mc_list = get_microcontroller_list_object(mc_metadata, self.method)
-            if mc_list:
+            invalidate_link(self, os.path.join(self.container, self.obj))
+            self._invalidate_cached_object(
+                os.path.join(self.account, self.container, self.obj))
+            # The new object only stores a reference to the parent policy
+            policy_id, version, policy = self.parent_policy
+            self.request.headers[SYSMETA_OBJ_HEADER + POLICY_KEY] = \
+                make_policy_reference(policy_id, version)
+            mc_list = policy.get_list('on' + self.method) if policy else None
+            if mc_list and self.request.content_length != 0 and \
+                    config_true_value(self.conf.get('streaming_put')):
+                response = self._streaming_put(mc_list, policy)
+            elif mc_list:
                 self.logger.info('Vertigo - There are microcontrollers' +
                                  ' to execute: ' + str(mc_list))
                 self._setup_docker_gateway()
-                mc_data = self.mc_docker_gateway.execute_microcontrollers(mc_list)
+                mc_data = self.mc_docker_gateway.execute_microcontrollers(
+                    mc_list, policy)
                 # end = time.time() - start
                 response = self._process_mc_data(mc_data)
                 # f = open("/tmp/vertigo/vertigo_put_overhead.log", 'a')
@@ -402,7 +896,11 @@ class VertigoProxyHandler(VertigoBaseHandler):
             pass
         elif self.is_object_move:
             response = self._process_object_move_and_link()
+        elif self.is_object_prefetch:
+            response = self._process_object_prefetch()
         else:
+            self._invalidate_cached_object(
+                os.path.join(self.account, self.container, self.obj))
             response = self.request.get_response(self.app)
 
         return response
@@ -419,11 +917,86 @@ class VertigoProxyHandler(VertigoBaseHandler):
                     new_key = key.replace('Container', 'Object').replace('X-Object-Sysmeta-', '')
                     response.headers[new_key] = response.headers[key]
 
-            if 'Vertigo-Microcontroller' in response.headers:
-                mc_dict = eval(response.headers['Vertigo-Microcontroller'])
-                for trigger in mc_dict.keys():
-                    if not mc_dict[trigger]:
-                        del mc_dict[trigger]
-                response.headers['Vertigo-Microcontroller'] = mc_dict
+            if self.obj:
+                table = self.get_trigger_table(response.headers)
+            else:
+                table = load_trigger_table(response.headers,
+                                           SYSMETA_CONTAINER_HEADER)
+            if table:
+                response.headers['Vertigo-Microcontroller'] = \
+                    dict(table.triggers)
+                for (trigger, mc), params in table.params.items():
+                    response.headers[('Vertigo-' + trigger + '-' + mc).title()] = params
+
+        return response
+
+    def _get_ondelete_mode(self, table, mc):
+        """
+        Gets the execution mode of an ondelete microcontroller: the 'mode'
+        of its parameters, or ondelete_mode
+        :return: 'sync' or 'deferred'
+        """
+        mode = self.conf.get('ondelete_mode', 'sync')
+        params = table.params.get(('ondelete', mc))
+        if params:
+            try:
+                mode = json.loads(params).get('mode', mode)
+            except (ValueError, AttributeError):
+                pass
+        return 'deferred' if mode == 'deferred' else 'sync'
+
+    @public
+    def DELETE(self):
+        """
+        DELETE handler on Proxy. Synchronous ondelete microcontrollers run
+        before the delete, and can cancel it. Deferred ones are queued after
+        the delete is committed, with the headers that the object had.
+        """
+        invalidate_link(self, os.path.join(self.container, self.obj))
+        self._invalidate_cached_object(
+            os.path.join(self.account, self.container, self.obj))
+        invoker = self.conf.get('deferred_invoker')
+        if invoker is None or self.obj.endswith('/'):
+            return self.request.get_response(self.app)
+        invoker.start()
+
+        path = os.path.join('/', self.api_version, self.account,
+                            self.container, self.obj)
+        head_resp = self.subrequest_factory.make_subrequest(
+            'HEAD', path).get_response(self.app)
+        table = self.get_trigger_table(head_resp.headers) \
+            if head_resp.is_success else None
+        mc_list = table.get_list('ondelete') if table else None
+        if not mc_list:
+            return self.request.get_response(self.app)
+
+        sync_list = [mc for mc in mc_list
+                     if self._get_ondelete_mode(table, mc) == 'sync']
+        deferred_list = [mc for mc in mc_list if mc not in sync_list]
+
+        if sync_list:
+            self.logger.info('Vertigo - There are microcontrollers' +
+                             ' to execute: ' + str(sync_list))
+            self._setup_docker_gateway(head_resp)
+            mc_data = self.mc_docker_gateway.execute_microcontrollers(
+                sync_list, table)
+            if mc_data['command'] == 'CANCEL':
+                return HTTPForbidden(body=mc_data['message'] + '\n',
+                                     request=self.request)
+            if mc_data['command'] == 'STORLET':
+                self.logger.warning('Vertigo - Storlets can not run on '
+                                    'DELETE requests')
+
+        response = self.request.get_response(self.app)
+        if deferred_list and response.is_success:
+            self.logger.info('Vertigo - Deferring microcontrollers: ' +
+                             str(deferred_list))
+            if invoker.enqueue(self.request, head_resp.headers,
+                               deferred_list, table):
+                self.logger.increment('vertigo.deferred.queued')
+            else:
+                self.logger.increment('vertigo.deferred.dropped')
+                self.logger.error('Vertigo - Deferred queue full, dropping '
+                                  'ondelete microcontrollers of ' + path)
 
         return response
@@ -0,0 +1,75 @@
+"""
+Times the search of the missing pseudo-folders of an object listing, done
+before assigning a microcontroller to a container or pseudo-folder with '*'.
+It compares get_missing_pseudo_folders() with the former scan of the
+listing, which looked up the parent of each object in the list itself (that
+one is only run up to --max-scan names, as it is quadratic).
+
+    python -m vertigo_middleware.tools.bench_pseudo_folders --names 10000
+"""
+from vertigo_middleware.common.utils import get_missing_pseudo_folders
+import argparse
+import sys
+import time
+
+
+def make_listing(names, depth, folders):
+    """
+    :returns: sorted listing of names spread over folders pseudo-folders of
+              each level, without their markers
+    """
+    listing = list()
+    for i in range(names):
+        path = '/'.join('d%d-%d' % (level, (i // (level + 1)) % folders)
+                        for level in range(depth - 1))
+        listing.append('%s/o%d' % (path, i) if path else 'o%d' % i)
+    return sorted(listing)
+
+
+def scan_missing_pseudo_folders(obj_list):
+    """
+    Former search: direct parents only, looked up in the list
+    """
+    missing = list()
+    for obj in obj_list:
+        if '/' in obj:
+            pseudo_folder = obj.rsplit('/', 1)[0] + '/'
+            if pseudo_folder not in obj_list and \
+                    pseudo_folder not in missing:
+                missing.append(pseudo_folder)
+    return missing
+
+
+def timed(func, *args):
+    start = time.time()
+    result = func(*args)
+    return time.time() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Times the search of missing pseudo-folders')
+    parser.add_argument('--names', type=int, action='append',
+                        help='listing sizes (default 10000, 100000, 1000000)')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='levels of the names, the object included')
+    parser.add_argument('--folders', type=int, default=1000,
+                        help='pseudo-folders per level')
+    parser.add_argument('--max-scan', type=int, default=10000,
+                        help='largest listing timed with the former scan')
+    args = parser.parse_args()
+
+    for names in args.names or [10000, 100000, 1000000]:
+        listing = make_listing(names, args.depth, args.folders)
+        elapsed, missing = timed(get_missing_pseudo_folders, listing)
+        line = '%d names, %d pseudo-folders: %.3fs' % (names, len(missing),
+                                                      elapsed)
+        if names <= args.max_scan:
+            elapsed, _ = timed(scan_missing_pseudo_folders, listing)
+            line += ' (former scan: %.3fs)' % elapsed
+        print(line)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
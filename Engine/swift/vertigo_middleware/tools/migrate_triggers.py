@@ -0,0 +1,147 @@
+"""
+Rewrites the Vertigo trigger metadata of existing objects and containers
+in place, from the legacy format (str(dict) plus one sysmeta key per
+microcontroller parameters) to the compact versioned format.
+
+Objects are migrated on each storage node, walking its local devices.
+Containers are migrated through the internal client. The middleware
+understands both formats, so the migration can run online and be resumed
+at any time.
+"""
+from swift.common.internal_client import InternalClient
+from swift.common.storage_policy import POLICIES
+from swift.common.swob import HeaderKeyDict
+from swift.common.utils import audit_location_generator, ratelimit_sleep
+from swift.obj.diskfile import get_data_dir
+from vertigo_middleware.common.triggers import load_trigger_table, \
+    store_trigger_table
+from vertigo_middleware.common.utils import update_object_metadata, \
+    get_object_metadata, SYSMETA_OBJ_HEADER, SYSMETA_CONTAINER_HEADER, LOCAL_PROXY
+import argparse
+import logging
+import time
+import sys
+
+
+class TriggerMigrator(object):
+
+    def __init__(self, max_rate, report_interval, dry_run, logger):
+        self.max_rate = max_rate
+        self.report_interval = report_interval
+        self.dry_run = dry_run
+        self.logger = logger
+        self.running_time = 0
+        self.last_report = time.time()
+        self.processed = 0
+        self.migrated = 0
+        self.errors = 0
+
+    def _throttle(self):
+        self.processed += 1
+        self.running_time = ratelimit_sleep(self.running_time, self.max_rate)
+        if time.time() - self.last_report >= self.report_interval:
+            self.report()
+
+    def report(self):
+        self.logger.info('Processed: %d, migrated: %d, errors: %d' %
+                         (self.processed, self.migrated, self.errors))
+        self.last_report = time.time()
+
+    def _migrate_metadata(self, metadata, sysmeta_prefix, empty_value=None):
+        """
+        :returns: whether the metadata has been rewritten
+        """
+        table = load_trigger_table(metadata, sysmeta_prefix)
+        if self.dry_run:
+            return store_trigger_table(dict(metadata), table,
+                                       sysmeta_prefix, empty_value)
+        return store_trigger_table(metadata, table, sysmeta_prefix,
+                                   empty_value)
+
+    def migrate_objects(self, devices, mount_check):
+        for policy in POLICIES:
+            locations = audit_location_generator(
+                devices, get_data_dir(policy), '.data',
+                mount_check=mount_check, logger=self.logger)
+            for data_file, _device, _partition in locations:
+                self._throttle()
+                changed = list()
+
+                def migrate(metadata):
+                    changed.append(self._migrate_metadata(
+                        metadata, SYSMETA_OBJ_HEADER))
+
+                try:
+                    if self.dry_run:
+                        migrate(get_object_metadata(data_file) or dict())
+                    else:
+                        update_object_metadata(data_file, migrate)
+                except Exception:
+                    self.errors += 1
+                    self.logger.exception('Error migrating ' + data_file)
+                    continue
+                if changed and changed[0]:
+                    self.migrated += 1
+
+    def migrate_containers(self, accounts, internal_client_conf):
+        client = InternalClient(internal_client_conf, 'Vertigo Migrator', 3)
+        for account in accounts:
+            for container in client.iter_containers(account):
+                self._throttle()
+                name = container['name']
+                try:
+                    metadata = HeaderKeyDict(client.get_container_metadata(
+                        account, name, metadata_prefix=SYSMETA_CONTAINER_HEADER))
+                    metadata = HeaderKeyDict(
+                        (SYSMETA_CONTAINER_HEADER + key, value)
+                        for key, value in metadata.items())
+                    if not self._migrate_metadata(
+                            metadata, SYSMETA_CONTAINER_HEADER, ''):
+                        continue
+                    if not self.dry_run:
+                        client.set_container_metadata(account, name,
+                                                      metadata)
+                except Exception:
+                    self.errors += 1
+                    self.logger.exception('Error migrating %s/%s' %
+                                          (account, name))
+                    continue
+                self.migrated += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Migrates Vertigo trigger metadata to the compact format')
+    parser.add_argument('--objects', action='store_true',
+                        help='migrate the objects of the local devices')
+    parser.add_argument('--devices', default='/srv/node')
+    parser.add_argument('--skip-mount-check', action='store_true')
+    parser.add_argument('--account', action='append', default=[],
+                        help='migrate the containers of the account '
+                             '(can be repeated)')
+    parser.add_argument('--internal-client-conf', default=LOCAL_PROXY)
+    parser.add_argument('--max-rate', type=float, default=100,
+                        help='maximum items per second (default: 100)')
+    parser.add_argument('--report-interval', type=float, default=60,
+                        help='seconds between progress reports')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only count the items to migrate')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    logger = logging.getLogger('vertigo-migrate-triggers')
+
+    migrator = TriggerMigrator(args.max_rate, args.report_interval,
+                               args.dry_run, logger)
+    if args.objects:
+        migrator.migrate_objects(args.devices, not args.skip_mount_check)
+    if args.account:
+        migrator.migrate_containers(args.account, args.internal_client_conf)
+    migrator.report()
+
+    return 1 if migrator.errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,135 @@
+"""
+Fires the ontimer microcontrollers of the objects of a storage node.
+
+The timers are loaded from the node-local trigger index (see
+vertigo-trigger-index), and run in the sandbox of their tenant with the
+gateway conf of the object-server Vertigo filter. Each object is fired only
+by the node that holds its first primary replica.
+"""
+from swift.common.ring.utils import is_local_device
+from swift.common.storage_policy import POLICIES
+from swift.common.swob import Request, Response
+from swift.common.utils import readconf, whataremyips
+from vertigo_middleware.common.policies import BackendPolicyStore, \
+    get_object_trigger_table
+from vertigo_middleware.common.scheduler import TimerScheduler
+from vertigo_middleware.common.trigger_index import TriggerIndex, \
+    DEFAULT_INDEX_PATH
+from vertigo_middleware.common.utils import get_object_metadata
+from vertigo_middleware.gateways import VertigoGatewayDocker
+from vertigo_middleware.gateways.docker.runtime import RunTimeSandbox
+from vertigo_middleware.vertigo_handler import load_vertigo_conf
+import argparse
+import logging
+import os
+import sys
+
+
+class PrimaryNodeFilter(object):
+    """
+    Selects the objects whose timers are fired by this node: the ones in the
+    partitions of which it holds the first primary replica. The other
+    primaries and the handoffs skip them. While that node is down, its
+    timers wait, and are then fired following their catch_up rule.
+    """
+
+    def __init__(self, conf):
+        self.swift_dir = conf.get('swift_dir', '/etc/swift')
+        self.devices = conf.get('devices', '/srv/node')
+        self.port = int(conf.get('bind_port', 6200))
+        self.ips = whataremyips(conf.get('bind_ip', '0.0.0.0'))
+
+    def __call__(self, data_file):
+        # <devices>/<device>/objects[-<index>]/<partition>/<suffix>/<hash>/
+        try:
+            device, datadir, partition = os.path.relpath(
+                data_file, self.devices).split(os.sep)[:3]
+            policy_index = int(datadir.split('-', 1)[1]) \
+                if '-' in datadir else 0
+            ring = POLICIES.get_object_ring(policy_index, self.swift_dir)
+            node = ring.get_part_nodes(int(partition))[0]
+        except (ValueError, IndexError):
+            return False
+        return node['device'] == device and \
+            is_local_device(self.ips, self.port, node['ip'], node['port'])
+
+
+class DockerTimerSandbox(object):
+    """
+    Runs batches of ontimer invocations in the docker sandbox of a tenant.
+    The sandbox is started once per batch, and the objects of the batch
+    are invoked one after the other.
+    """
+
+    def __init__(self, conf, logger, policy_store=None):
+        self.conf = conf
+        self.logger = logger
+        self.policy_store = policy_store
+
+    def _invoke(self, account, name, data_file, mc_list):
+        metadata = get_object_metadata(data_file)
+        metadata.pop('name', None)
+        table = get_object_trigger_table(metadata, self.policy_store)
+        request = Request.blank('/v1' + name,
+                                environ={'REQUEST_METHOD': 'TIMER'})
+        request.headers['X-Current-Server'] = 'object'
+        request.headers['X-Method'] = 'timer'
+        # Read by the microcontroller API. There is no user token: the API
+        # calls need the API bus, or a token of their own.
+        request.headers['Referer'] = 'TIMER %s%s' % (request.host_url,
+                                                    request.path)
+        request.headers['X-Tenant-Id'] = account.split('_', 1)[-1]
+        response = Response(headers=metadata, request=request)
+        gateway = VertigoGatewayDocker(request, response, self.conf,
+                                       self.logger, account)
+        # The sandbox is started once per batch
+        return gateway.execute_microcontrollers(mc_list,
+                                                trigger_table=table,
+                                                data_file=data_file,
+                                                start_sandbox=False)
+
+    def invoke_batch(self, account, batch):
+        RunTimeSandbox(self.logger, self.conf, account).start()
+        results = dict()
+        for name, data_file, mc_list in batch:
+            try:
+                results[name] = self._invoke(account, name, data_file,
+                                             mc_list)
+            except (OSError, IOError):
+                # Replaced or deleted since it was indexed
+                self.logger.warning('Vertigo - ontimer object not found: ' +
+                                    name)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Fires the Vertigo ontimer microcontrollers of the '
+                    'local objects')
+    parser.add_argument('conf', help='object-server conf file')
+    parser.add_argument('--section', default='filter:vertigo_handler',
+                        help='section of the Vertigo filter')
+    parser.add_argument('--index', default=DEFAULT_INDEX_PATH)
+    parser.add_argument('--sync-interval', type=float, default=300,
+                        help='seconds between trigger index reloads')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    logger = logging.getLogger('vertigo-timer-scheduler')
+
+    conf = readconf(args.conf, args.section)
+    vertigo_conf = load_vertigo_conf(conf)
+    policy_store = BackendPolicyStore(vertigo_conf, logger)
+    scheduler = TimerScheduler(TriggerIndex(args.index),
+                               DockerTimerSandbox(vertigo_conf, logger,
+                                                  policy_store),
+                               vertigo_conf, logger,
+                               policy_store=policy_store,
+                               owner=PrimaryNodeFilter(conf))
+    scheduler.run_forever(args.sync_interval)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
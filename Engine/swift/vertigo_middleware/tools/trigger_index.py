@@ -0,0 +1,187 @@
+"""
+Builds and queries the node-local Vertigo trigger index.
+
+The crawler walks the local devices and indexes the objects with triggers
+of their own, or with a reference to an inherited policy. After the first
+complete crawl, only the data files changed since the start of the last
+complete crawl are read again (xattr writes update their ctime). The
+object-server middleware keeps the index up to date between crawls when
+trigger_index_enabled is set.
+"""
+from swift.common.exceptions import DiskFileNotExist
+from swift.common.storage_policy import POLICIES
+from swift.common.utils import audit_location_generator, ratelimit_sleep
+from swift.obj.diskfile import get_data_dir
+from vertigo_middleware.common.trigger_index import TriggerIndex, \
+    DEFAULT_INDEX_PATH
+from vertigo_middleware.common.triggers import TRIGGERS
+from vertigo_middleware.common.utils import get_object_metadata
+import argparse
+import errno
+import logging
+import time
+import os
+import sys
+
+
+class TriggerIndexer(object):
+
+    def __init__(self, index, max_rate, report_interval, commit_interval,
+                 logger):
+        self.index = index
+        self.max_rate = max_rate
+        self.report_interval = report_interval
+        self.commit_interval = commit_interval
+        self.logger = logger
+
+    def _reset_stats(self):
+        self.running_time = 0
+        self.started = time.time()
+        self.last_report = self.started
+        self.processed = 0
+        self.indexed = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        self.logger.info('Processed: %d (%.1f files/s), indexed: %d, '
+                         'skipped: %d, errors: %d' % (
+                             self.processed, self.processed / elapsed,
+                             self.indexed, self.skipped, self.errors))
+        self.last_report = time.time()
+
+    def _index_file(self, data_file, crawl, since, indexed):
+        if os.stat(data_file).st_ctime < since:
+            # Unchanged since the last complete crawl
+            if data_file in indexed:
+                self.index.touch(data_file, crawl)
+            return
+        self.running_time = ratelimit_sleep(self.running_time, self.max_rate)
+        metadata = get_object_metadata(data_file)
+        if metadata and 'name' in metadata:
+            self.index.update(data_file, metadata, crawl, commit=False)
+            self.indexed += 1
+
+    def crawl(self, devices, mount_check):
+        """
+        Runs a complete crawl of the local devices
+
+        :returns: number of errors
+        """
+        self._reset_stats()
+        crawl, since = self.index.start_crawl(self.started)
+        indexed = self.index.get_data_files()
+        for policy in POLICIES:
+            locations = audit_location_generator(
+                devices, get_data_dir(policy), '.data',
+                mount_check=mount_check, logger=self.logger)
+            for data_file, _device, _partition in locations:
+                self.processed += 1
+                try:
+                    self._index_file(data_file, crawl, since, indexed)
+                except DiskFileNotExist:
+                    # Replaced or deleted during the crawl
+                    self.skipped += 1
+                except (OSError, IOError) as e:
+                    if e.errno == errno.ENOENT:
+                        # Replaced or deleted during the crawl
+                        self.skipped += 1
+                    else:
+                        self.errors += 1
+                        self.logger.error('Error indexing %s: %s' %
+                                          (data_file, e))
+                except Exception:
+                    self.errors += 1
+                    self.logger.exception('Error indexing ' + data_file)
+                if self.processed % self.commit_interval == 0:
+                    self.index.commit()
+                if time.time() - self.last_report >= self.report_interval:
+                    self.report()
+
+        self.index.commit()
+        if self.errors:
+            # Entries of the files that failed would be pruned
+            self.logger.warning('Crawl incomplete, index not pruned')
+        else:
+            pruned = self.index.complete_crawl(crawl, time.time())
+            self.logger.info('Crawl complete, pruned: %d' % pruned)
+        self.report()
+        return self.errors
+
+
+def _crawl(args, logger):
+    index = TriggerIndex(args.index)
+    indexer = TriggerIndexer(index, args.max_rate, args.report_interval,
+                             args.commit_interval, logger)
+    while True:
+        errors = indexer.crawl(args.devices, not args.skip_mount_check)
+        if args.once:
+            return 1 if errors else 0
+        time.sleep(args.interval)
+
+
+def _query(args, logger):
+    index = TriggerIndex(args.index)
+    if args.policy:
+        for name, data_file in index.find_by_policy(args.policy):
+            print('%s %s' % (name, data_file))
+    else:
+        for name, data_file, trigger, mc in index.find(args.trigger,
+                                                       args.mc):
+            print('%s %s %s %s' % (name, trigger, mc, data_file))
+    return 0
+
+
+def _stats(args, logger):
+    stats = TriggerIndex(args.index).stats()
+    print('objects: %d' % stats['objects'])
+    for trigger in TRIGGERS:
+        print('%s: %d' % (trigger, stats['triggers'].get(trigger, 0)))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Builds and queries the node-local Vertigo trigger index')
+    parser.add_argument('--index', default=DEFAULT_INDEX_PATH)
+    subparsers = parser.add_subparsers()
+
+    crawl = subparsers.add_parser('crawl', help='index the local devices')
+    crawl.add_argument('--devices', default='/srv/node')
+    crawl.add_argument('--skip-mount-check', action='store_true')
+    crawl.add_argument('--once', action='store_true',
+                       help='run a single crawl')
+    crawl.add_argument('--interval', type=float, default=3600,
+                       help='seconds between crawls (default: 3600)')
+    crawl.add_argument('--max-rate', type=float, default=100,
+                       help='maximum data files read per second '
+                            '(default: 100)')
+    crawl.add_argument('--commit-interval', type=int, default=1000,
+                       help='data files between index commits')
+    crawl.add_argument('--report-interval', type=float, default=60,
+                       help='seconds between progress reports')
+    crawl.set_defaults(func=_crawl)
+
+    query = subparsers.add_parser(
+        'query', help='list the objects with a microcontroller or policy')
+    query.add_argument('--trigger', choices=TRIGGERS)
+    query.add_argument('--mc')
+    query.add_argument('--policy',
+                       help='list the objects that inherit this policy')
+    query.set_defaults(func=_query)
+
+    stats = subparsers.add_parser('stats', help='show index statistics')
+    stats.set_defaults(func=_stats)
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    logger = logging.getLogger('vertigo-trigger-index')
+
+    return args.func(args, logger)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,27 @@
 from swift.common.swob import HTTPInternalServerError, HTTPException, wsgify
-from swift.common.utils import get_logger
+from swift.common.utils import get_logger, config_true_value, \
+    cache_from_env
 from ConfigParser import RawConfigParser
 from vertigo_middleware.handlers import VertigoProxyHandler
 from vertigo_middleware.handlers import VertigoObjectHandler
 from vertigo_middleware.handlers.base import NotVertigoRequest
+from vertigo_middleware.common.object_cache import HotObjectCache, \
+    HOT_OBJECT_KEY_PREFIX
+from vertigo_middleware.common.prefetch import PrefetchEngine
+from vertigo_middleware.common.coalescing import RequestCoalescer
+from vertigo_middleware.common.policies import PolicyStore, \
+    BackendPolicyStore
+from vertigo_middleware.common.deferred_queue import DeferredQueue, \
+    DeferredInvoker
+from vertigo_middleware.common.placement import StorletPlacementPlanner
+from vertigo_middleware.common.storlet_cache import StorletOutputCache
+from vertigo_middleware.common.storlet_metadata import StorletMetadataCache
+from vertigo_middleware.common.transform import TransformWorker
+from vertigo_middleware.common.trigger_index import TriggerIndex, \
+    TriggerIndexWriter, DEFAULT_INDEX_PATH
+from vertigo_middleware.common.utils import LINK_CACHE_PREFIX
+from urllib import unquote
+import os
 
 
 class VertigoHandlerMiddleware(object):
@@ -15,6 +33,73 @@ class VertigoHandlerMiddleware(object):
         self.vertigo_conf = vertigo_conf
         self.handler_class = self._get_handler(self.exec_server)
 
+        if self.exec_server == 'proxy' and \
+                config_true_value(vertigo_conf.get('hot_object_cache_enabled')):
+            # One cache per worker, shared by all its requests
+            self.vertigo_conf['hot_object_cache'] = HotObjectCache(
+                vertigo_conf, self.logger)
+            if config_true_value(vertigo_conf.get('prefetch_enabled')):
+                self.vertigo_conf['prefetch_engine'] = PrefetchEngine(
+                    vertigo_conf, self.logger, self.app,
+                    self.vertigo_conf['hot_object_cache'])
+
+        if self.exec_server == 'proxy':
+            self.vertigo_conf['policy_store'] = PolicyStore(vertigo_conf,
+                                                            self.logger)
+            # Entry point of the microcontroller API bus subrequests
+            self.vertigo_conf['vertigo_app'] = self
+        elif self.exec_server == 'object':
+            # Policies not forwarded by the proxy, or outdated
+            self.vertigo_conf['policy_store'] = BackendPolicyStore(
+                vertigo_conf, self.logger)
+
+        if self.exec_server == 'proxy' and \
+                config_true_value(vertigo_conf.get('ondelete_enabled')):
+            queue = DeferredQueue(
+                vertigo_conf.get('ondelete_queue_dir',
+                                 '/var/cache/vertigo/deferred'),
+                int(vertigo_conf.get('ondelete_queue_size', 10000)),
+                self.logger)
+            self.vertigo_conf['deferred_invoker'] = DeferredInvoker(
+                vertigo_conf, self.logger, queue)
+
+        if self.exec_server == 'proxy' and \
+                vertigo_conf.get('storlet_put_mode') == 'deferred':
+            queue = DeferredQueue(
+                vertigo_conf.get('storlet_transform_queue_dir',
+                                 '/var/cache/vertigo/transform'),
+                int(vertigo_conf.get('storlet_transform_queue_size', 10000)),
+                self.logger)
+            self.vertigo_conf['transform_worker'] = TransformWorker(
+                vertigo_conf, self.logger, queue, self.app)
+
+        if self.exec_server == 'proxy' and \
+                config_true_value(vertigo_conf.get('request_coalescing')):
+            self.vertigo_conf['request_coalescer'] = RequestCoalescer(
+                vertigo_conf, self.logger)
+
+        # Only the proxies see the updates of the storlet container, and
+        # the object servers have no memcache to learn about them
+        if self.exec_server == 'proxy' and \
+                float(vertigo_conf.get('storlet_metadata_ttl', 30)) > 0:
+            self.vertigo_conf['storlet_metadata_cache'] = \
+                StorletMetadataCache(vertigo_conf, self.logger)
+
+        if vertigo_conf.get('storlet_placement') == 'cost':
+            self.vertigo_conf['storlet_planner'] = StorletPlacementPlanner(
+                vertigo_conf, self.logger)
+
+        if config_true_value(vertigo_conf.get('storlet_cache_enabled')):
+            self.vertigo_conf['storlet_output_cache'] = StorletOutputCache(
+                vertigo_conf, self.logger)
+
+        if self.exec_server == 'object' and \
+                config_true_value(vertigo_conf.get('trigger_index_enabled')):
+            self.vertigo_conf['trigger_index'] = TriggerIndexWriter(
+                TriggerIndex(vertigo_conf.get('trigger_index_path',
+                                              DEFAULT_INDEX_PATH),
+                             check_same_thread=False))
+
     def _get_handler(self, exec_server):
         """
         Generate Handler class based on execution_server parameter
@@ -32,8 +117,58 @@ class VertigoHandlerMiddleware(object):
                 'configuration error: execution_server must be either proxy'
                 ' or object but is %s' % exec_server)
 
+    def _invalidate_storlet_metadata(self, req):
+        """
+        Drops the cached metadata of an updated storlet
+        """
+        # /version/account/container/object
+        vaco = req.environ['PATH_INFO'].split('/', 4)
+        if len(vaco) == 5 and vaco[4] and \
+                vaco[3] == self.vertigo_conf.get('storlet_container'):
+            self.vertigo_conf['storlet_metadata_cache'].invalidate(
+                vaco[2], vaco[4], cache_from_env(req.environ, True))
+
+    def _invalidate_copy_destination(self, req):
+        """
+        Drops the cached copies of the destination of a server-side copy
+        (PUT with X-Copy-From, or COPY), which is not handled by the proxy
+        handler: the hot-object cache, its ETag and the link cache
+        """
+        # /version/account/container/object
+        vaco = req.environ['PATH_INFO'].split('/', 4)
+        if len(vaco) < 5:
+            return
+        account = vaco[2]
+        if req.method == 'COPY':
+            destination = unquote(req.headers.get('Destination', ''))
+            account = req.headers.get('Destination-Account', account)
+        else:
+            destination = '/'.join(vaco[3:])
+        obj = os.path.join(account, destination.lstrip('/'))
+
+        memcache = cache_from_env(req.environ, True)
+        hot_object_cache = self.vertigo_conf.get('hot_object_cache')
+        if hot_object_cache is not None:
+            hot_object_cache.invalidate(obj)
+        if memcache is not None:
+            memcache.delete(HOT_OBJECT_KEY_PREFIX + obj)
+            memcache.delete(LINK_CACHE_PREFIX + obj)
+
     @wsgify
     def __call__(self, req):
+        if not self.handler_class.is_vertigo_request(req.environ,
+                                                     self.vertigo_conf):
+            response = self.handler_class.bypass_request(req, self.app)
+            if self.exec_server == 'proxy' and \
+                    req.method in ('PUT', 'POST', 'DELETE') and \
+                    'storlet_metadata_cache' in self.vertigo_conf:
+                self._invalidate_storlet_metadata(req)
+            if self.exec_server == 'proxy' and (
+                    req.method == 'COPY' or (req.method == 'PUT' and
+                                             'X-Copy-From' in req.headers)):
+                self._invalidate_copy_destination(req)
+            return response
+
         try:
             request_handler = self.handler_class(
                 req, self.vertigo_conf, self.app, self.logger)
@@ -58,23 +193,61 @@ class VertigoHandlerMiddleware(object):
             raise HTTPInternalServerError(body='Vertigo execution failed')
 
 
-def filter_factory(global_conf, **local_conf):
-    """Standard filter factory to use the middleware with paste.deploy"""
-
-    conf = global_conf.copy()
-    conf.update(local_conf)
+def load_vertigo_conf(conf):
+    """
+    Builds the gateway conf dict from the filter conf, and the storlet
+    middleware and gateway confs it points to
 
+    :param conf: conf dict of the filter, with its __file__
+    :returns: gateway conf dict
+    """
     vertigo_conf = dict()
     vertigo_conf['devices'] = conf.get('devices', '/srv/node')
     vertigo_conf['execution_server'] = conf.get('execution_server')
     vertigo_conf['mc_timeout'] = conf.get('mc_timeout', 5)
     vertigo_conf['mc_pipe'] = conf.get('mc_pipe', 'vertigo_pipe')
-    # vertigo_conf['api_pipe'] = conf.get('mc_pipe', 'api_pipe')
     vertigo_conf['metadata_visibility'] = conf.get('metadata_visibility', True)
     vertigo_conf['mc_dir'] = conf.get('mc_dir', '/home/docker_device/vertigo/scopes')
     vertigo_conf['cache_dir'] = conf.get('cache_dir', '/home/docker_device/cache/scopes')
     vertigo_conf['mc_container'] = conf.get('mc_container', 'microcontroller')
     vertigo_conf['mc_dependency'] = conf.get('mc_dependency', 'dependency')
+    vertigo_conf['pseudo_folder_concurrency'] = conf.get('pseudo_folder_concurrency', 10)
+    vertigo_conf['hot_object_cache_enabled'] = conf.get('hot_object_cache_enabled', False)
+    vertigo_conf['prefetch_enabled'] = conf.get('prefetch_enabled', True)
+    vertigo_conf['request_coalescing'] = conf.get('request_coalescing', False)
+    vertigo_conf['ondelete_enabled'] = conf.get('ondelete_enabled', False)
+    for key in ('hot_object_cache_dir', 'hot_object_mem_max_size',
+                'hot_object_max_size', 'hot_object_mem_capacity',
+                'hot_object_mmap_capacity', 'hot_object_min_hits',
+                'hot_object_rescan_interval',
+                'prefetch_concurrency', 'prefetch_max_pending',
+                'coalescing_buffer_size', 'coalescing_max_tracked',
+                'coalescing_request_independent_mcs',
+                'policy_cache_ttl', 'policy_cache_size', 'policy_fanout',
+                'trigger_index_enabled', 'trigger_index_path',
+                'timer_default_interval', 'timer_min_interval',
+                'timer_jitter', 'timer_max_jitter', 'timer_batch_size',
+                'timer_tenant_rate', 'timer_tenant_burst', 'timer_catch_up',
+                'timer_max_catch_up', 'timer_retry_interval', 'timer_tick',
+                'ondelete_mode', 'ondelete_queue_dir', 'ondelete_queue_size',
+                'ondelete_poll_interval', 'deferred_max_retries',
+                'deferred_retry_interval', 'speculative_get',
+                'speculative_buffer_size', 'streaming_put',
+                'streaming_put_spool_size', 'storlet_put_mode',
+                'storlet_transform_queue_dir', 'storlet_transform_queue_size',
+                'storlet_transform_workers', 'storlet_pending_get',
+                'storlet_cache_enabled', 'storlet_cache_dir',
+                'storlet_cache_capacity', 'storlet_cache_max_size',
+                'storlet_cache_rescan_interval', 'storlet_metadata_ttl',
+                'storlet_metadata_cache_size', 'storlet_range_spool_size',
+                'slo_segment_concurrency', 'slo_segment_buffer_chunks',
+                'storlet_placement', 'storlet_placement_debug',
+                'storlet_default_selectivity', 'storlet_default_cpu_cost',
+                'storlet_default_object_size', 'storlet_network_cost',
+                'storlet_stats_alpha', 'mc_data_sample_size', 'api_bus',
+                'api_bus_timeout'):
+        if key in conf:
+            vertigo_conf[key] = conf[key]
 
     ''' Load storlet parameters '''
     configParser = RawConfigParser()
@@ -89,6 +262,12 @@ def filter_factory(global_conf, **local_conf):
     for key, val in additional_items:
         vertigo_conf[key] = val
 
+    vertigo_conf['vertigo_containers'] = frozenset(
+        [vertigo_conf['mc_container'],
+         vertigo_conf['mc_dependency'],
+         vertigo_conf.get('storlet_container'),
+         vertigo_conf.get('storlet_dependency')])
+
     """ Load Storlets Gateway class """
     module_name = vertigo_conf['storlet_gateway_module']
     mo = module_name[:module_name.rfind(':')]
@@ -97,6 +276,17 @@ def filter_factory(global_conf, **local_conf):
     the_class = getattr(module, cl)
     vertigo_conf["storlets_gateway_module"] = the_class
 
+    return vertigo_conf
+
+
+def filter_factory(global_conf, **local_conf):
+    """Standard filter factory to use the middleware with paste.deploy"""
+
+    conf = global_conf.copy()
+    conf.update(local_conf)
+
+    vertigo_conf = load_vertigo_conf(conf)
+
     def swift_vertigo(app):
         return VertigoHandlerMiddleware(app, global_conf, vertigo_conf)
 